@@ -0,0 +1,24 @@
+"""Add items keyset index
+
+Revision ID: 3c9e1f0a7b42
+Revises: 839fff2a2af8
+Create Date: 2026-10-18 09:12:41.204113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e1f0a7b42'
+down_revision = '839fff2a2af8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_items_owner_id_addition_date_id', 'items', ['owner_id', 'addition_date', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_items_owner_id_addition_date_id', table_name='items')
@@ -0,0 +1,75 @@
+"""Move inline thumbnails to files
+
+Revision ID: 6f0b8d3a2c17
+Revises: a51d2e8c94f3
+Create Date: 2026-10-18 11:26:05.318742
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import base64
+import binascii
+import hashlib
+import json
+import os
+import os.path
+
+
+# revision identifiers, used by Alembic.
+revision = '6f0b8d3a2c17'
+down_revision = 'a51d2e8c94f3'
+branch_labels = None
+depends_on = None
+
+PHOTOS_DIR = './local/photos'
+
+items = sa.table('items',
+    sa.column('id', sa.Integer),
+    sa.column('owner_id', sa.Integer),
+    sa.column('photos', sa.String),
+)
+
+
+def upgrade() -> None:
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(items.c.id, items.c.owner_id, items.c.photos)).fetchall()
+    for item_id, owner_id, photos in rows:
+        photos = json.loads(photos) if photos else None
+        if not photos or 'thumbnail' not in photos:
+            continue
+
+        thumbnail = photos.pop('thumbnail')
+        photos['thumbnail_id'] = None
+        if thumbnail:
+            try:
+                data = base64.b64decode(thumbnail, validate=True)
+            except binascii.Error:
+                data = None
+            if data:
+                thumbnail_id = f'{item_id}-{hashlib.sha256(data).hexdigest()[:16]}'
+                thumbnail_dir = f'{PHOTOS_DIR}/{owner_id}/thumbnails'
+                os.makedirs(thumbnail_dir, exist_ok=True)
+                with open(f'{thumbnail_dir}/{thumbnail_id}.jpeg', 'wb') as thumbnail_file:
+                    thumbnail_file.write(data)
+                photos['thumbnail_id'] = thumbnail_id
+
+        connection.execute(items.update().where(items.c.id == item_id).values(photos=json.dumps(photos)))
+
+
+def downgrade() -> None:
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(items.c.id, items.c.owner_id, items.c.photos)).fetchall()
+    for item_id, owner_id, photos in rows:
+        photos = json.loads(photos) if photos else None
+        if not photos or 'thumbnail_id' not in photos:
+            continue
+
+        thumbnail_id = photos.pop('thumbnail_id')
+        if thumbnail_id:
+            thumbnail_path = f'{PHOTOS_DIR}/{owner_id}/thumbnails/{thumbnail_id}.jpeg'
+            if os.path.isfile(thumbnail_path):
+                with open(thumbnail_path, 'rb') as thumbnail_file:
+                    photos['thumbnail'] = base64.b64encode(thumbnail_file.read()).decode()
+
+        connection.execute(items.update().where(items.c.id == item_id).values(photos=json.dumps(photos)))
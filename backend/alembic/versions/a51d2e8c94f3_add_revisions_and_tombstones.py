@@ -0,0 +1,60 @@
+"""Add revisions and tombstones
+
+Revision ID: a51d2e8c94f3
+Revises: 3c9e1f0a7b42
+Create Date: 2026-10-18 10:03:17.562310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a51d2e8c94f3'
+down_revision = '3c9e1f0a7b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('revision', sa.Integer(), nullable=False, server_default="0"))
+    op.add_column('items', sa.Column('revision', sa.Integer(), nullable=False, server_default="0"))
+    op.add_column('tags', sa.Column('revision', sa.Integer(), nullable=False, server_default="0"))
+    op.add_column('locations', sa.Column('revision', sa.Integer(), nullable=False, server_default="0"))
+
+    # Existing data belongs to the first revision, so that a sync from revision 0 returns it all
+    op.execute('UPDATE users SET revision = 1')
+    op.execute('UPDATE items SET revision = 1')
+    op.execute('UPDATE tags SET revision = 1')
+    op.execute('UPDATE locations SET revision = 1')
+
+    op.create_index('ix_items_owner_id_revision', 'items', ['owner_id', 'revision'], unique=False)
+    op.create_index('ix_tags_owner_id_revision', 'tags', ['owner_id', 'revision'], unique=False)
+    op.create_index('ix_locations_owner_id_revision', 'locations', ['owner_id', 'revision'], unique=False)
+
+    op.create_table('tombstones',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('object_id', sa.Integer(), nullable=False),
+    sa.Column('revision', sa.Integer(), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_tombstones_id'), 'tombstones', ['id'], unique=False)
+    op.create_index('ix_tombstones_owner_id_revision', 'tombstones', ['owner_id', 'revision'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tombstones_owner_id_revision', table_name='tombstones')
+    op.drop_index(op.f('ix_tombstones_id'), table_name='tombstones')
+    op.drop_table('tombstones')
+
+    op.drop_index('ix_locations_owner_id_revision', table_name='locations')
+    op.drop_index('ix_tags_owner_id_revision', table_name='tags')
+    op.drop_index('ix_items_owner_id_revision', table_name='items')
+
+    op.drop_column('locations', 'revision')
+    op.drop_column('tags', 'revision')
+    op.drop_column('items', 'revision')
+    op.drop_column('users', 'revision')
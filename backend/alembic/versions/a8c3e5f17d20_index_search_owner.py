@@ -0,0 +1,88 @@
+"""Index the owner of the items in the full-text search
+
+Revision ID: a8c3e5f17d20
+Revises: f3b8d2e6a4c9
+Create Date: 2026-10-19 10:12:44.305172
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8c3e5f17d20'
+down_revision = 'f3b8d2e6a4c9'
+branch_labels = None
+depends_on = None
+
+# The FTS5 columns cannot be changed: the table, its triggers and its content are created again,
+# with the owner as an indexed token (`u<owner_id>`) instead of an unindexed column
+TABLES = {
+    'owner': "owner, name, description, code, tags, locations",
+    'owner_id': "owner_id UNINDEXED, name, description, code, tags, locations",
+}
+OWNER_VALUES = {
+    'owner': "'u' || items.owner_id",
+    'owner_id': "items.owner_id",
+}
+
+INDEX_ITEMS = """INSERT INTO items_fts (rowid, {owner_column}, name, description, code, tags, locations)
+    SELECT items.id, {owner_value}, items.name, items.description, items.code,
+        (SELECT group_concat(tags.name, ' ') FROM item_tags JOIN tags ON tags.id = item_tags.tag_id
+            WHERE item_tags.item_id = items.id),
+        (SELECT group_concat(locations.name, ' ') FROM item_locations JOIN locations ON locations.id = item_locations.location_id
+            WHERE item_locations.item_id = items.id)
+    FROM items WHERE {condition};"""
+
+def get_triggers(owner_column: str):
+    def index_items(condition: str):
+        return INDEX_ITEMS.format(owner_column=owner_column, owner_value=OWNER_VALUES[owner_column],
+                                  condition=condition)
+
+    def reindex_items(condition: str):
+        return f"DELETE FROM items_fts WHERE rowid IN (SELECT id FROM items WHERE {condition}); " + \
+            index_items(condition)
+
+    return {
+        'items_fts_items_insert': "AFTER INSERT ON items BEGIN " +
+            index_items('items.id = new.id') + " END",
+        'items_fts_items_update': "AFTER UPDATE OF name, description, code, owner_id ON items BEGIN " +
+            "DELETE FROM items_fts WHERE rowid = old.id; " + index_items('items.id = new.id') + " END",
+        'items_fts_items_delete': "AFTER DELETE ON items BEGIN " +
+            "DELETE FROM items_fts WHERE rowid = old.id; END",
+        'items_fts_item_tags_insert': "AFTER INSERT ON item_tags BEGIN " +
+            reindex_items('items.id = new.item_id') + " END",
+        'items_fts_item_tags_delete': "AFTER DELETE ON item_tags BEGIN " +
+            reindex_items('items.id = old.item_id') + " END",
+        'items_fts_item_locations_insert': "AFTER INSERT ON item_locations BEGIN " +
+            reindex_items('items.id = new.item_id') + " END",
+        'items_fts_item_locations_delete': "AFTER DELETE ON item_locations BEGIN " +
+            reindex_items('items.id = old.item_id') + " END",
+        'items_fts_tags_update': "AFTER UPDATE OF name ON tags BEGIN " +
+            reindex_items('items.id IN (SELECT item_id FROM item_tags WHERE tag_id = new.id)') + " END",
+        'items_fts_locations_update': "AFTER UPDATE OF name ON locations BEGIN " +
+            reindex_items('items.id IN (SELECT item_id FROM item_locations WHERE location_id = new.id)') + " END",
+    }
+
+def create_index(owner_column: str):
+    op.execute(f"CREATE VIRTUAL TABLE items_fts USING fts5({TABLES[owner_column]}, "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+    op.execute("INSERT INTO items_fts (items_fts, rank) VALUES ('rank', 'bm25(0, 10.0, 1.0, 2.0, 5.0, 5.0)')")
+    for name, definition in get_triggers(owner_column).items():
+        op.execute(f"CREATE TRIGGER {name} {definition}")
+    op.execute(INDEX_ITEMS.format(owner_column=owner_column, owner_value=OWNER_VALUES[owner_column], condition='1'))
+
+def drop_index(owner_column: str):
+    for name in get_triggers(owner_column):
+        op.execute(f"DROP TRIGGER {name}")
+    op.execute("DROP TABLE items_fts")
+
+
+def upgrade() -> None:
+    drop_index('owner_id')
+    create_index('owner')
+
+
+def downgrade() -> None:
+    drop_index('owner')
+    create_index('owner_id')
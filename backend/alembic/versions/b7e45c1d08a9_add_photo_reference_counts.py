@@ -0,0 +1,54 @@
+"""Add photo reference counts
+
+Revision ID: b7e45c1d08a9
+Revises: 6f0b8d3a2c17
+Create Date: 2026-10-18 13:41:52.907215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from collections import Counter
+import json
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e45c1d08a9'
+down_revision = '6f0b8d3a2c17'
+branch_labels = None
+depends_on = None
+
+items = sa.table('items',
+    sa.column('owner_id', sa.Integer),
+    sa.column('photos', sa.String),
+)
+
+
+def upgrade() -> None:
+    photos = op.create_table('photos',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('image_id', sa.String(), nullable=False),
+    sa.Column('ref_count', sa.Integer(), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('owner_id', 'image_id')
+    )
+    op.create_index(op.f('ix_photos_id'), 'photos', ['id'], unique=False)
+
+    # Count the references to the already uploaded photos
+    ref_counts = Counter()
+    for owner_id, item_photos in op.get_bind().execute(sa.select(items.c.owner_id, items.c.photos)):
+        item_photos = json.loads(item_photos) if item_photos else None
+        for image_id in (item_photos or {}).get('sources') or []:
+            ref_counts[(owner_id, image_id)] += 1
+    if ref_counts:
+        op.bulk_insert(photos, [
+            {'owner_id': owner_id, 'image_id': image_id, 'ref_count': ref_count}
+            for (owner_id, image_id), ref_count in ref_counts.items()
+        ])
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_photos_id'), table_name='photos')
+    op.drop_table('photos')
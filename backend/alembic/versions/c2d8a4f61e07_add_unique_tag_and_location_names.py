@@ -0,0 +1,57 @@
+"""Add unique tag and location names
+
+Revision ID: c2d8a4f61e07
+Revises: b7e45c1d08a9
+Create Date: 2026-10-18 16:12:40.318264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d8a4f61e07'
+down_revision = 'b7e45c1d08a9'
+branch_labels = None
+depends_on = None
+
+
+def merge_duplicates(table: str, link_table: str, link_column: str, kind: str):
+    """Merge the tags or locations of a user that have the same name (e.g., created by concurrent writes)
+    into the oldest one. The merged ones get a tombstone, and their items a new revision, so that clients sync them."""
+    bind = op.get_bind()
+    duplicates = bind.execute(sa.text(
+        f'SELECT duplicate.id, kept.id, duplicate.owner_id FROM {table} AS duplicate '
+        f'JOIN (SELECT owner_id, name, MIN(id) AS id FROM {table} GROUP BY owner_id, name) AS kept '
+        f'ON kept.owner_id = duplicate.owner_id AND kept.name = duplicate.name '
+        f'WHERE duplicate.id != kept.id')).fetchall()
+
+    for duplicate_id, kept_id, owner_id in duplicates:
+        parameters = {'duplicate_id': duplicate_id, 'kept_id': kept_id, 'owner_id': owner_id, 'kind': kind}
+        bind.execute(sa.text('UPDATE users SET revision = revision + 1 WHERE id = :owner_id'), parameters)
+        parameters['revision'] = bind.execute(sa.text('SELECT revision FROM users WHERE id = :owner_id'), parameters).scalar()
+
+        bind.execute(sa.text(
+            f'UPDATE items SET revision = :revision '
+            f'WHERE id IN (SELECT item_id FROM {link_table} WHERE {link_column} = :duplicate_id)'), parameters)
+        bind.execute(sa.text(
+            f'INSERT OR IGNORE INTO {link_table} (item_id, {link_column}) '
+            f'SELECT item_id, :kept_id FROM {link_table} WHERE {link_column} = :duplicate_id'), parameters)
+        bind.execute(sa.text(f'DELETE FROM {link_table} WHERE {link_column} = :duplicate_id'), parameters)
+        bind.execute(sa.text(f'DELETE FROM {table} WHERE id = :duplicate_id'), parameters)
+        bind.execute(sa.text(
+            'INSERT INTO tombstones (kind, object_id, revision, owner_id) '
+            'VALUES (:kind, :duplicate_id, :revision, :owner_id)'), parameters)
+
+
+def upgrade() -> None:
+    merge_duplicates('tags', 'item_tags', 'tag_id', 'tag')
+    merge_duplicates('locations', 'item_locations', 'location_id', 'location')
+
+    op.create_index('ux_tags_owner_id_name', 'tags', ['owner_id', 'name'], unique=True)
+    op.create_index('ux_locations_owner_id_name', 'locations', ['owner_id', 'name'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ux_locations_owner_id_name', table_name='locations')
+    op.drop_index('ux_tags_owner_id_name', table_name='tags')
@@ -0,0 +1,66 @@
+"""Add items full-text search
+
+Revision ID: d4e9b7a3c5f1
+Revises: c2d8a4f61e07
+Create Date: 2026-10-18 17:05:21.664093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4e9b7a3c5f1'
+down_revision = 'c2d8a4f61e07'
+branch_labels = None
+depends_on = None
+
+INDEX_ITEMS = """INSERT INTO items_fts (rowid, owner_id, name, description, code, tags, locations)
+    SELECT items.id, items.owner_id, items.name, items.description, items.code,
+        (SELECT group_concat(tags.name, ' ') FROM item_tags JOIN tags ON tags.id = item_tags.tag_id
+            WHERE item_tags.item_id = items.id),
+        (SELECT group_concat(locations.name, ' ') FROM item_locations JOIN locations ON locations.id = item_locations.location_id
+            WHERE item_locations.item_id = items.id)
+    FROM items WHERE {condition};"""
+
+def reindex_items(condition: str):
+    return f"DELETE FROM items_fts WHERE rowid IN (SELECT id FROM items WHERE {condition}); " + \
+        INDEX_ITEMS.format(condition=condition)
+
+TRIGGERS = {
+    'items_fts_items_insert': "AFTER INSERT ON items BEGIN " +
+        INDEX_ITEMS.format(condition='items.id = new.id') + " END",
+    'items_fts_items_update': "AFTER UPDATE OF name, description, code, owner_id ON items BEGIN " +
+        "DELETE FROM items_fts WHERE rowid = old.id; " + INDEX_ITEMS.format(condition='items.id = new.id') + " END",
+    'items_fts_items_delete': "AFTER DELETE ON items BEGIN " +
+        "DELETE FROM items_fts WHERE rowid = old.id; END",
+    'items_fts_item_tags_insert': "AFTER INSERT ON item_tags BEGIN " +
+        reindex_items('items.id = new.item_id') + " END",
+    'items_fts_item_tags_delete': "AFTER DELETE ON item_tags BEGIN " +
+        reindex_items('items.id = old.item_id') + " END",
+    'items_fts_item_locations_insert': "AFTER INSERT ON item_locations BEGIN " +
+        reindex_items('items.id = new.item_id') + " END",
+    'items_fts_item_locations_delete': "AFTER DELETE ON item_locations BEGIN " +
+        reindex_items('items.id = old.item_id') + " END",
+    'items_fts_tags_update': "AFTER UPDATE OF name ON tags BEGIN " +
+        reindex_items('items.id IN (SELECT item_id FROM item_tags WHERE tag_id = new.id)') + " END",
+    'items_fts_locations_update': "AFTER UPDATE OF name ON locations BEGIN " +
+        reindex_items('items.id IN (SELECT item_id FROM item_locations WHERE location_id = new.id)') + " END",
+}
+
+
+def upgrade() -> None:
+    op.execute("CREATE VIRTUAL TABLE items_fts USING fts5(owner_id UNINDEXED, name, description, code, tags, locations, "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+    op.execute("INSERT INTO items_fts (items_fts, rank) VALUES ('rank', 'bm25(0, 10.0, 1.0, 2.0, 5.0, 5.0)')")
+    for name, definition in TRIGGERS.items():
+        op.execute(f"CREATE TRIGGER {name} {definition}")
+
+    # Index the existing items
+    op.execute(INDEX_ITEMS.format(condition='1'))
+
+
+def downgrade() -> None:
+    for name in TRIGGERS:
+        op.execute(f"DROP TRIGGER {name}")
+    op.execute("DROP TABLE items_fts")
@@ -0,0 +1,28 @@
+"""Add item filter indexes
+
+Revision ID: e5a1c7d9b3f2
+Revises: d4e9b7a3c5f1
+Create Date: 2026-10-18 18:05:12.640318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a1c7d9b3f2'
+down_revision = 'd4e9b7a3c5f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_item_tags_tag_id_item_id', 'item_tags', ['tag_id', 'item_id'], unique=False)
+    op.create_index('ix_item_locations_location_id_item_id', 'item_locations', ['location_id', 'item_id'], unique=False)
+    op.create_index('ix_items_owner_id_expiration_date', 'items', ['owner_id', 'expiration_date'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_items_owner_id_expiration_date', table_name='items')
+    op.drop_index('ix_item_locations_location_id_item_id', table_name='item_locations')
+    op.drop_index('ix_item_tags_tag_id_item_id', table_name='item_tags')
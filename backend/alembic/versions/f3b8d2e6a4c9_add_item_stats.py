@@ -0,0 +1,47 @@
+"""Add item stats
+
+Revision ID: f3b8d2e6a4c9
+Revises: e5a1c7d9b3f2
+Create Date: 2026-10-18 19:02:37.118452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d2e6a4c9'
+down_revision = 'e5a1c7d9b3f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('item_stats',
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('object_id', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('cost', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('owner_id', 'kind', 'object_id')
+    )
+
+    # Compute the stats of the existing items
+    op.execute(
+        "INSERT INTO item_stats (owner_id, kind, object_id, count, cost) "
+        "SELECT owner_id, CASE WHEN is_active THEN 'active' ELSE 'archived' END, 0, COUNT(*), SUM(cost) "
+        "FROM items GROUP BY owner_id, is_active")
+    op.execute(
+        "INSERT INTO item_stats (owner_id, kind, object_id, count, cost) "
+        "SELECT items.owner_id, 'tag', item_tags.tag_id, COUNT(*), SUM(items.cost) "
+        "FROM items JOIN item_tags ON item_tags.item_id = items.id GROUP BY items.owner_id, item_tags.tag_id")
+    op.execute(
+        "INSERT INTO item_stats (owner_id, kind, object_id, count, cost) "
+        "SELECT items.owner_id, 'location', item_locations.location_id, COUNT(*), SUM(items.cost) "
+        "FROM items JOIN item_locations ON item_locations.item_id = items.id "
+        "GROUP BY items.owner_id, item_locations.location_id")
+
+
+def downgrade() -> None:
+    op.drop_table('item_stats')
@@ -0,0 +1,55 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """A bounded cache whose entries expire after a time-to-live.
+    When the cache is full, the least recently used entry is evicted.
+    The cache is safe to use from multiple threads."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Get the value cached for a key, or None if the key is missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires: float = None):
+        """Cache a value for a key.
+        The entry expires after the TTL, or at the `expires` timestamp if that comes first."""
+        expires_ttl = time.time() + self.ttl
+        expires = min(expires, expires_ttl) if expires else expires_ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """Remove the entries whose value satisfies a predicate."""
+        with self.lock:
+            for key in [key for key, (value, _) in self.entries.items() if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
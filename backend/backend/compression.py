@@ -0,0 +1,106 @@
+"""Compression of the API responses, negotiated with the `Accept-Encoding` header of the requests:
+zstd, brotli and gzip, by order of preference (see COMPRESSION_ENCODINGS).
+
+A body is compressed chunk by chunk while it is sent, so it is never held twice in memory.
+The small bodies, whose compression saves little, and the ones compressed already
+(e.g., the JPEG images) are sent as they are.
+"""
+import zlib
+
+import brotli
+from decouple import Csv
+from starlette.datastructures import Headers
+import zstandard
+
+from .config import config
+
+# Bodies smaller than this, in bytes, are not compressed
+COMPRESSION_MIN_SIZE = config('COMPRESSION_MIN_SIZE', default=1024, cast=int)
+# Encodings used, by order of preference
+COMPRESSION_ENCODINGS = config('COMPRESSION_ENCODINGS', default='zstd,br,gzip', cast=Csv())
+
+# Levels for compressing on the fly: most of the size gain, for little CPU time
+LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+class GzipCompressor:
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+class BrotliCompressor:
+    def __init__(self, level: int):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+class ZstdCompressor:
+    def __init__(self, level: int):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+COMPRESSORS = {'zstd': ZstdCompressor, 'br': BrotliCompressor, 'gzip': GzipCompressor}
+
+def get_available_encodings():
+    """Get the encodings that can be used, by order of preference (the unknown ones are skipped)."""
+    return [encoding for encoding in COMPRESSION_ENCODINGS if encoding in COMPRESSORS]
+
+AVAILABLE_ENCODINGS = get_available_encodings()
+
+def create_compressor(encoding: str, level: int = None):
+    """Get a compressor, with `compress(data)` for each chunk and `flush()` for the end of the data."""
+    return COMPRESSORS[encoding](LEVELS[encoding] if level is None else level)
+
+def get_accepted_encodings(headers: Headers, encodings):
+    """Get the encodings among the given ones that a request accepts, highest q-value first,
+    in their order for equal q-values. An encoding with a zero q-value is refused, even if `*` is accepted."""
+    qvalues = {}
+    for value in headers.get('accept-encoding', '').split(','):
+        name, _, parameters = value.strip().partition(';')
+        parameters = parameters.replace(' ', '')
+        try:
+            qvalue = float(parameters[2:]) if parameters.startswith('q=') else 1.0
+        except ValueError:
+            qvalue = 1.0
+        if name.strip():
+            qvalues[name.strip().lower()] = qvalue
+    accepted = [(qvalues.get(encoding, qvalues.get('*', 0)), encoding) for encoding in encodings]
+    return tuple(encoding for qvalue, encoding in sorted(accepted, key=lambda pair: -pair[0]) if qvalue > 0)
+
+def choose_encoding(headers: Headers):
+    """Get the preferred encoding that a request accepts, or None to send the response as it is."""
+    accepted = get_accepted_encodings(headers, AVAILABLE_ENCODINGS)
+    return accepted[0] if accepted else None
+
+def is_compressible(status_code: int, headers: Headers):
+    """Check whether a response is worth compressing, from its status and its headers."""
+    if status_code < 200 or status_code in (204, 206, 304) or 'content-encoding' in headers:
+        return False
+    if not headers.get('content-type', '').startswith(COMPRESSIBLE_TYPES):
+        return False
+    content_length = headers.get('content-length')
+    # A streamed body has no length
+    return content_length is None or int(content_length) >= COMPRESSION_MIN_SIZE
+
+async def compress_body(body_iterator, compressor):
+    """Compress the chunks of a body as they come."""
+    async for chunk in body_iterator:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
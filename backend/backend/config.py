@@ -0,0 +1,4 @@
+from decouple import Config, RepositoryEnv
+
+DOTENV_FILE = './local/.env'
+config = Config(RepositoryEnv(DOTENV_FILE))
@@ -1,9 +1,13 @@
+import base64
+from collections import Counter
 import datetime
-from sqlalchemy.orm import Session
-import json
-import os
+import functools
+from sqlalchemy import case, event, exists, func, literal, literal_column, select, true, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, selectinload
+import re
 
-from . import models, schemas, security
+from . import models, photos, schemas, security
 
 class DbException(Exception):
     pass
@@ -20,27 +24,152 @@ def prepare_db_object(db: Session, db_object, poco_object):
     object_data = poco_object.dict(exclude_unset=True)
     for key, value in object_data.items():
         if (key == 'photos'):
-            setattr(db_object, key, json.dumps(value))
+            set_item_photos(db, db_object, value)
         elif not isinstance(value, list):
             setattr(db_object, key, value)
 
-def get_or_create(session, model, **kwargs):
-    instance = session.query(model).filter_by(**kwargs).first()
-    if instance:
-        return instance
+def set_item_photos(db: Session, db_item, item_photos: dict):
+    """Store the photos information of an item.
+    An inline (base64) thumbnail is moved to a file and only its ID is kept in the DB.
+    Without a new thumbnail, the current one is kept as long as a photo is still selected;
+    a replaced thumbnail is removed after the commit."""
+    previous = db_item.photos
+    previous_thumbnail_id = previous.get('thumbnail_id') if previous else None
+
+    item_photos = dict(item_photos or {})
+    thumbnail = item_photos.pop('thumbnail', None)
+    if thumbnail:
+        item_photos['thumbnail_id'] = photos.save_thumbnail(db_item.owner_id, db_item.id, thumbnail)
+    elif item_photos.get('selected') is not None:
+        item_photos['thumbnail_id'] = previous_thumbnail_id
     else:
-        instance = model(**kwargs)
-        session.add(instance)
-        session.commit()
-        return instance
+        item_photos['thumbnail_id'] = None
+
+    if previous_thumbnail_id and previous_thumbnail_id != item_photos['thumbnail_id']:
+        after_commit(db, photos.queue_deletion, db_item.owner_id, [], [previous_thumbnail_id])
+
+    db_item.photos = item_photos
+
+def get_photo_sources(db_item):
+    """Get the photos (image IDs) shown by an item."""
+    return (db_item.photos or {}).get('sources') or []
+
+def update_photo_refs(db: Session, user_id: int, previous_sources: list, sources: list):
+    """Update the reference counts of the photos of a user, given the photos of an item before and after a change.
+    Returns the photos that are no longer shown by any item; their files can be removed after the commit."""
+    added = Counter(sources) - Counter(previous_sources)
+    removed = Counter(previous_sources) - Counter(sources)
+    if not added and not removed:
+        return []
+
+    db_photos = {db_photo.image_id: db_photo for db_photo in db.query(models.Photo).
+        filter(models.Photo.owner_id == user_id).
+        filter(models.Photo.image_id.in_(set(added) | set(removed)))}
+
+    for image_id, count in added.items():
+        if image_id not in db_photos:
+            db_photos[image_id] = models.Photo(owner_id=user_id, image_id=image_id, ref_count=0)
+            db.add(db_photos[image_id])
+        db_photos[image_id].ref_count += count
+
+    unreferenced = []
+    for image_id, count in removed.items():
+        db_photo = db_photos.get(image_id)
+        if db_photo:
+            db_photo.ref_count -= count
+            if db_photo.ref_count > 0:
+                continue
+            db.delete(db_photo)
+        unreferenced.append(image_id)
+    return unreferenced
+
+def get_photo_files(db: Session, user_id: int):
+    """Get the photos (image IDs) and the thumbnails (thumbnail IDs) shown by the items of a user,
+    i.e., the photo files that must be kept."""
+    image_ids, thumbnail_ids = set(), set()
+    for item_photos, in db.query(models.Item.photos).\
+            filter(models.Item.owner_id == user_id).filter(models.Item.photos.isnot(None)):
+        image_ids.update(item_photos.get('sources') or [])
+        if item_photos.get('thumbnail_id'):
+            thumbnail_ids.add(item_photos['thumbnail_id'])
+    return image_ids, thumbnail_ids
+
+def after_commit(db: Session, func, *args):
+    """Run a function once the changes of a session are in the DB (e.g., to remove the files they no longer use).
+    This is right away, unless the session is part of a write batch (see `storage.Writer`), committed later."""
+    callbacks = db.info.get('after_commit')
+    if callbacks is None:
+        func(*args)
+    else:
+        callbacks.append(functools.partial(func, *args))
+
+def get_or_create_all(db: Session, model, user_id: int, names: list, revision: int):
+    """Get the tags or locations (depending on the model) of a user with the given names, creating the missing ones.
+    The existing ones are found with a single query, and the missing ones are added with a single insert,
+    which skips the names created by a concurrent write (the names of a user are unique).
+    The new ones are stamped with the given revision. Nothing is committed."""
+    names = list(dict.fromkeys(names))
+    if not names:
+        return []
+
+    def query_named(names):
+        return {db_object.name: db_object for db_object in db.query(model).
+            filter(model.owner_id == user_id).
+            filter(model.name.in_(names))}
+
+    db_objects = query_named(names)
+    missing = [name for name in names if name not in db_objects]
+    if missing:
+        db.execute(sqlite_insert(model.__table__).
+            values([{'name': name, 'owner_id': user_id, 'revision': revision} for name in missing]).
+            on_conflict_do_nothing(index_elements=['owner_id', 'name']))
+        db_objects.update(query_named(missing))
+    return [db_objects[name] for name in names]
+
+def next_revision(db: Session, user_id: int):
+    """Increment the change revision of a user and return it.
+    Objects changed by a write are stamped with the new revision, so that clients can sync only the changes."""
+    db.query(models.User).filter(models.User.id == user_id).\
+        update({models.User.revision: models.User.revision + 1}, synchronize_session=False)
+    return get_user_revision(db, user_id)
+
+def restamp_linked_items(db: Session, link_column, object_id: int, revision: int):
+    """Stamp the items linked to a tag or a location (depending on the link column) with a revision, e.g., after
+    it was renamed: the items show the names of their tags and locations, so their synced copies are outdated.
+    Nothing is committed."""
+    db.query(models.Item).\
+        filter(models.Item.id.in_(select(link_column.table.c.item_id).where(link_column == object_id))).\
+        update({models.Item.revision: revision}, synchronize_session=False)
+
+def encode_cursor(db_item):
+    """Build an opaque pagination cursor pointing after the given item."""
+    raw = f'{db_item.addition_date.isoformat()}_{db_item.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    """Get the (addition_date, id) key encoded in a pagination cursor.
+    If the cursor is malformed, an exception is raised."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        addition_date, item_id = raw.split('_')
+        return datetime.date.fromisoformat(addition_date), int(item_id)
+    except ValueError:
+        raise DbException('Invalid cursor.')
 
 #------------------------------------------ Users
 
+@event.listens_for(models.User, 'after_update')
+def invalidate_cached_user(mapper, connection, target):
+    """Drop the cached copies of a user when it changes (e.g., its password or settings).
+    Registered with the DB functions, so that it applies to all the code changing users, not only to the API."""
+    security.user_cache.invalidate(lambda current_user: current_user.id == target.id)
+
 def get_user(db: Session, user_id: int):
-    """Get a specific user in the DB.
+    """Get a specific user in the DB, with its tags and locations.
     The user is identified by its ID in the DB.
     """
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    return db.query(models.User).options(selectinload(models.User.tags), selectinload(models.User.locations)). \
+        filter(models.User.id == user_id).first()
 
 def get_user_by_email(db: Session, email: str):
     """Get a specific user in the DB.
@@ -48,13 +177,19 @@ def get_user_by_email(db: Session, email: str):
     """
     return db.query(models.User).filter(models.User.email == email).first()
 
-def create_user(db: Session, user: schemas.UserCreate):
+def get_user_revision(db: Session, user_id: int):
+    """Get the change revision of a user, i.e., the version of all its items, tags and locations."""
+    return db.query(models.User.revision).filter(models.User.id == user_id).scalar()
+
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: str = None):
     """Create a new user in the DB.
-    The user is identified by its email. If the user exists already, an exception is raised."""
+    The user is identified by its email. If the user exists already, an exception is raised.
+    The password is hashed here, unless its hash is given already."""
     db_user = db.query(models.User).filter(models.User.email == user.email).first()
     if db_user:
         raise DbException('User already registered.')
-    hashed_password = security.get_password_hash(user.password)
+    if hashed_password is None:
+        hashed_password = security.get_password_hash(user.password)
     db_user = models.User(
         email=user.email,
         hashed_password=hashed_password,
@@ -66,7 +201,7 @@ def create_user(db: Session, user: schemas.UserCreate):
     )
     db.add(db_user)
     db.commit()
-    db.refresh(db_user)
+    # No refresh: the new user and its (empty) relationships are loaded already, and would be lazily loaded again
     return db_user
 
 #------------------------------------------ Items
@@ -82,49 +217,214 @@ def get_user_item(db: Session, user_id: int, item_id: int):
         raise DbExceptionNotFound('Item not found')
     return db_item
 
-def get_user_items(db: Session, user_id: int, skip: int = 0, limit: int = 10000):
-    """Get the items associated with a user.
+def get_user_item_revision(db: Session, user_id: int, item_id: int):
+    """Get the revision of an item associated with a specific user, without loading the item.
+    If the item is not found, or the item is not associated with the user, an exception is raised.
+    """
+    revision = db.query(models.Item.revision).filter(models.Item.owner_id == user_id).filter(models.Item.id == item_id).scalar()
+    if revision is None:
+        raise DbExceptionNotFound('Item not found')
+    return revision
+
+FILTER_DRIVING_LINKS = 5000
+
+# The columns of the items shown in the lists (see `summarize_items`)
+ITEM_SUMMARY_COLUMNS = [
+    models.Item.id, models.Item.name, models.Item.quantity, models.Item.cost, models.Item.expiration_date,
+    models.Item.code, models.Item.photos, models.Item.is_active, models.Item.is_bookmarked, models.Item.is_silenced,
+    models.Item.addition_date, models.Item.removal_date,
+]
+
+def query_user_items(db: Session, user_id: int, item_filter: schemas.ItemFilter = None, summary: bool = False):
+    """Query the items associated with a user, restricted to the ones matching a filter (if one is given).
+    With `summary`, only the ITEM_SUMMARY_COLUMNS are queried, as rows instead of ORM objects.
+    Each tag and location of the filter is an EXISTS on the link table, checked while the items are read in order.
+    If one of them has less than FILTER_DRIVING_LINKS items (see `find_driving_link`), the items are read from its
+    link table instead, with its (tag_id/location_id, item_id) index, so that a rare tag or location does not scan
+    all the items."""
+    query = db.query(*ITEM_SUMMARY_COLUMNS) if summary else db.query(models.Item)
+    if item_filter is None:
+        return query.filter(models.Item.owner_id == user_id)
+
+    for field in ('is_active', 'is_bookmarked', 'is_silenced'):
+        value = getattr(item_filter, field)
+        if value is not None:
+            query = query.filter(getattr(models.Item, field) == value)
+    if item_filter.expiration_date_from is not None:
+        query = query.filter(models.Item.expiration_date >= item_filter.expiration_date_from)
+    if item_filter.expiration_date_to is not None:
+        query = query.filter(models.Item.expiration_date <= item_filter.expiration_date_to)
+    if item_filter.cost_min is not None:
+        query = query.filter(models.Item.cost >= item_filter.cost_min)
+    if item_filter.cost_max is not None:
+        query = query.filter(models.Item.cost <= item_filter.cost_max)
+
+    links = [(models.item_tags, models.item_tags.c.tag_id == tag_id) for tag_id in set(item_filter.tag_ids)] + \
+        [(models.item_locations, models.item_locations.c.location_id == location_id)
+            for location_id in set(item_filter.location_ids)]
+    driving_link = find_driving_link(db, links)
+
+    for index, (link_table, condition) in enumerate(links):
+        if index == driving_link:
+            query = query.filter(models.Item.id.in_(select(link_table.c.item_id).where(condition)))
+        else:
+            query = query.filter(exists().where(condition, link_table.c.item_id == models.Item.id))
+    if driving_link is None:
+        return query.filter(models.Item.owner_id == user_id)
+    # With an index on `owner_id` usable, SQLite reads all the items of the user in list order (and checks the
+    # IN for each one), as when there is no rare link: the items must be looked up by the IDs of the link table.
+    # `+ 0` makes the owner condition an expression, which no index covers, so it is only checked on these items.
+    # Both plans are tested (see `test_filters`).
+    return query.filter(models.Item.owner_id + 0 == user_id)
+
+def find_driving_link(db: Session, links: list):
+    """Find the (link table, condition) of a filter with the fewest items, if it has less than FILTER_DRIVING_LINKS.
+    The items are counted up to FILTER_DRIVING_LINKS, in a single statement, on the (tag_id/location_id, item_id)
+    indexes. Returns the index of the link, or None."""
+    if not links:
+        return None
+    link_counts = db.query(*[
+        select(func.count()).select_from(
+            select(link_table.c.item_id).where(condition).limit(FILTER_DRIVING_LINKS).subquery()).scalar_subquery()
+        for link_table, condition in links]).one()
+    if min(link_counts) >= FILTER_DRIVING_LINKS:
+        return None
+    return list(link_counts).index(min(link_counts))
+
+SUMMARY_BATCH_SIZE = 500
+
+def summarize_items(db: Session, rows: list):
+    """Turn the rows of a summary query (see `query_user_items`) into dicts, with the names of the tags
+    and of the locations of the items, read with a query on each link table per SUMMARY_BATCH_SIZE items."""
+    summaries = {row.id: {**row._asdict(), 'tags': [], 'locations': []} for row in rows}
+    item_ids = list(summaries)
+    for key, link_table, link_column, model in (
+            ('tags', models.item_tags, models.item_tags.c.tag_id, models.Tag),
+            ('locations', models.item_locations, models.item_locations.c.location_id, models.Location)):
+        for start in range(0, len(item_ids), SUMMARY_BATCH_SIZE):
+            for item_id, name in db.query(link_table.c.item_id, model.name).\
+                    join(model, model.id == link_column).\
+                    filter(link_table.c.item_id.in_(item_ids[start:start + SUMMARY_BATCH_SIZE])):
+                summaries[item_id][key].append({'name': name})
+    return list(summaries.values())
+
+def get_user_items(db: Session, user_id: int, skip: int = 0, limit: int = 10000, item_filter: schemas.ItemFilter = None,
+                   summary: bool = False):
+    """Get the items associated with a user, newest first.
     An offset and a limit can be given, to facilitate implementing paging by clients.
+    Only the items matching a filter are returned, if one is given.
+    With `summary`, the items are dicts without the description (see `summarize_items`), instead of ORM objects.
     If no items are found an empty list is returned.
     """
-    return db.query(models.Item).filter(models.Item.owner_id == user_id).offset(skip).limit(limit).all()
+    query = query_user_items(db, user_id, item_filter, summary=summary)
+    db_items = query.\
+        order_by(models.Item.addition_date.desc(), models.Item.id.desc()).\
+        offset(skip).limit(limit).all()
+    return summarize_items(db, db_items) if summary else db_items
+
+def get_user_items_page(db: Session, user_id: int, cursor: str = None, limit: int = 50,
+                        item_filter: schemas.ItemFilter = None, summary: bool = False):
+    """Get a page of the items associated with a user, newest first.
+    The page starts after the item the cursor points to (or at the newest item if no cursor is given).
+    Only the items matching a filter are returned, if one is given.
+    With `summary`, the items are dicts without the description (see `summarize_items`), instead of ORM objects.
+    Returns the items and the cursor of the next page, which is None when there are no more items.
+    """
+    query = query_user_items(db, user_id, item_filter, summary=summary)
+    if cursor:
+        query = query.filter(tuple_(models.Item.addition_date, models.Item.id) < decode_cursor(cursor))
+    db_items = query.\
+        order_by(models.Item.addition_date.desc(), models.Item.id.desc()).\
+        limit(limit + 1).all()
+
+    next_cursor = None
+    if len(db_items) > limit:
+        db_items = db_items[:limit]
+        next_cursor = encode_cursor(db_items[-1])
+    return (summarize_items(db, db_items) if summary else db_items), next_cursor
+
+# Searches with more matches are not ranked (see `search_user_items`)
+SEARCH_RANKED_MATCHES = 2000
+
+SEARCH_COLUMNS = {'n': '{name}', 't': '{tags}', 'l': '{locations}'}
+SEARCH_ALL_COLUMNS = '{name description code tags locations}'
+
+def build_search_query(q: str, user_id: int):
+    """Translate a search text into a full-text (FTS5) query on the items of a user, or None if the text has
+    nothing to search. The text has comma separated terms, all of which must match. A term prefixed by `n.`, `t.`
+    or `l.` (or `n:`, `t:`, `l:`) matches only the item name, its tag names or its location names, any other term
+    matches these, the description and the code as well. The last word of a term matches as a prefix.
+    The owner token of the user is matched first, so that only the entries of the user's items are read."""
+    expressions = []
+    for term in q.split(','):
+        term = term.strip()
+        columns = SEARCH_ALL_COLUMNS
+        if len(term) > 2 and term[0].lower() in SEARCH_COLUMNS and term[1] in '.:':
+            columns = SEARCH_COLUMNS[term[0].lower()]
+            term = term[2:]
+        # Only the words are kept, so the text cannot inject FTS5 syntax
+        words = re.findall(r'\w+', term)
+        if words:
+            phrase = ' '.join(words)
+            expressions.append(f'{columns} : "{phrase}" *')
+    if not expressions:
+        return None
+    return ' AND '.join([f'owner : "u{user_id}"'] + expressions)
+
+def search_user_items(db: Session, user_id: int, q: str, limit: int = 50):
+    """Search the items of a user, best matches first (see `build_search_query` for the search text).
+    Ranking computes the score of every match, so a search matching SEARCH_RANKED_MATCHES items or more
+    (e.g., a single letter) gives the newest matches first instead, after a bounded count of the matches."""
+    match = build_search_query(q, user_id)
+    if match is None:
+        return []
+
+    query = db.query(models.items_fts.c.rowid).filter(literal_column('items_fts').op('MATCH')(match))
+    match_count = db.query(func.count()).select_from(query.limit(SEARCH_RANKED_MATCHES).subquery()).scalar()
+    order = literal_column('rank') if match_count < SEARCH_RANKED_MATCHES else models.items_fts.c.rowid.desc()
+    item_ids = [item_id for item_id, in query.order_by(order).limit(limit)]
+
+    # The IDs are already filtered by owner: filtering the items by owner again would make SQLite scan
+    # all the items of the user
+    db_items = {db_item.id: db_item for db_item in db.query(models.Item).
+        filter(models.Item.id.in_(item_ids))}
+    return [db_items[item_id] for item_id in item_ids if item_id in db_items]
 
 def create_user_item(db: Session, item: schemas.ItemCreate, user_id: int):
     """Create an item in the DB associated with a user."""
 
     # Add normal fields
     item_fields = {}
-    for key, value in item.dict(exclude_unset=True).items():
-        if (key == 'photos'):
-            item_fields[key] = json.dumps(value)
-        elif not isinstance(value, list):
+    item_fields_set = item.dict(exclude_unset=True)
+    for key, value in item_fields_set.items():
+        if (key != 'photos') and not isinstance(value, list):
             item_fields[key] = value
+    revision = next_revision(db, user_id)
     db_item = models.Item(
         **item_fields,
         addition_date= datetime.date.today(),
         is_active=True,
-        owner_id=user_id
+        owner_id=user_id,
+        revision=revision
     )
 
-    # Add locations
-    if item.locations:
-        for location in item.locations:
-            db_location = get_or_create(db, models.Location, name=location.name, owner_id=user_id)
-            db_item.locations.append(db_location)
-    else:
-        db_item.locations = []
-
-    # Add tags
-    if item.tags:
-        for tag in item.tags:
-            db_tag = get_or_create(db, models.Tag, name=tag.name, owner_id=user_id)
-            db_item.tags.append(db_tag)
-    else:
-        db_item.tags = []
+    # Add locations and tags
+    db_item.locations = get_or_create_all(db, models.Location, user_id,
+        [location.name for location in item.locations or []], revision)
+    db_item.tags = get_or_create_all(db, models.Tag, user_id,
+        [tag.name for tag in item.tags or []], revision)
 
     db.add(db_item)
+    db.flush()
+
+    # Add photos (the item ID is needed to store the thumbnail)
+    if 'photos' in item_fields_set:
+        set_item_photos(db, db_item, item_fields_set['photos'])
+        update_photo_refs(db, user_id, [], get_photo_sources(db_item))
+
+    update_item_stats(db, {}, get_item_stats(db_item))
     db.commit()
-    db.refresh(db_item)
+    # No refresh: the tags and locations are loaded already, and would be lazily loaded again
     return db_item
 
 def update_user_item(db: Session, item_id: int, item: schemas.ItemUpdate, user_id: int):
@@ -133,39 +433,35 @@ def update_user_item(db: Session, item_id: int, item: schemas.ItemUpdate, user_i
     db_item = db.query(models.Item).filter(models.Item.owner_id == user_id).filter(models.Item.id == item_id).first()
     if not db_item:
         raise DbExceptionNotFound('Item not found')
-
-    # Remove deleted images
-    if (item.photos):
-        previous = json.loads(db_item.photos)
-        for source in previous['sources']:
-            if source not in item.photos.sources:
-                path_id = source.replace('-', '/')
-                file_path = f'./local/photos/{user_id}/{path_id}'
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-                    os.remove(f'{file_path}.full')
-                    os.remove(f'{file_path}.thumb')
+    previous_stats = get_item_stats(db_item)
 
     # Add normal fields
+    previous_sources = get_photo_sources(db_item)
     prepare_db_object(db, db_item, item)
 
-    # Update locations
-    if item.locations:
-        db_item.locations=[]
-        for location in item.locations:
-            db_location = get_or_create(db, models.Location, name=location.name, owner_id=user_id)
-            db_item.locations.append(db_location)
+    # Release the removed images (also when the photos are cleared with null or an empty object)
+    unreferenced = []
+    if 'photos' in item.__fields_set__:
+        unreferenced = update_photo_refs(db, user_id, previous_sources, get_photo_sources(db_item))
+
+    revision = next_revision(db, user_id)
 
-    # Update tags
+    # Update locations and tags
+    if item.locations:
+        db_item.locations = get_or_create_all(db, models.Location, user_id,
+            [location.name for location in item.locations], revision)
     if item.tags:
-        db_item.tags=[]
-        for tag in item.tags:
-            db_tag = get_or_create(db, models.Tag, name=tag.name, owner_id=user_id)
-            db_item.tags.append(db_tag)
+        db_item.tags = get_or_create_all(db, models.Tag, user_id,
+            [tag.name for tag in item.tags], revision)
+
+    db_item.revision = revision
 
     db.add(db_item)
+    db.flush()
+    update_item_stats(db, previous_stats, get_item_stats(db_item))
     db.commit()
-    db.refresh(db_item)
+    after_commit(db, photos.queue_deletion, user_id, unreferenced)
+    # No refresh: the tags and locations are loaded already, and would be lazily loaded again
     return db_item
 
 def delete_user_item(db: Session, item_id: int, user_id: int):
@@ -175,18 +471,127 @@ def delete_user_item(db: Session, item_id: int, user_id: int):
     if not db_item:
         raise DbExceptionNotFound('Item not found')
 
-    # Remove item images
-    photos = json.loads(db_item.photos)
-    for source in photos['sources']:
-        path_id = source.replace('-', '/')
-        file_path = f'./local/photos/{user_id}/{path_id}'
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-            os.remove(f'{file_path}.full')
-            os.remove(f'{file_path}.thumb')
+    # Release the item images
+    unreferenced = update_photo_refs(db, user_id, get_photo_sources(db_item), [])
+    photos_data = db_item.photos
+    thumbnail_ids = [photos_data['thumbnail_id']] if photos_data and photos_data.get('thumbnail_id') else []
 
+    update_item_stats(db, get_item_stats(db_item), {})
+    db.add(models.Tombstone(kind='item', object_id=db_item.id, revision=next_revision(db, user_id), owner_id=user_id))
     db.delete(db_item)
     db.commit()
+    after_commit(db, photos.queue_deletion, user_id, unreferenced, thumbnail_ids)
+
+BULK_FLAGS = {
+    'archive': {models.Item.is_active: False},
+    'restore': {models.Item.is_active: True},
+    'bookmark': {models.Item.is_bookmarked: True},
+    'unbookmark': {models.Item.is_bookmarked: False},
+}
+
+def get_bulk_changes(db: Session, bulk: schemas.ItemsBulk, user_id: int, item_ids: list):
+    """Find the items of a bulk operation that it changes, with the ID of its existing tag or location
+    (None if the user has none with its name). E.g., `remove_tag` only changes the items that have the tag,
+    `archive` the active ones and `move_location` the ones with another location than the given one."""
+    if bulk.operation == 'delete':
+        return item_ids, None
+    if bulk.operation in BULK_FLAGS:
+        (column, value), = BULK_FLAGS[bulk.operation].items()
+        changed_ids = {item_id for item_id, in db.query(models.Item.id).
+            filter(models.Item.id.in_(item_ids)).filter(column != value)}
+        return [item_id for item_id in item_ids if item_id in changed_ids], None
+
+    if bulk.operation in ('add_tag', 'remove_tag'):
+        model, name, link_table, link_column = models.Tag, bulk.tag.name, models.item_tags, models.item_tags.c.tag_id
+    else:
+        model, name, link_table, link_column = \
+            models.Location, bulk.location.name, models.item_locations, models.item_locations.c.location_id
+    object_id = db.query(model.id).filter(model.owner_id == user_id).filter(model.name == name).scalar()
+    links = {}
+    if object_id is not None:
+        for item_id, linked_id in db.query(link_table.c.item_id, link_column).\
+                filter(link_table.c.item_id.in_(item_ids)):
+            links.setdefault(item_id, set()).add(linked_id)
+
+    if bulk.operation == 'add_tag':
+        changed_ids = [item_id for item_id in item_ids if object_id not in links.get(item_id, ())]
+    elif bulk.operation == 'remove_tag':
+        changed_ids = [item_id for item_id in item_ids if object_id in links.get(item_id, ())]
+    else:
+        changed_ids = [item_id for item_id in item_ids if links.get(item_id) != {object_id}]
+    return changed_ids, object_id
+
+def bulk_update_user_items(db: Session, bulk: schemas.ItemsBulk, user_id: int):
+    """Apply an operation to several items of a user, with a few set-based statements in a single transaction.
+    The IDs that do not belong to items of the user are ignored, and so are the items that the operation
+    leaves unchanged (see `get_bulk_changes`): they keep their revision.
+    Returns the revision of the change and the sorted IDs of the changed items (with the current revision
+    if there are none).
+    If the operation lacks its tag or location, an exception is raised."""
+    if bulk.operation in ('add_tag', 'remove_tag') and not bulk.tag:
+        raise DbException('Tag missing.')
+    if bulk.operation == 'move_location' and not bulk.location:
+        raise DbException('Location missing.')
+
+    item_ids = sorted(item_id for item_id, in db.query(models.Item.id).
+        filter(models.Item.owner_id == user_id).
+        filter(models.Item.id.in_(set(bulk.ids))))
+    item_ids, object_id = get_bulk_changes(db, bulk, user_id, item_ids) if item_ids else ([], None)
+    if not item_ids:
+        return {'revision': get_user_revision(db, user_id), 'ids': []}
+
+    revision = next_revision(db, user_id)
+    query_items = db.query(models.Item).filter(models.Item.id.in_(item_ids))
+    previous_stats = aggregate_item_stats(db, models.Item.id.in_(item_ids))
+
+    if bulk.operation == 'delete':
+        bulk_delete_items(db, user_id, item_ids, revision)
+    else:
+        if bulk.operation in ('add_tag', 'move_location'):
+            if bulk.operation == 'add_tag':
+                link_table, link_column = models.item_tags, 'tag_id'
+                if object_id is None:
+                    object_id = get_or_create_all(db, models.Tag, user_id, [bulk.tag.name], revision)[0].id
+            else:
+                link_table, link_column = models.item_locations, 'location_id'
+                if object_id is None:
+                    object_id = get_or_create_all(db, models.Location, user_id, [bulk.location.name], revision)[0].id
+                db.execute(link_table.delete().
+                    where(link_table.c.item_id.in_(item_ids)).
+                    where(link_table.c.location_id != object_id))
+            db.execute(sqlite_insert(link_table).
+                values([{'item_id': item_id, link_column: object_id} for item_id in item_ids]).
+                on_conflict_do_nothing())
+        elif bulk.operation == 'remove_tag':
+            db.execute(models.item_tags.delete().
+                where(models.item_tags.c.item_id.in_(item_ids)).
+                where(models.item_tags.c.tag_id == object_id))
+
+        query_items.update({**BULK_FLAGS.get(bulk.operation, {}), models.Item.revision: revision},
+            synchronize_session=False)
+
+    update_item_stats(db, previous_stats, aggregate_item_stats(db, models.Item.id.in_(item_ids)))
+    db.commit()
+    return {'revision': revision, 'ids': item_ids}
+
+def bulk_delete_items(db: Session, user_id: int, item_ids: list, revision: int):
+    """Delete items of a user, together with their tags and locations links, and release their photos.
+    The photo files are removed after the commit."""
+    sources, thumbnail_ids = [], []
+    for item_photos, in db.query(models.Item.photos).filter(models.Item.id.in_(item_ids)):
+        sources += (item_photos or {}).get('sources') or []
+        if item_photos and item_photos.get('thumbnail_id'):
+            thumbnail_ids.append(item_photos['thumbnail_id'])
+    unreferenced = update_photo_refs(db, user_id, sources, [])
+
+    db.execute(models.Tombstone.__table__.insert(), [
+        {'kind': 'item', 'object_id': item_id, 'revision': revision, 'owner_id': user_id} for item_id in item_ids
+    ])
+    db.execute(models.item_tags.delete().where(models.item_tags.c.item_id.in_(item_ids)))
+    db.execute(models.item_locations.delete().where(models.item_locations.c.item_id.in_(item_ids)))
+    db.query(models.Item).filter(models.Item.id.in_(item_ids)).delete(synchronize_session=False)
+
+    after_commit(db, photos.queue_deletion, user_id, unreferenced, thumbnail_ids)
 
 #------------------------------------------ Tags
 
@@ -198,6 +603,7 @@ def get_user_tags(db: Session, user_id: int):
 
 def update_user_tag(db: Session, tag_id: int, tag: schemas.TagUpdate, user_id: int):
     """Update a tag in the DB associated with a specific user.
+    A renamed tag changes the revision of its items as well.
     If the tag is not found in the DB, an exception is raised."""
     db_tag = db.query(models.Tag).filter(models.Tag.owner_id == user_id).filter(models.Tag.id == tag_id).first()
     if not db_tag:
@@ -211,7 +617,11 @@ def update_user_tag(db: Session, tag_id: int, tag: schemas.TagUpdate, user_id: i
         if (conflicting_tag and conflicting_tag.id != tag_id):
             raise DbException('Tag name already exists.')
 
+    previous_name = db_tag.name
     prepare_db_object(db, db_tag, tag)
+    db_tag.revision = next_revision(db, user_id)
+    if db_tag.name != previous_name:
+        restamp_linked_items(db, models.item_tags.c.tag_id, tag_id, db_tag.revision)
 
     db.add(db_tag)
     db.commit()
@@ -228,6 +638,7 @@ def get_user_locations(db: Session, user_id: int):
 
 def update_user_location(db: Session, location_id: int, location: schemas.LocationUpdate, user_id: int):
     """Update a location in the DB associated with a specific user.
+    A renamed location changes the revision of its items as well.
     If the location is not found in the DB, an exception is raised."""
     db_location = db.query(models.Location).filter(models.Location.owner_id == user_id).filter(models.Location.id == location_id).first()
     if not db_location:
@@ -241,9 +652,128 @@ def update_user_location(db: Session, location_id: int, location: schemas.Locati
         if (conflicting_location and conflicting_location.id != location_id):
             raise DbException('Location name already exists.')
 
+    previous_name = db_location.name
     prepare_db_object(db, db_location, location)
+    db_location.revision = next_revision(db, user_id)
+    if db_location.name != previous_name:
+        restamp_linked_items(db, models.item_locations.c.location_id, location_id, db_location.revision)
 
     db.add(db_location)
     db.commit()
     db.refresh(db_location)
     return db_location
+
+#------------------------------------------ Stats
+
+def aggregate_item_stats(db: Session, condition):
+    """Count the items matching a condition and sum their cost, by owner and by status, tag and location.
+    Returns {(owner_id, kind, object_id): (count, cost)}, with the keys of the `item_stats` table.
+    Used by the writes of several items; the writes of a single item use `get_item_stats`."""
+    status = case((models.Item.is_active, 'active'), else_='archived')
+    queries = [
+        db.query(models.Item.owner_id, status, literal(0)).
+            group_by(models.Item.owner_id, status),
+        db.query(models.Item.owner_id, literal('tag'), models.item_tags.c.tag_id).
+            join(models.item_tags, models.item_tags.c.item_id == models.Item.id).
+            group_by(models.Item.owner_id, models.item_tags.c.tag_id),
+        db.query(models.Item.owner_id, literal('location'), models.item_locations.c.location_id).
+            join(models.item_locations, models.item_locations.c.item_id == models.Item.id).
+            group_by(models.Item.owner_id, models.item_locations.c.location_id),
+    ]
+    stats = {}
+    for query in queries:
+        for owner_id, kind, object_id, count, cost in query.\
+                add_columns(func.count(), func.sum(models.Item.cost)).filter(condition):
+            stats[(owner_id, kind, object_id)] = (count, cost)
+    return stats
+
+def get_item_stats(db_item: models.Item):
+    """Get the stats of a single item, like `aggregate_item_stats`, from its loaded attributes instead of
+    with queries: the item counts once, with its cost, for its status and for each of its tags and locations."""
+    entry = (1, db_item.cost or 0)
+    stats = {(db_item.owner_id, 'active' if db_item.is_active else 'archived', 0): entry}
+    for kind, linked_objects in (('tag', db_item.tags), ('location', db_item.locations)):
+        for db_object in linked_objects:
+            stats[(db_item.owner_id, kind, db_object.id)] = entry
+    return stats
+
+def update_item_stats(db: Session, previous_stats: dict, stats: dict):
+    """Update the stats of the items, given the stats of the changed items before and after the change
+    (see `aggregate_item_stats`). Only the differences are written, with a single upsert. Nothing is committed."""
+    deltas = []
+    for key in set(previous_stats) | set(stats):
+        count, cost = stats.get(key, (0, 0))
+        previous_count, previous_cost = previous_stats.get(key, (0, 0))
+        if (count, cost) != (previous_count, previous_cost):
+            owner_id, kind, object_id = key
+            deltas.append({'owner_id': owner_id, 'kind': kind, 'object_id': object_id,
+                           'count': count - previous_count, 'cost': cost - previous_cost})
+    if not deltas:
+        return
+
+    insert = sqlite_insert(models.ItemStats.__table__).values(deltas)
+    db.execute(insert.on_conflict_do_update(
+        index_elements=['owner_id', 'kind', 'object_id'],
+        set_={'count': models.ItemStats.count + insert.excluded['count'],
+              'cost': models.ItemStats.cost + insert.excluded['cost']}))
+
+def rebuild_item_stats(db: Session, user_id: int = None):
+    """Compute again the stats of the items of a user (of all the users if none is given) from the items,
+    e.g., after the DB was changed by hand."""
+    query_stats = db.query(models.ItemStats)
+    condition = true()
+    if user_id is not None:
+        query_stats = query_stats.filter(models.ItemStats.owner_id == user_id)
+        condition = models.Item.owner_id == user_id
+    query_stats.delete(synchronize_session=False)
+    update_item_stats(db, {}, aggregate_item_stats(db, condition))
+    db.commit()
+
+def get_user_stats(db: Session, user_id: int):
+    """Get the number and the total cost of the items of a user: active, archived, by tag and by location
+    (highest cost first). The stats are read from the `item_stats` table, not computed from the items."""
+    names = {}
+    for kind, model in (('tag', models.Tag), ('location', models.Location)):
+        for object_id, name in db.query(model.id, model.name).filter(model.owner_id == user_id):
+            names[(kind, object_id)] = name
+
+    stats = {'active_count': 0, 'active_cost': 0, 'archived_count': 0, 'archived_cost': 0, 'tags': [], 'locations': []}
+    for db_stats in db.query(models.ItemStats).\
+            filter(models.ItemStats.owner_id == user_id).\
+            filter(models.ItemStats.count > 0):
+        if db_stats.kind in ('active', 'archived'):
+            stats[f'{db_stats.kind}_count'] = db_stats.count
+            stats[f'{db_stats.kind}_cost'] = db_stats.cost
+        elif (db_stats.kind, db_stats.object_id) in names:
+            stats[f'{db_stats.kind}s'].append({'id': db_stats.object_id, 'name': names[(db_stats.kind, db_stats.object_id)],
+                                               'count': db_stats.count, 'cost': db_stats.cost})
+    for kind in ('tags', 'locations'):
+        stats[kind].sort(key=lambda entry: (-entry['cost'], -entry['count'], entry['name']))
+    return stats
+
+#------------------------------------------ Changes
+
+def get_user_changes(db: Session, user_id: int, since: int = 0):
+    """Get the items, tags and locations of a user that changed after a given revision.
+    Returns the current revision of the user, the created or updated objects, and the IDs of the deleted ones.
+    Passing the returned revision as `since` in a next call gives only the changes made in between.
+    """
+    revision = get_user_revision(db, user_id)
+
+    def changed(model):
+        return db.query(model).\
+            filter(model.owner_id == user_id).\
+            filter(model.revision > since).\
+            filter(model.revision <= revision).all()
+
+    deleted = {'items': [], 'tags': [], 'locations': []}
+    for tombstone in changed(models.Tombstone):
+        deleted[f'{tombstone.kind}s'].append(tombstone.object_id)
+
+    return {
+        'revision': revision,
+        'items': changed(models.Item),
+        'tags': changed(models.Tag),
+        'locations': changed(models.Location),
+        'deleted': deleted,
+    }
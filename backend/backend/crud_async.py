@@ -0,0 +1,90 @@
+"""Asynchronous versions of the `crud` functions.
+
+Each function runs its `crud` counterpart, so the queries are the same, but the DB I/O
+is awaited instead of blocking a thread. Reads run through `AsyncSession.run_sync` on
+a (read-only) session, writes are queued on the writer of the process.
+The returned objects are detached from any lazy loading: everything a caller
+serializes has to be loaded by the function itself.
+"""
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, schemas, security
+from .crud import DbException, DbExceptionNotFound
+from .database import writer
+
+#------------------------------------------ Users
+
+async def get_user(db: AsyncSession, user_id: int):
+    """Get a specific user in the DB, with its tags and locations."""
+    return await db.run_sync(crud.get_user, user_id)
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    return await db.run_sync(crud.get_user_by_email, email)
+
+async def get_user_revision(db: AsyncSession, user_id: int):
+    return await db.run_sync(crud.get_user_revision, user_id)
+
+async def create_user(user: schemas.UserCreate):
+    """Create a new user in the DB, with its tags and locations.
+    The password is hashed on the password pool, not to block the event loop."""
+    hashed_password = await security.run_password_task(security.get_password_hash, user.password)
+    return await writer.run(crud.create_user, user, hashed_password=hashed_password)
+
+#------------------------------------------ Items
+
+async def get_user_item(db: AsyncSession, user_id: int, item_id: int):
+    return await db.run_sync(crud.get_user_item, user_id, item_id)
+
+async def get_user_item_revision(db: AsyncSession, user_id: int, item_id: int):
+    return await db.run_sync(crud.get_user_item_revision, user_id, item_id)
+
+async def get_user_items(db: AsyncSession, user_id: int, skip: int = 0, limit: int = 10000,
+                         item_filter: schemas.ItemFilter = None, summary: bool = False):
+    return await db.run_sync(crud.get_user_items, user_id, skip=skip, limit=limit, item_filter=item_filter,
+                             summary=summary)
+
+async def get_user_items_page(db: AsyncSession, user_id: int, cursor: str = None, limit: int = 50,
+                              item_filter: schemas.ItemFilter = None, summary: bool = False):
+    return await db.run_sync(crud.get_user_items_page, user_id, cursor=cursor, limit=limit, item_filter=item_filter,
+                             summary=summary)
+
+async def search_user_items(db: AsyncSession, user_id: int, q: str, limit: int = 50):
+    return await db.run_sync(crud.search_user_items, user_id, q, limit=limit)
+
+async def create_user_item(item: schemas.ItemCreate, user_id: int):
+    return await writer.run(crud.create_user_item, item, user_id)
+
+async def update_user_item(item_id: int, item: schemas.ItemUpdate, user_id: int):
+    return await writer.run(crud.update_user_item, item_id, item, user_id)
+
+async def delete_user_item(item_id: int, user_id: int):
+    return await writer.run(crud.delete_user_item, item_id, user_id)
+
+async def bulk_update_user_items(bulk: schemas.ItemsBulk, user_id: int):
+    return await writer.run(crud.bulk_update_user_items, bulk, user_id)
+
+#------------------------------------------ Tags
+
+async def get_user_tags(db: AsyncSession, user_id: int):
+    return await db.run_sync(crud.get_user_tags, user_id)
+
+async def update_user_tag(tag_id: int, tag: schemas.TagUpdate, user_id: int):
+    return await writer.run(crud.update_user_tag, tag_id, tag, user_id)
+
+#------------------------------------------ Locations
+
+async def get_user_locations(db: AsyncSession, user_id: int):
+    return await db.run_sync(crud.get_user_locations, user_id)
+
+async def update_user_location(location_id: int, location: schemas.LocationUpdate, user_id: int):
+    return await writer.run(crud.update_user_location, location_id, location, user_id)
+
+#------------------------------------------ Stats
+
+async def get_user_stats(db: AsyncSession, user_id: int):
+    return await db.run_sync(crud.get_user_stats, user_id)
+
+#------------------------------------------ Changes
+
+async def get_user_changes(db: AsyncSession, user_id: int, since: int = 0):
+    return await db.run_sync(crud.get_user_changes, user_id, since=since)
@@ -1,12 +1,24 @@
-from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from . import metrics, storage
+
 SQLALCHEMY_DATABASE_URL = "sqlite:///./local/backend.db"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./local/backend.db"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# Synchronous access, used by the scripts and Alembic
+engine = metrics.instrument_engine(storage.create_sync_engine(SQLALCHEMY_DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+# Asynchronous access, used by the API: reads use a pool of read-only connections,
+# writes are queued on the writer of the process.
+# Objects are not expired on commit, since they cannot be lazily reloaded outside of the session calls.
+async_engine = metrics.instrument_engine(storage.create_read_engine(ASYNC_SQLALCHEMY_DATABASE_URL))
+AsyncSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession
+)
+write_engine = metrics.instrument_engine(storage.create_write_engine(ASYNC_SQLALCHEMY_DATABASE_URL))
+writer = storage.Writer(write_engine)
+
+Base = declarative_base()
@@ -1,24 +1,22 @@
 import uvicorn
 
-from datetime import date
-
-from fastapi import Depends, FastAPI, HTTPException, status, UploadFile, Response
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, status, UploadFile, Response
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
-import json
+from email.utils import formatdate, parsedate_to_datetime
+import datetime
+import hashlib
 import os
 import os.path
-from PIL import Image, ImageOps
-from sqlalchemy.orm import Session
-from time import time
-from typing import List
+import time
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.routing import Match
+from typing import List, Union
 
-from backend import crud, models, schemas, security
-from backend.database import SessionLocal, engine
+from backend import compression, crud, crud_async, metrics, models, photos, schemas, security, static
+from backend.database import AsyncSessionLocal, async_engine, write_engine, writer
 
 #models.Base.metadata.create_all(bind=engine)
 
@@ -40,18 +38,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-api = FastAPI(title="api")
+api = FastAPI(title="api", default_response_class=ORJSONResponse)
 
 # Database dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+#---------------------------------------------------- Conditional requests
+
+def check_etag(request: Request, response: Response, etag: str):
+    """Set the ETag of a response and compare it with the If-None-Match header of the request.
+    Returns a 304 response if the client copy is still valid, or None if the body has to be sent.
+    The ETag is weak, as the body may be sent compressed (see `compress_response`): the 304 responses and
+    the compressed and uncompressed bodies have the same validator.
+    """
+    response.headers['ETag'] = f'W/{etag}'
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=response.headers)
+    return None
+
+def etag_matches(request: Request, etag: str):
+    """Check whether the If-None-Match header of a request matches an ETag."""
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    client_etags = [client_etag.strip().replace('W/', '', 1) for client_etag in if_none_match.split(',')]
+    return etag in client_etags or '*' in client_etags
 
 #---------------------------------------------------- Login
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    current_user = security.user_cache.get(token)
+    if current_user is not None:
+        return current_user
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -65,10 +88,13 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         token_data = schemas.TokenData(email=email)
     except security.SecurityException:
         raise credentials_exception
-    user_db = crud.get_user_by_email(db, email=token_data.email)
+    user_db = await crud_async.get_user_by_email(db, email=token_data.email)
     if user_db is None:
         raise credentials_exception
-    return user_db
+
+    current_user = schemas.CurrentUser.from_orm(user_db)
+    security.user_cache.set(token, current_user, expires=payload.get("exp"))
+    return current_user
 
 
 async def get_current_active_user(current_user: schemas.User = Depends(get_current_user)):
@@ -77,11 +103,12 @@ async def get_current_active_user(current_user: schemas.User = Depends(get_curre
     return current_user
 
 @api.post("/token", response_model=schemas.Token)
+@metrics.query_budget(1)
 async def login_for_access_token(
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
         form_data: OAuth2PasswordRequestForm = Depends()):
-    user_db = crud.get_user_by_email(db, form_data.username)
-    user_db = security.authenticate_user(user_db, form_data.password)
+    user_db = await crud_async.get_user_by_email(db, form_data.username)
+    user_db = await security.run_password_task(security.authenticate_user, user_db, form_data.password)
     if not user_db:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -94,221 +121,566 @@ async def login_for_access_token(
 #---------------------------------------------------- Users
 
 @api.post("/users/", response_model=schemas.User)
-def create_user(
+@metrics.query_budget(3)
+async def create_user(
         user: schemas.UserCreate,
-        db: Session = Depends(get_db)):
+        db: AsyncSession = Depends(get_db)):
     """Create an user"""
-    db_user = crud.get_user_by_email(db, email=user.email)
+    db_user = await crud_async.get_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=422, detail="User already registered.")
-    new_user_db = crud.create_user(db=db, user=user)
+    new_user_db = await crud_async.create_user(user=user)
     return new_user_db
 
 
 @api.get("/users/me", response_model=schemas.User)
-def read_user(current_user_db: schemas.User = Depends(get_current_active_user)):
+@metrics.query_budget(3)
+async def read_user(
+        db: AsyncSession = Depends(get_db),
+        current_user_db: schemas.User = Depends(get_current_active_user)):
     """Get the information associated with the current user."""
 
-    if current_user_db is None:
+    user_db = await crud_async.get_user(db, current_user_db.id)
+    if user_db is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return current_user_db
+    return user_db
 
 #---------------------------------------------------- Items
 
+def get_item_filter(
+        is_active: Union[bool, None] = None,
+        is_bookmarked: Union[bool, None] = None,
+        is_silenced: Union[bool, None] = None,
+        tag_ids: List[int] = Query(default=[]),
+        location_ids: List[int] = Query(default=[]),
+        expiration_date_from: Union[datetime.date, None] = None,
+        expiration_date_to: Union[datetime.date, None] = None,
+        cost_min: Union[int, None] = None,
+        cost_max: Union[int, None] = None):
+    """Item filter dependency: the items must have all the tags and locations (e.g., `?tag_ids=1&tag_ids=2`),
+    the date and cost ranges are inclusive."""
+    return schemas.ItemFilter(
+        is_active=is_active, is_bookmarked=is_bookmarked, is_silenced=is_silenced,
+        tag_ids=tag_ids, location_ids=location_ids,
+        expiration_date_from=expiration_date_from, expiration_date_to=expiration_date_to,
+        cost_min=cost_min, cost_max=cost_max)
+
+def get_filter_key(item_filter: schemas.ItemFilter):
+    """A short key of a filter, for the ETags of the filtered lists."""
+    filter_json = item_filter.json(exclude_defaults=True)
+    return hashlib.sha1(filter_json.encode()).hexdigest()[:16] if filter_json != '{}' else 'all'
+
+ITEM_PHOTOS = {'thumbnail': None, 'thumbnail_id': None, 'selected': None, 'sources': None}
+
 def create_serializable_item(item_db):
-    serializable_item = jsonable_encoder(item_db)
-    if ('photos' in serializable_item):
-        serializable_item['photos'] = json.loads(serializable_item['photos'])
-    return serializable_item
+    """Convert an ORM item to the data of `schemas.Item`, in one pass over its loaded attributes.
+    The ORM data is trusted, so it is not validated again by pydantic (see `create_fast_response`)."""
+    return {
+        'name': item_db.name,
+        'description': item_db.description,
+        'quantity': item_db.quantity,
+        'cost': item_db.cost,
+        'expiration_date': item_db.expiration_date,
+        'code': item_db.code,
+        'photos': {**ITEM_PHOTOS, **item_db.photos} if item_db.photos is not None else None,
+        'locations': [{'name': location_db.name} for location_db in item_db.locations],
+        'tags': [{'name': tag_db.name} for tag_db in item_db.tags],
+        'is_active': item_db.is_active,
+        'is_bookmarked': item_db.is_bookmarked,
+        'is_silenced': item_db.is_silenced,
+        'id': item_db.id,
+        'addition_date': item_db.addition_date,
+        'removal_date': item_db.removal_date,
+    }
+
+def create_serializable_summary(item_summary: dict):
+    """Complete an item of a summary list (see `crud.summarize_items`) to the data of `schemas.Item`,
+    without the description."""
+    item_photos = item_summary['photos']
+    return {**item_summary, 'photos': {**ITEM_PHOTOS, **item_photos} if item_photos is not None else None}
+
+def create_fast_response(content, response: Response = None):
+    """Send data that already has the shape of the response model (e.g., from `create_serializable_item`),
+    encoded by orjson, without the validation and the encoding of FastAPI.
+    The headers set on the `Response` parameter of the endpoint (e.g., the ETag) are kept."""
+    return ORJSONResponse(content=content, headers=response.headers if response is not None else None)
 
 @api.post("/users/me/items/", response_model=schemas.Item)
-def create_user_item(
+@metrics.query_budget(13)
+async def create_user_item(
         item: schemas.ItemCreate,
-        db: Session = Depends(get_db),
         current_user_db: schemas.User = Depends(get_current_active_user)):
     """Create an item for the current user."""
 
     current_user_id = current_user_db.id
 
-    item_db = crud.create_user_item(db=db, item=item, user_id=current_user_id)
+    try:
+        item_db = await crud_async.create_user_item(item=item, user_id=current_user_id)
+    except photos.PhotoException:
+        raise HTTPException(status_code=422, detail="Invalid thumbnail")
+
     item_serializable = create_serializable_item(item_db)
-    return item_serializable
+    return create_fast_response(item_serializable)
 
 
 @api.get("/users/me/items/", response_model=List[schemas.Item])
-def get_user_items(
+@metrics.query_budget(6)
+async def get_user_items(
+        request: Request,
+        response: Response,
         skip: int = 0,
         limit: int = 10000,
-        db: Session = Depends(get_db),
+        summary: bool = False,
+        item_filter: schemas.ItemFilter = Depends(get_item_filter),
+        db: AsyncSession = Depends(get_db),
+        current_user_db: schemas.User = Depends(get_current_active_user)):
+    """Get the items associated with the current user, optionally filtered (see the query parameters).
+    With `summary`, the items come without their description, which is faster for long lists."""
+
+    current_user_id = current_user_db.id
+
+    revision = await crud_async.get_user_revision(db, current_user_id)
+    filter_key = get_filter_key(item_filter)
+    etag = f'"items-{current_user_id}-{revision}-{skip}-{limit}-{filter_key}-{int(summary)}"'
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
+
+    items_db = await crud_async.get_user_items(db, current_user_id, skip=skip, limit=limit, item_filter=item_filter,
+                                               summary=summary)
+    if summary:
+        items_serializable = [create_serializable_summary(item_summary) for item_summary in items_db]
+    else:
+        items_serializable = [create_serializable_item(item_db) for item_db in items_db]
+    return create_fast_response(items_serializable, response)
+
+
+@api.get("/users/me/items/page", response_model=schemas.ItemPage, responses={422: {"description": "Invalid cursor"}})
+@metrics.query_budget(5)
+async def get_user_items_page(
+        request: Request,
+        response: Response,
+        cursor: Union[str, None] = None,
+        limit: int = Query(default=50, ge=1, le=1000),
+        summary: bool = False,
+        item_filter: schemas.ItemFilter = Depends(get_item_filter),
+        db: AsyncSession = Depends(get_db),
+        current_user_db: schemas.User = Depends(get_current_active_user)):
+    """Get a page of the items associated with the current user, newest first, optionally filtered.
+    The `next_cursor` of a page is passed as `cursor` (with the same filter) to get the following page.
+    With `summary`, the items come without their description."""
+
+    current_user_id = current_user_db.id
+
+    try:
+        addition_date, item_id = crud.decode_cursor(cursor) if cursor else ('', '')
+        revision = await crud_async.get_user_revision(db, current_user_id)
+        filter_key = get_filter_key(item_filter)
+        etag = f'"items-{current_user_id}-{revision}-{addition_date}-{item_id}-{limit}-{filter_key}-{int(summary)}"'
+        not_modified = check_etag(request, response, etag)
+        if not_modified:
+            return not_modified
+
+        items_db, next_cursor = await crud_async.get_user_items_page(db, current_user_id, cursor=cursor, limit=limit,
+                                                                     item_filter=item_filter, summary=summary)
+    except crud.DbException:
+        raise HTTPException(status_code=422, detail="Invalid cursor")
+
+    if summary:
+        items_serializable = [create_serializable_summary(item_summary) for item_summary in items_db]
+    else:
+        items_serializable = [create_serializable_item(item_db) for item_db in items_db]
+    return create_fast_response({"items": items_serializable, "next_cursor": next_cursor}, response)
+
+
+@api.get("/users/me/items/search", response_model=List[schemas.Item])
+@metrics.query_budget(5)
+async def search_user_items(
+        q: str,
+        limit: int = Query(default=50, ge=1, le=200),
+        db: AsyncSession = Depends(get_db),
         current_user_db: schemas.User = Depends(get_current_active_user)):
-    """Get the items associated with the current user."""
+    """Search the items associated with the current user, best matches first.
+    `q` has comma separated terms, all of which must match; a term prefixed by `n.`, `t.` or `l.`
+    (or `n:`, `t:`, `l:`) matches only the item names, tags or locations (e.g., `t.tools, l:garage, drill`).
+    The last word of a term matches as a prefix."""
 
     current_user_id = current_user_db.id
 
-    items_db = crud.get_user_items(db, current_user_id, skip=skip, limit=limit)
+    items_db = await crud_async.search_user_items(db, current_user_id, q, limit=limit)
     items_serializable = [create_serializable_item(item_db) for item_db in items_db]
-    items_serializable = sorted(items_serializable, key= lambda x: x['addition_date'], reverse=True)
-    return items_serializable
+    return create_fast_response(items_serializable)
+
+
+@api.post("/users/me/items/bulk", response_model=schemas.ItemsBulkResult, responses={422: {"description": "Tag or location missing"}})
+@metrics.query_budget(17)
+async def bulk_update_user_items(
+        bulk: schemas.ItemsBulk,
+        current_user_db: schemas.User = Depends(get_current_active_user)):
+    """Apply an operation (e.g., archive, delete or add a tag) to several items associated with the current user.
+    Returns the IDs of the changed items; the IDs of unknown items are ignored."""
+
+    current_user_id = current_user_db.id
+
+    try:
+        result = await crud_async.bulk_update_user_items(bulk=bulk, user_id=current_user_id)
+    except crud.DbException:
+        raise HTTPException(status_code=422, detail="Tag or location missing")
+
+    return result
 
 
 @api.get("/users/me/items/{item_id}", response_model=schemas.Item, responses={404: {"description": "Item not found"}})
-def get_user_item(
+@metrics.query_budget(4)
+async def get_user_item(
         item_id: int,
-        db: Session = Depends(get_db),
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(get_db),
         current_user_db: schemas.User = Depends(get_current_active_user)):
     """Get detailed information about a specific item associated with the current user."""
 
     current_user_id = current_user_db.id
 
     try:
-        item_db = crud.get_user_item(db, current_user_id, item_id)
+        item_revision = await crud_async.get_user_item_revision(db, current_user_id, item_id)
+        etag = f'"item-{item_id}-{item_revision}"'
+        not_modified = check_etag(request, response, etag)
+        if not_modified:
+            return not_modified
+
+        item_db = await crud_async.get_user_item(db, current_user_id, item_id)
         item_serializable = create_serializable_item(item_db)
     except crud.DbExceptionNotFound:
         raise HTTPException(status_code=404, detail="Item not found")
 
-    return item_serializable
+    return create_fast_response(item_serializable, response)
 
 @api.post("/users/me/items/{item_id}", response_model=schemas.Item, responses={404: {"description": "Item not found"}})
-def update_user_item(
+@metrics.query_budget(16)
+async def update_user_item(
         item_id: int,
         item: schemas.ItemUpdate,
-        db: Session = Depends(get_db),
         current_user_db: schemas.User = Depends(get_current_active_user)):
     """Update the information of a specific item associated with the current user."""
 
     current_user_id = current_user_db.id
 
     try:
-        item_db = crud.update_user_item(db=db, item_id=item_id, item=item, user_id=current_user_id)
+        item_db = await crud_async.update_user_item(item_id=item_id, item=item, user_id=current_user_id)
         item_serializable = create_serializable_item(item_db)
     except crud.DbExceptionNotFound:
         raise HTTPException(status_code=404, detail="Item not found")
+    except photos.PhotoException:
+        raise HTTPException(status_code=422, detail="Invalid thumbnail")
 
-    return item_serializable
+    return create_fast_response(item_serializable)
 
 @api.delete("/users/me/items/{item_id}", status_code=status.HTTP_204_NO_CONTENT, responses={404: {"description": "Item not found"}})
-def delete_user_item(
+@metrics.query_budget(12)
+async def delete_user_item(
         item_id: int,
-        db: Session = Depends(get_db),
         current_user_db: schemas.User = Depends(get_current_active_user)):
     """Delete a specific item associated with the current user."""
 
     current_user_id = current_user_db.id
 
     try:
-        crud.delete_user_item(db=db, item_id=item_id, user_id=current_user_id)
+        await crud_async.delete_user_item(item_id=item_id, user_id=current_user_id)
     except crud.DbExceptionNotFound:
         raise HTTPException(status_code=404, detail="Item not found")
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 @api.post("/items/", status_code=201)
+@metrics.query_budget(0)
 async def create_item(name: str):
     return {"name": name}
 
 #---------------------------------------------------- Images
 
+def parse_range(range_header: str, size: int):
+    """Get the (start, end) bytes of a single range request, with `end` included.
+    Returns None for the ranges that are not supported (these get the full file),
+    and raises a ValueError for the ranges that cannot be satisfied."""
+    if not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    start, _, end = range_header[len('bytes='):].strip().partition('-')
+    if not start.isdigit() and not end.isdigit():
+        return None
+    if not start:
+        # Suffix range: the last `end` bytes
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end.isdigit() else size - 1
+    if start > end or start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+def parse_http_date(value: Union[str, None]):
+    """Get the date in an HTTP header, or None if it is missing or malformed."""
+    try:
+        return parsedate_to_datetime(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+def image_response(request: Request, file_path: str, etag: str):
+    """Serve a photo file. Photo files never change once written, so they are cached indefinitely,
+    revalidated with their ETag or modification date, and can be requested by byte ranges.
+    The bytes are sent by the reverse proxy instead of the worker when IMAGE_SENDFILE is set."""
+    stat_result = os.stat(file_path)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(stat_result.st_mtime, usegmt=True),
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Accept-Ranges': 'bytes',
+    }
+
+    if 'if-none-match' in request.headers:
+        not_modified = etag_matches(request, etag)
+    else:
+        if_modified_since = parse_http_date(request.headers.get('if-modified-since'))
+        not_modified = if_modified_since is not None and int(stat_result.st_mtime) <= if_modified_since.timestamp()
+    if not_modified:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    sendfile_header = photos.get_sendfile_header(file_path)
+    if sendfile_header:
+        # The proxy handles the ranges itself
+        headers[sendfile_header[0]] = sendfile_header[1]
+        return Response(media_type='image/jpeg', headers=headers)
+
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, stat_result.st_size)
+        except ValueError:
+            return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={'Content-Range': f'bytes */{stat_result.st_size}'})
+        if byte_range:
+            start, end = byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{stat_result.st_size}'
+            headers['Content-Length'] = str(end - start + 1)
+            return StreamingResponse(photos.read_file_range(file_path, start, end - start + 1),
+                status_code=status.HTTP_206_PARTIAL_CONTENT, media_type='image/jpeg', headers=headers)
+
+    return FileResponse(file_path, media_type='image/jpeg', headers=headers, stat_result=stat_result, method=request.method)
+
 @api.get("/users/me/items/{item_id}/image/{image_id}", response_class=FileResponse, responses={404: {"description": "Item not found"}})
-def get_user_item_image(
+@metrics.query_budget(0)
+async def get_user_item_image(
         item_id: int,
         image_id: str,
-        db: Session = Depends(get_db),
+        request: Request,
         current_user_db: schemas.User = Depends(get_current_active_user)):
-    """Get a specific image for an item associated with the current user."""
+    """Get a specific image for an item associated with the current user.
+    If the image was just uploaded, the response waits for its variants to be created."""
 
     current_user_id = current_user_db.id
 
-    path_id = image_id.replace('-','/')
-    file_path = f'./local/photos/{current_user_id}/{path_id}'
-    if os.path.isfile(file_path):
-        return file_path
-    else:
+    try:
+        file_path = photos.get_image_path(current_user_id, image_id)
+    except photos.PhotoException:
         raise HTTPException(status_code=404, detail="Item not found")
 
-@api.post("/users/me/items/{item_id}/image", responses={404: {"description": "Item not found"}})
-def upload_user_image(
+    try:
+        return image_response(request, file_path, f'"{image_id}"')
+    except FileNotFoundError:
+        pass
+
+    with metrics.measure_image():
+        await photos.wait_for_image(file_path)
+    try:
+        return image_response(request, file_path, f'"{image_id}"')
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Item not found")
+
+@api.get("/users/me/items/{item_id}/image/{image_id}/status", response_model=schemas.ImageStatus, responses={404: {"description": "Item not found"}})
+@metrics.query_budget(0)
+def get_user_item_image_status(
         item_id: int,
-        mode: str,
-        file: UploadFile,
-        db: Session = Depends(get_db),
+        image_id: str,
         current_user_db: schemas.User = Depends(get_current_active_user)):
-    """Upload an image file for an item associated with the current user"""
+    """Get which variants of an image uploaded for an item associated with the current user are ready,
+    or whether they could not be created."""
 
     current_user_id = current_user_db.id
 
-    d = date.today()
-    t = int(time())
+    try:
+        file_path = photos.get_image_path(current_user_id, image_id)
+    except photos.PhotoException:
+        raise HTTPException(status_code=404, detail="Item not found")
 
-    image_dir = f'./local/photos/{current_user_id}/{d.year}/{d.month}'
-    os.makedirs(image_dir, exist_ok=True)
+    variants = photos.get_image_status(file_path)
+    failed = photos.is_image_failed(file_path)
+    if not photos.is_image_pending(file_path) and not any(variants.values()) and not failed:
+        raise HTTPException(status_code=404, detail="Item not found")
 
-    image_file =f'{image_dir}/{t}.jpeg'
-    image_file_full = f'{image_file}.full'
-    image_file_thumb = f'{image_file}.thumb'
-    image_id = f'{d.year}-{d.month}-{t}.jpeg'
+    return {"filename": image_id, "variants": variants, "failed": failed}
 
-    with open(image_file_full, "wb") as image:
-        image.write(file.file.read())
+@api.get("/users/me/items/{item_id}/thumbnail/{thumbnail_id}", response_class=FileResponse, responses={404: {"description": "Thumbnail not found"}})
+@metrics.query_budget(0)
+def get_user_item_thumbnail(
+        item_id: int,
+        thumbnail_id: str,
+        request: Request,
+        current_user_db: schemas.User = Depends(get_current_active_user)):
+    """Get the thumbnail of an item associated with the current user.
+    A thumbnail ID changes whenever the thumbnail changes, so the response can be cached indefinitely."""
 
-    SD_WIDTH = 640
-    NORMAL_WIDTH = 320
-    THUMB_SIZE = 80
+    current_user_id = current_user_db.id
 
-    img = Image.open(image_file_full)
-    img = ImageOps.exif_transpose(img)
-    (width, height) = img.size
+    try:
+        file_path = photos.get_thumbnail_path(current_user_id, thumbnail_id)
+    except photos.PhotoException:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
 
-    if (mode == 'sd'):
-        ratio_full = SD_WIDTH / width
-        img_full = img.resize(
-            (int(width * ratio_full), int(height * ratio_full)),
-            Image.Resampling.LANCZOS
-        )
-    else:
-        img_full = img
-    img_full.save(image_file_full, 'JPEG', quality='web_high')
+    if not thumbnail_id.startswith(f'{item_id}-'):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
 
-    ratio_normal = NORMAL_WIDTH / width
-    img_normal = img.resize(
-        (int(width * ratio_normal), int(height*ratio_normal)),
-        Image.Resampling.LANCZOS
-    )
-    img_normal.save(image_file, 'JPEG', quality='web_high')
+    try:
+        return image_response(request, file_path, f'"{thumbnail_id}"')
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+
+@api.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Reject image uploads declared larger than the maximum size before their body is read."""
+    if request.method == 'POST' and request.url.path.endswith('/image'):
+        content_length = request.headers.get('content-length', '')
+        # Allow for the multipart envelope around the image data
+        if content_length.isdigit() and int(content_length) > photos.MAX_UPLOAD_SIZE + 64 * 1024:
+            return JSONResponse(status_code=413, content={"detail": "Image too large"})
+    return await call_next(request)
+
+@api.middleware("http")
+async def compress_response(request: Request, call_next):
+    """Compress the response bodies in the preferred encoding the client accepts (see `compression`),
+    chunk by chunk as they are sent. Small bodies and images are sent as they are."""
+    response = await call_next(request)
+    if not compression.is_compressible(response.status_code, response.headers):
+        return response
+    vary = response.headers.get('Vary')
+    response.headers['Vary'] = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+    encoding = compression.choose_encoding(request.headers)
+    if encoding is None or request.method == 'HEAD':
+        return response
+
+    response.headers['Content-Encoding'] = encoding
+    if 'Content-Length' in response.headers:
+        del response.headers['Content-Length']
+    # The compressed body is another representation of the resource: only weakly equal to the original
+    # (the ETags of `check_etag` are weak already)
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        response.headers['ETag'] = f'W/{etag}'
+    response.body_iterator = compression.compress_body(response.body_iterator,
+                                                       compression.create_compressor(encoding))
+    return response
+
+def get_route_path(scope):
+    """Get the path template of the API route matching a request (e.g., `/users/me/items/{item_id}`)."""
+    for route in api.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+@api.middleware("http")
+async def measure_request(request: Request, call_next):
+    """Record the metrics of a request by route (see `metrics`), once its response body is sent.
+    With METRICS_SERVER_TIMING, the DB, image and total times are also sent in a Server-Timing header."""
+    request_metrics = metrics.RequestMetrics()
+    token = metrics.current_request.set(request_metrics)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.current_request.reset(token)
+    if metrics.METRICS_SERVER_TIMING:
+        response.headers['Server-Timing'] = metrics.get_server_timing(request_metrics, time.perf_counter() - start)
+
+    route_path = get_route_path(request.scope)
+    body_iterator = response.body_iterator
+
+    async def measure_body():
+        response_bytes = 0
+        try:
+            async for chunk in body_iterator:
+                response_bytes += len(chunk)
+                yield chunk
+        finally:
+            metrics.record_request(request.method, route_path, response.status_code, time.perf_counter() - start,
+                                   request_metrics, response_bytes)
+    response.body_iterator = measure_body()
+    return response
+
+@api.post("/users/me/items/{item_id}/image", response_model=schemas.ImageStatus, responses={404: {"description": "Item not found"}, 413: {"description": "Image too large"}, 422: {"description": "Invalid image"}, 503: {"description": "Too many images being processed"}})
+@metrics.query_budget(0)
+def upload_user_image(
+        item_id: int,
+        mode: str,
+        file: UploadFile,
+        current_user_db: schemas.User = Depends(get_current_active_user)):
+    """Upload an image file for an item associated with the current user.
+    The image variants (full, normal and thumb) are created in the background;
+    their readiness is reported by the image status endpoint.
+    Uploading an image that is already stored reuses its files."""
 
-    ratio_thumb = max(THUMB_SIZE / width, THUMB_SIZE / height)
-    img_normal = img.resize(
-        (int(width * ratio_thumb), int(height*ratio_thumb)),
-        Image.Resampling.LANCZOS
-    )
-    img_normal.save(image_file_thumb, 'JPEG', quality='web_high')
+    current_user_id = current_user_db.id
 
-    return {"filename": image_id}
+    try:
+        with metrics.measure_image():
+            image_id, is_new = photos.save_upload(file.file, current_user_id, mode)
+    except photos.PhotoExceptionTooLarge:
+        raise HTTPException(status_code=413, detail="Image too large")
+    except photos.PhotoExceptionInvalid:
+        raise HTTPException(status_code=422, detail="Invalid image")
+
+    image_file = photos.get_image_path(current_user_id, image_id)
+    if is_new:
+        try:
+            photos.submit_image(image_file, mode)
+        except photos.PhotoExceptionBusy:
+            raise HTTPException(status_code=503, detail="Too many images being processed", headers={"Retry-After": "1"})
+
+    return {"filename": image_id, "variants": photos.get_image_status(image_file)}
 
 #---------------------------------------------------- Tags
 
 @api.get("/users/me/tags/", response_model=List[schemas.Tag])
-def get_user_tags(
-        db: Session = Depends(get_db),
+@metrics.query_budget(2)
+async def get_user_tags(
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(get_db),
         current_user_db: schemas.User = Depends(get_current_active_user)):
     """Get the tags associated with the current user."""
 
     current_user_id = current_user_db.id
 
-    tags_db = crud.get_user_tags(db, current_user_id)
+    revision = await crud_async.get_user_revision(db, current_user_id)
+    etag = f'"tags-{current_user_id}-{revision}"'
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
+
+    tags_db = await crud_async.get_user_tags(db, current_user_id)
     return tags_db
 
 @api.post("/users/me/tags/{tag_id}", response_model=schemas.Tag, responses={404: {"description": "Tag not found"}})
-def update_user_tag(
+@metrics.query_budget(7)
+async def update_user_tag(
         tag_id: int,
         tag: schemas.TagUpdate,
-        db: Session = Depends(get_db),
         current_user_db: schemas.User = Depends(get_current_active_user)):
     """Update a specific tag associated with the current user."""
 
     current_user_id = current_user_db.id
 
     try:
-        tag_db = crud.update_user_tag(db, tag_id=tag_id, tag=tag, user_id=current_user_id)
+        tag_db = await crud_async.update_user_tag(tag_id=tag_id, tag=tag, user_id=current_user_id)
     except crud.DbExceptionNotFound:
         raise HTTPException(status_code=404, detail="Tag not found")
     except crud.DbException:
@@ -319,29 +691,38 @@ def update_user_tag(
 #---------------------------------------------------- Locations
 
 @api.get("/users/me/locations/", response_model=List[schemas.Location])
-def get_user_locations(
-        db: Session = Depends(get_db),
+@metrics.query_budget(2)
+async def get_user_locations(
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(get_db),
         current_user_db: schemas.User = Depends(get_current_active_user)):
     """Get the locations associated with the current user."""
 
     current_user_id = current_user_db.id
 
-    locations_db = crud.get_user_locations(db, current_user_id)
+    revision = await crud_async.get_user_revision(db, current_user_id)
+    etag = f'"locations-{current_user_id}-{revision}"'
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
+
+    locations_db = await crud_async.get_user_locations(db, current_user_id)
     return locations_db
 
 
 @api.post("/users/me/locations/{location_id}", response_model=schemas.Location, responses={404: {"description": "Location not found"}})
-def update_user_location(
+@metrics.query_budget(7)
+async def update_user_location(
         location_id: int,
         location: schemas.LocationUpdate,
-        db: Session = Depends(get_db),
         current_user_db: schemas.User = Depends(get_current_active_user)):
     """Update a specific location associated with the current user."""
 
     current_user_id = current_user_db.id
 
     try:
-        location_db = crud.update_user_location(db, location_id=location_id, location=location, user_id=current_user_id)
+        location_db = await crud_async.update_user_location(location_id=location_id, location=location, user_id=current_user_id)
     except crud.DbExceptionNotFound:
         raise HTTPException(status_code=404, detail="Location not found")
     except crud.DbException:
@@ -349,8 +730,84 @@ def update_user_location(
 
     return location_db
 
+#---------------------------------------------------- Stats
+
+@api.get("/users/me/stats", response_model=schemas.Stats)
+@metrics.query_budget(4)
+async def get_user_stats(
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(get_db),
+        current_user_db: schemas.User = Depends(get_current_active_user)):
+    """Get the number and the total cost of the items of the current user: active, archived, by tag and by location."""
+
+    current_user_id = current_user_db.id
+
+    revision = await crud_async.get_user_revision(db, current_user_id)
+    etag = f'"stats-{current_user_id}-{revision}"'
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
+
+    stats = await crud_async.get_user_stats(db, current_user_id)
+    return stats
+
+#---------------------------------------------------- Changes
+
+@api.get("/users/me/changes", response_model=schemas.Changes)
+@metrics.query_budget(7)
+async def get_user_changes(
+        since: int = 0,
+        db: AsyncSession = Depends(get_db),
+        current_user_db: schemas.User = Depends(get_current_active_user)):
+    """Get the items, tags and locations of the current user that changed after a given revision.
+    The returned `revision` is passed as `since` in the next call to get only the newer changes."""
+
+    current_user_id = current_user_db.id
+
+    changes = await crud_async.get_user_changes(db, current_user_id, since=since)
+    changes['items'] = [create_serializable_item(item_db) for item_db in changes['items']]
+    for kind in ('tags', 'locations'):
+        changes[kind] = [{'name': object_db.name, 'id': object_db.id} for object_db in changes[kind]]
+    return create_fast_response(changes)
+
+@app.on_event("startup")
+def start_image_pool():
+    photos.start_image_pool()
+
+@app.on_event("shutdown")
+def shutdown_image_pool():
+    photos.shutdown_image_pool()
+
+@app.on_event("shutdown")
+def shutdown_deletion_worker():
+    photos.shutdown_deletion_worker()
+
+@app.on_event("shutdown")
+async def shutdown_database():
+    await writer.close()
+    await async_engine.dispose()
+    await write_engine.dispose()
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+@metrics.query_budget(0)
+def get_metrics(authorization: Union[str, None] = Header(default=None)):
+    """Export the metrics of the requests (see `metrics`) and of the caches, in the Prometheus text format.
+    Only served with the METRICS_TOKEN as bearer token, and not at all without a METRICS_TOKEN."""
+    if not metrics.METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not metrics.check_token(authorization):
+        raise HTTPException(status_code=401, detail="Invalid metrics token", headers={"WWW-Authenticate": "Bearer"})
+    cache_stats = security.user_cache.stats()
+    return PlainTextResponse(metrics.export({
+        'auth_cache_entries': ('gauge', 'Users in the authentication cache', cache_stats['size']),
+        'auth_cache_hits_total': ('counter', 'Authentications served by the cache', cache_stats['hits']),
+        'auth_cache_misses_total': ('counter', 'Authentications that read the user from the DB', cache_stats['misses']),
+        'write_batches_total': ('counter', 'Batches committed by the writer', writer.batches),
+    }), media_type='text/plain; version=0.0.4')
+
 app.mount("/api", api)
-app.mount("/", StaticFiles(directory="app",html=True), name="app")
+app.mount("/", static.PrecompressedStaticFiles(directory="app", html=True), name="app")
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
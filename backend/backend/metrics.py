@@ -0,0 +1,267 @@
+"""Performance metrics of the requests, by route: latency, SQL statements, DB time, rows fetched,
+response size and image handling time. They are exported in the Prometheus text format.
+
+A request is measured by `RequestMetrics`, set for its context by the middleware of the API;
+the SQL statements are counted by hooks on the engines (see `instrument_engine`), the image handling
+by `measure_image`. The metrics are kept by each process (i.e., by each worker of the server).
+
+The statements of a block can also be recorded with `track_queries`, e.g., to check the query budgets
+of the endpoints (see `query_budget`).
+"""
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+import secrets
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .config import config
+
+# Add a Server-Timing header to the API responses (shown by the browser developer tools)
+METRICS_SERVER_TIMING = config('METRICS_SERVER_TIMING', default=False, cast=bool)
+# Bearer token of the requests to /metrics (e.g., `bearer_token` of the Prometheus scrape config);
+# without it, /metrics is not served
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class RequestMetrics:
+    """What a request costs, besides its latency."""
+    __slots__ = ('statements', 'db_time', 'rows', 'image_time')
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.image_time = 0.0
+
+current_request = ContextVar('current_request', default=None)
+
+#------------------------------------------ Collection
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_time = 0.0
+        self.rows = 0
+        self.response_bytes = 0
+        self.image_time = 0.0
+        self.errors = 0
+
+routes = {}
+image_processing = Histogram(LATENCY_BUCKETS)
+metrics_lock = threading.Lock()
+
+def record_request(method: str, route: str, status_code: int, latency: float, request_metrics: RequestMetrics,
+                   response_bytes: int):
+    with metrics_lock:
+        route_metrics = routes.get((method, route))
+        if route_metrics is None:
+            route_metrics = routes[(method, route)] = RouteMetrics()
+        route_metrics.latency.observe(latency)
+        route_metrics.statements.observe(request_metrics.statements)
+        route_metrics.db_time += request_metrics.db_time
+        route_metrics.rows += request_metrics.rows
+        route_metrics.response_bytes += response_bytes
+        route_metrics.image_time += request_metrics.image_time
+        if status_code >= 500:
+            route_metrics.errors += 1
+
+def record_image_processing(duration: float):
+    """Record the time an uploaded image took to be processed, in the background (queueing included)."""
+    with metrics_lock:
+        image_processing.observe(duration)
+
+@contextmanager
+def measure_image():
+    """Count the time spent in a block as image handling time of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_metrics = current_request.get()
+        if request_metrics is not None:
+            request_metrics.image_time += time.perf_counter() - start
+
+def get_server_timing(request_metrics: RequestMetrics, duration: float):
+    """Get the value of the Server-Timing header of a response."""
+    return (f'db;dur={1000 * request_metrics.db_time:.1f};desc="{request_metrics.statements} statements, '
+            f'{request_metrics.rows} rows", image;dur={1000 * request_metrics.image_time:.1f}, '
+            f'app;dur={1000 * duration:.1f}')
+
+#------------------------------------------ SQL hooks
+
+def count_fetched_rows(cursor):
+    """Get the rows fetched by a cursor when executing, or 0 if unknown.
+    The DBAPI adapter of the async engines (aiosqlite) fetches all the rows of a statement when executing it,
+    and keeps them in a list, which is not part of its API: the rows are not counted if that changes
+    (see the test of the metrics). The other cursors fetch their rows later, while the result is read."""
+    rows = getattr(cursor, '_rows', None)
+    return len(rows) if isinstance(rows, list) else 0
+
+def instrument_engine(engine):
+    """Count the statements, their duration and the rows they fetch, for the request running them.
+    The rows are only counted for the async engines (see `count_fetched_rows`)."""
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context.metrics_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        query_log = current_query_log.get()
+        if query_log is not None and not statement.startswith(TRANSACTION_STATEMENTS):
+            query_log.statements.append(statement)
+        request_metrics = current_request.get()
+        if request_metrics is None:
+            return
+        request_metrics.statements += 1
+        request_metrics.db_time += time.perf_counter() - context.metrics_start
+        if cursor.description:
+            request_metrics.rows += count_fetched_rows(cursor)
+
+    return engine
+
+#------------------------------------------ Query budgets
+
+# Not counted as queries
+TRANSACTION_STATEMENTS = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK')
+# A statement run more times than this in a block is reported as an N+1 pattern (e.g., a query per item)
+REPEAT_LIMIT = 2
+
+
+class QueryBudgetException(Exception):
+    pass
+
+class QueryLog:
+    """The SQL statements of a block, and the lazy loads of relationships among them."""
+
+    def __init__(self):
+        self.statements = []
+        self.lazy_loads = []
+
+    def get_repeated(self):
+        """Get the statements run more than REPEAT_LIMIT times, with their number of runs."""
+        counts = Counter(self.statements)
+        return {statement: count for statement, count in counts.items() if count > REPEAT_LIMIT}
+
+    def check(self, budget: int):
+        """Raise an exception if there are more statements than the budget, repeated statements or lazy loads."""
+        problems = []
+        if len(self.statements) > budget:
+            problems.append(f'{len(self.statements)} statements for a budget of {budget}')
+        for statement, count in self.get_repeated().items():
+            problems.append(f'statement run {count} times: {statement}')
+        for lazy_load in self.lazy_loads:
+            problems.append(f'lazy load of {lazy_load}')
+        if problems:
+            raise QueryBudgetException('; '.join(problems))
+
+current_query_log = ContextVar('current_query_log', default=None)
+
+@contextmanager
+def track_queries():
+    """Record the statements run by a block (and by the writer jobs it queues) in a QueryLog."""
+    query_log = QueryLog()
+    token = current_query_log.set(query_log)
+    try:
+        yield query_log
+    finally:
+        current_query_log.reset(token)
+
+@event.listens_for(Session, 'do_orm_execute')
+def record_lazy_load(orm_execute_state):
+    query_log = current_query_log.get()
+    if query_log is not None and orm_execute_state.is_select and orm_execute_state.lazy_loaded_from is not None:
+        mapper = orm_execute_state.lazy_loaded_from.mapper
+        query_log.lazy_loads.append(f'{mapper.class_.__name__} ({orm_execute_state.statement})')
+
+def query_budget(statements: int):
+    """Declare the most SQL statements an endpoint may run for a request (authenticated user cached),
+    checked by `scripts/check_query_budgets`."""
+    def set_budget(endpoint):
+        endpoint.query_budget = statements
+        return endpoint
+    return set_budget
+
+#------------------------------------------ Export
+
+def check_token(authorization: str):
+    """Check the Authorization header of a request to /metrics against METRICS_TOKEN."""
+    expected = f'Bearer {METRICS_TOKEN}'
+    return bool(METRICS_TOKEN) and secrets.compare_digest((authorization or '').encode(), expected.encode())
+
+def format_labels(labels: dict):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}' if labels else ''
+
+def format_histogram(lines: list, name: str, labels: dict, histogram: Histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{format_labels({**labels, "le": bound})} {cumulative}')
+    lines.append(f'{name}_bucket{format_labels({**labels, "le": "+Inf"})} {histogram.count}')
+    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+ROUTE_COUNTERS = [
+    ('db_seconds', 'Time spent executing SQL statements', 'db_time'),
+    ('db_rows', 'Rows fetched by the SQL statements', 'rows'),
+    ('response_bytes', 'Size of the response bodies, as sent (compressed or not)', 'response_bytes'),
+    ('image_seconds', 'Time spent handling images in the requests (e.g., storing uploads)', 'image_time'),
+    ('errors', 'Requests that failed with a server error', 'errors'),
+]
+
+def export(extra: dict = None):
+    """Get the metrics in the Prometheus text format,
+    with some more metrics given as {name: (type, help, value)} (e.g., of the caches)."""
+    lines = []
+    with metrics_lock:
+        route_items = sorted(routes.items())
+
+        lines += ['# HELP stuffkeeper_request_seconds Latency of the requests, by route',
+                  '# TYPE stuffkeeper_request_seconds histogram']
+        for (method, route), route_metrics in route_items:
+            format_histogram(lines, 'stuffkeeper_request_seconds', {'method': method, 'route': route},
+                             route_metrics.latency)
+        lines += ['# HELP stuffkeeper_request_db_statements SQL statements per request, by route',
+                  '# TYPE stuffkeeper_request_db_statements histogram']
+        for (method, route), route_metrics in route_items:
+            format_histogram(lines, 'stuffkeeper_request_db_statements', {'method': method, 'route': route},
+                             route_metrics.statements)
+        for name, help_text, attribute in ROUTE_COUNTERS:
+            lines += [f'# HELP stuffkeeper_request_{name}_total {help_text}, by route',
+                      f'# TYPE stuffkeeper_request_{name}_total counter']
+            for (method, route), route_metrics in route_items:
+                labels = format_labels({'method': method, 'route': route})
+                lines.append(f'stuffkeeper_request_{name}_total{labels} {getattr(route_metrics, attribute)}')
+
+        lines += ['# HELP stuffkeeper_image_processing_seconds Time to create the variants of an uploaded image',
+                  '# TYPE stuffkeeper_image_processing_seconds histogram']
+        format_histogram(lines, 'stuffkeeper_image_processing_seconds', {}, image_processing)
+
+    for name, (metric_type, help_text, value) in (extra or {}).items():
+        lines += [f'# HELP stuffkeeper_{name} {help_text}', f'# TYPE stuffkeeper_{name} {metric_type}',
+                  f'stuffkeeper_{name} {value}']
+    return '\n'.join(lines) + '\n'
@@ -1,16 +1,21 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Date, Table
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, JSON, String, Date, Table, Index, UniqueConstraint, DDL, event
+from sqlalchemy.sql import column, table
 from sqlalchemy.orm import relationship
 
 from .database import Base
 
 item_locations = Table('item_locations', Base.metadata,
     Column('item_id', ForeignKey('items.id'), primary_key=True),
-    Column('location_id', ForeignKey('locations.id'), primary_key=True)
+    Column('location_id', ForeignKey('locations.id'), primary_key=True),
+    # The primary key starts with the item: filtering the items by location needs the reverse index
+    Index('ix_item_locations_location_id_item_id', 'location_id', 'item_id'),
 )
 
 item_tags = Table('item_tags', Base.metadata,
     Column('item_id', ForeignKey('items.id'), primary_key=True),
-    Column('tag_id', ForeignKey('tags.id'), primary_key=True)
+    Column('tag_id', ForeignKey('tags.id'), primary_key=True),
+    # The primary key starts with the item: filtering the items by tag needs the reverse index
+    Index('ix_item_tags_tag_id_item_id', 'tag_id', 'item_id'),
 )
 
 class User(Base):
@@ -22,6 +27,7 @@ class User(Base):
     settings = Column(String, nullable=False, default="{}")
     is_active = Column(Boolean, nullable=False, default=True)
     creation_date = Column(Date, nullable=False)
+    revision = Column(Integer, nullable=False, default=0)
 
     items = relationship("Item", back_populates="owner")
     locations = relationship("Location", back_populates="owner")
@@ -29,6 +35,13 @@ class User(Base):
 
 class Item(Base):
     __tablename__ = "items"
+    __table_args__ = (
+        # Supports the keyset pagination of the items list (newest first)
+        Index('ix_items_owner_id_addition_date_id', 'owner_id', 'addition_date', 'id'),
+        Index('ix_items_owner_id_revision', 'owner_id', 'revision'),
+        # Supports the filtering of the items expiring in a date range
+        Index('ix_items_owner_id_expiration_date', 'owner_id', 'expiration_date'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=True)
@@ -38,7 +51,8 @@ class Item(Base):
     cost = Column(Integer,nullable=False, default=0)
     expiration_date = Column(Date, nullable=True)
     code = Column(String, nullable=True)
-    photos = Column(String, nullable=True)
+    # Stored as JSON text (like before), read as a dict
+    photos = Column(JSON(none_as_null=True), nullable=True)
 
     is_active = Column(Boolean, nullable=False, default=True)
     is_bookmarked = Column(Boolean, nullable=False, default=False)
@@ -46,17 +60,26 @@ class Item(Base):
 
     addition_date = Column(Date, nullable=False)
     removal_date = Column(Date, nullable=True)
+    revision = Column(Integer, nullable=False, default=0)
 
     owner_id = Column(Integer, ForeignKey("users.id"))
     owner = relationship("User", back_populates="items")
-    locations = relationship("Location", secondary="item_locations", back_populates='items', lazy='joined')
-    tags = relationship("Tag", secondary="item_tags", back_populates='items', lazy='joined')
+    # Loaded with one more query each, for all the items of a query: joining both would read
+    # a row per tag and location of each item (and makes SQLite scan the link tables for a limited query)
+    locations = relationship("Location", secondary="item_locations", back_populates='items', lazy='selectin')
+    tags = relationship("Tag", secondary="item_tags", back_populates='items', lazy='selectin')
 
 class Location(Base):
     __tablename__ = "locations"
+    __table_args__ = (
+        Index('ix_locations_owner_id_revision', 'owner_id', 'revision'),
+        # The names of a user are unique, so that concurrent writes cannot create duplicates
+        Index('ux_locations_owner_id_name', 'owner_id', 'name', unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True, nullable=False)
+    revision = Column(Integer, nullable=False, default=0)
 
     owner_id = Column(Integer, ForeignKey("users.id"))
     owner = relationship("User", back_populates="locations")
@@ -64,10 +87,103 @@ class Location(Base):
 
 class Tag(Base):
     __tablename__ = "tags"
+    __table_args__ = (
+        Index('ix_tags_owner_id_revision', 'owner_id', 'revision'),
+        # The names of a user are unique, so that concurrent writes cannot create duplicates
+        Index('ux_tags_owner_id_name', 'owner_id', 'name', unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True, nullable=False)
+    revision = Column(Integer, nullable=False, default=0)
 
     owner_id = Column(Integer, ForeignKey("users.id"))
     owner = relationship("User", back_populates="tags")
-    items = relationship("Item", secondary="item_tags", back_populates='tags')
\ No newline at end of file
+    items = relationship("Item", secondary="item_tags", back_populates='tags')
+
+class Tombstone(Base):
+    """Record of a deleted item, tag or location, kept so that clients can sync deletions."""
+    __tablename__ = "tombstones"
+    __table_args__ = (
+        Index('ix_tombstones_owner_id_revision', 'owner_id', 'revision'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    object_id = Column(Integer, nullable=False)
+    revision = Column(Integer, nullable=False)
+
+    owner_id = Column(Integer, ForeignKey("users.id"))
+
+class Photo(Base):
+    """Reference count of a (content addressed) photo, shared by all the items of a user that show it."""
+    __tablename__ = "photos"
+    __table_args__ = (
+        UniqueConstraint('owner_id', 'image_id'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    image_id = Column(String, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+
+    owner_id = Column(Integer, ForeignKey("users.id"))
+
+class ItemStats(Base):
+    """Number and total cost of the items of a user, by status (kind 'active' or 'archived', object_id 0),
+    by tag (kind 'tag') and by location (kind 'location').
+    The counters are updated by the item writes (see `crud.update_item_stats`)."""
+    __tablename__ = "item_stats"
+
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    kind = Column(String, primary_key=True)
+    object_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    cost = Column(Integer, nullable=False, default=0)
+
+# Full-text index of the items, with the names of their tags and locations.
+# The index is kept in sync by triggers, so that set-based writes (e.g., bulk operations) update it as well.
+# The owner is indexed as a token (`u<owner_id>`, see `crud.build_search_query`), so that a search only
+# reads the entries of the user's items instead of the matches of all the users.
+items_fts = table('items_fts',
+    column('rowid', Integer),
+)
+
+INDEX_ITEMS = """INSERT INTO items_fts (rowid, owner, name, description, code, tags, locations)
+    SELECT items.id, 'u' || items.owner_id, items.name, items.description, items.code,
+        (SELECT group_concat(tags.name, ' ') FROM item_tags JOIN tags ON tags.id = item_tags.tag_id
+            WHERE item_tags.item_id = items.id),
+        (SELECT group_concat(locations.name, ' ') FROM item_locations JOIN locations ON locations.id = item_locations.location_id
+            WHERE item_locations.item_id = items.id)
+    FROM items WHERE {condition};"""
+
+def reindex_items(condition: str):
+    return f"DELETE FROM items_fts WHERE rowid IN (SELECT id FROM items WHERE {condition}); " + \
+        INDEX_ITEMS.format(condition=condition)
+
+ITEMS_FTS_DDL = [
+    "CREATE VIRTUAL TABLE items_fts USING fts5(owner, name, description, code, tags, locations, "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    # Rank the matches in the name first, then in the tags and locations, the code and the description
+    "INSERT INTO items_fts (items_fts, rank) VALUES ('rank', 'bm25(0, 10.0, 1.0, 2.0, 5.0, 5.0)')",
+    "CREATE TRIGGER items_fts_items_insert AFTER INSERT ON items BEGIN " +
+        INDEX_ITEMS.format(condition='items.id = new.id') + " END",
+    "CREATE TRIGGER items_fts_items_update AFTER UPDATE OF name, description, code, owner_id ON items BEGIN " +
+        "DELETE FROM items_fts WHERE rowid = old.id; " + INDEX_ITEMS.format(condition='items.id = new.id') + " END",
+    "CREATE TRIGGER items_fts_items_delete AFTER DELETE ON items BEGIN " +
+        "DELETE FROM items_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER items_fts_item_tags_insert AFTER INSERT ON item_tags BEGIN " +
+        reindex_items('items.id = new.item_id') + " END",
+    "CREATE TRIGGER items_fts_item_tags_delete AFTER DELETE ON item_tags BEGIN " +
+        reindex_items('items.id = old.item_id') + " END",
+    "CREATE TRIGGER items_fts_item_locations_insert AFTER INSERT ON item_locations BEGIN " +
+        reindex_items('items.id = new.item_id') + " END",
+    "CREATE TRIGGER items_fts_item_locations_delete AFTER DELETE ON item_locations BEGIN " +
+        reindex_items('items.id = old.item_id') + " END",
+    "CREATE TRIGGER items_fts_tags_update AFTER UPDATE OF name ON tags BEGIN " +
+        reindex_items('items.id IN (SELECT item_id FROM item_tags WHERE tag_id = new.id)') + " END",
+    "CREATE TRIGGER items_fts_locations_update AFTER UPDATE OF name ON locations BEGIN " +
+        reindex_items('items.id IN (SELECT item_id FROM item_locations WHERE location_id = new.id)') + " END",
+]
+
+for statement in ITEMS_FTS_DDL:
+    event.listen(Base.metadata, 'after_create', DDL(statement))
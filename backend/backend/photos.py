@@ -0,0 +1,475 @@
+import asyncio
+import base64
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import fcntl
+import functools
+import hashlib
+import logging
+import multiprocessing
+import os
+import os.path
+import re
+import tempfile
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+from . import metrics
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+PHOTOS_DIR = './local/photos'
+
+SD_WIDTH = 640
+NORMAL_WIDTH = 320
+THUMB_SIZE = 80
+
+IMAGE_WORKERS = config('IMAGE_WORKERS', default=os.cpu_count() or 1, cast=int)
+IMAGE_QUEUE_SIZE = config('IMAGE_QUEUE_SIZE', default=4 * IMAGE_WORKERS, cast=int)
+
+MAX_UPLOAD_SIZE = config('MAX_UPLOAD_SIZE', default=20 * 1024 * 1024, cast=int)
+# Seconds during which an image uploaded again is kept for the item it is uploaded for,
+# even if the items that showed it are changed or deleted in the meantime
+UPLOAD_PIN_TIME = config('UPLOAD_PIN_TIME', default=3600, cast=int)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Let a fronting reverse proxy send the image files: '' (disabled), 'x-accel-redirect' (nginx) or 'x-sendfile'
+IMAGE_SENDFILE = config('IMAGE_SENDFILE', default='')
+# Internal location under which nginx serves PHOTOS_DIR, used with 'x-accel-redirect'
+IMAGE_SENDFILE_PREFIX = config('IMAGE_SENDFILE_PREFIX', default='/protected-photos')
+
+THUMBNAIL_ID_PATTERN = re.compile(r'^\d+-[0-9a-f]{16}$')
+# Content addressed images (e.g., `3f-0c9a...e1.jpeg`) as well as legacy ones (e.g., `2023-5-1683380000.jpeg`)
+IMAGE_ID_PATTERN = re.compile(r'^[0-9a-f]+(-[0-9a-f]+)*\.jpeg(\.full|\.thumb)?$')
+
+class PhotoException(Exception):
+    pass
+
+class PhotoExceptionBusy(PhotoException):
+    pass
+
+class PhotoExceptionTooLarge(PhotoException):
+    pass
+
+class PhotoExceptionInvalid(PhotoException):
+    pass
+
+#------------------------------------------ Thumbnails
+
+def get_thumbnail_path(user_id: int, thumbnail_id: str):
+    """Get the path of the file storing a thumbnail.
+    If the thumbnail ID is malformed, an exception is raised."""
+    if not THUMBNAIL_ID_PATTERN.match(thumbnail_id):
+        raise PhotoException('Invalid thumbnail.')
+    return f'{PHOTOS_DIR}/{user_id}/thumbnails/{thumbnail_id}.jpeg'
+
+def save_thumbnail(user_id: int, item_id: int, thumbnail: str):
+    """Store an inline (base64) JPEG thumbnail of an item in a file.
+    The thumbnail ID depends on the image content, so a changed thumbnail gets a new (cacheable) URL.
+    The file is written under a temporary name and moved in place, so it is never served partly written."""
+    try:
+        data = base64.b64decode(thumbnail, validate=True)
+    except ValueError:
+        raise PhotoException('Invalid thumbnail.')
+
+    thumbnail_id = f'{item_id}-{hashlib.sha256(data).hexdigest()[:16]}'
+    thumbnail_path = get_thumbnail_path(user_id, thumbnail_id)
+    thumbnail_dir = os.path.dirname(thumbnail_path)
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    tmp_file, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=thumbnail_dir)
+    try:
+        with os.fdopen(tmp_file, 'wb') as thumbnail_file:
+            thumbnail_file.write(data)
+        os.replace(tmp_path, thumbnail_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    return thumbnail_id
+
+def delete_thumbnail(user_id: int, thumbnail_id: str):
+    """Remove the file storing a thumbnail, if it exists."""
+    remove_file(get_thumbnail_path(user_id, thumbnail_id))
+
+#------------------------------------------ Images
+
+def get_image_path(user_id: int, image_id: str):
+    """Get the path of the file storing an image variant (e.g., `3f-0c9a...e1.jpeg.thumb`).
+    If the image ID is malformed, an exception is raised."""
+    if not IMAGE_ID_PATTERN.match(image_id):
+        raise PhotoException('Invalid image.')
+    path_id = image_id.replace('-', '/')
+    return f'{PHOTOS_DIR}/{user_id}/{path_id}'
+
+def make_image_id(digest: str):
+    """Get the ID of a content addressed image, given the hash of its content.
+    The first characters of the hash select a sub-directory, to keep directories small."""
+    return f'{digest[:2]}-{digest[2:32]}.jpeg'
+
+def get_image_variants(image_path: str):
+    """Get the paths of the variants of an image, given the path of any of them."""
+    for suffix in ['.full', '.thumb']:
+        if image_path.endswith(suffix):
+            image_path = image_path[:-len(suffix)]
+    return {
+        'full': f'{image_path}.full',
+        'normal': image_path,
+        'thumb': f'{image_path}.thumb',
+    }
+
+def get_upload_path(image_path: str):
+    """Get the path where the upload of an image is kept until its variants are created."""
+    return f'{get_image_variants(image_path)["normal"]}.upload'
+
+def get_failed_path(image_path: str):
+    """Get the path of the marker left when the variants of an image could not be created."""
+    return f'{get_image_variants(image_path)["normal"]}.failed'
+
+def get_pin_path(image_path: str):
+    """Get the path of the marker that keeps the files of an image uploaded again (see UPLOAD_PIN_TIME)."""
+    return f'{get_image_variants(image_path)["normal"]}.pin'
+
+# Files kept next to the variants of an image
+MARKER_SUFFIXES = ('.failed', '.pin')
+
+@contextmanager
+def lock_user_files(user_id: int):
+    """Hold the lock of the image files of a user, shared by the processes of the application,
+    so that an upload does not reuse an image while its files are being removed."""
+    user_dir = f'{PHOTOS_DIR}/{user_id}'
+    os.makedirs(user_dir, exist_ok=True)
+    with open(f'{user_dir}/.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def verify_image(file_path: str):
+    """Check that a file is an image that Pillow can read, without decoding it.
+    If it is not, an exception is raised."""
+    try:
+        with Image.open(file_path) as img:
+            img.verify()
+    except Exception:
+        raise PhotoExceptionInvalid('Invalid image.')
+
+def save_upload(source_file, user_id: int, mode: str):
+    """Stream an uploaded file, in fixed-size chunks, to the photo store of a user.
+    The image ID is the hash of the upload and of the processing mode, so identical uploads share their files.
+    Returns the image ID and whether the image is new (i.e., its variants still have to be created).
+    If the upload exceeds MAX_UPLOAD_SIZE or is not an image, it is discarded and an exception is raised."""
+    user_dir = f'{PHOTOS_DIR}/{user_id}'
+    os.makedirs(user_dir, exist_ok=True)
+    tmp_file, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=user_dir)
+
+    size = 0
+    content_hash = hashlib.sha256(mode.encode() + b'\0')
+    try:
+        with os.fdopen(tmp_file, 'wb') as upload_file:
+            while chunk := source_file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise PhotoExceptionTooLarge('Image too large.')
+                content_hash.update(chunk)
+                upload_file.write(chunk)
+
+        image_id = make_image_id(content_hash.hexdigest())
+        image_path = get_image_path(user_id, image_id)
+        with lock_user_files(user_id):
+            if is_image_pending(image_path):
+                return image_id, False
+            if os.path.isfile(image_path):
+                # Reused: keep the files until the item is saved, even if the items showing the image
+                # are deleted in the meantime (see `delete_files`) or the files look orphaned (see `find_orphan_files`)
+                with open(get_pin_path(image_path), 'w'):
+                    pass
+                return image_id, False
+
+            verify_image(tmp_path)
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            # Processed again, if it failed before
+            remove_file(get_failed_path(image_path))
+            os.replace(tmp_path, get_upload_path(image_path))
+            return image_id, True
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+def get_image_files(image_path: str):
+    """Get the paths of the files of an image: its variants and its markers."""
+    return [*get_image_variants(image_path).values(), get_failed_path(image_path), get_pin_path(image_path)]
+
+def delete_image(user_id: int, image_id: str):
+    """Remove the files storing the variants of an image, and its markers, if they exist."""
+    for file_path in get_image_files(get_image_path(user_id, image_id)):
+        remove_file(file_path)
+
+def is_image_pinned(image_path: str):
+    """Check whether an image was uploaded again less than UPLOAD_PIN_TIME ago."""
+    mtime = get_files_mtime([get_pin_path(image_path)])
+    return mtime is not None and mtime > time.time() - UPLOAD_PIN_TIME
+
+def remove_file(file_path: str):
+    """Remove a file, if it exists."""
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+def get_sendfile_header(file_path: str):
+    """Get the header that lets the reverse proxy send a photo file, or None if this is disabled."""
+    if IMAGE_SENDFILE == 'x-accel-redirect':
+        return 'X-Accel-Redirect', IMAGE_SENDFILE_PREFIX + file_path[len(PHOTOS_DIR):]
+    if IMAGE_SENDFILE == 'x-sendfile':
+        return 'X-Sendfile', os.path.abspath(file_path)
+    return None
+
+def read_file_range(file_path: str, start: int, length: int):
+    """Read a byte range of a file, in fixed-size chunks."""
+    with open(file_path, 'rb') as range_file:
+        range_file.seek(start)
+        while length > 0:
+            chunk = range_file.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def get_image_status(image_path: str):
+    """Get which variants of an image are ready to be served."""
+    return {variant: os.path.isfile(path) for variant, path in get_image_variants(image_path).items()}
+
+def is_image_pending(image_path: str):
+    """Check whether the variants of an image are still being created."""
+    return os.path.isfile(get_upload_path(image_path))
+
+def is_image_failed(image_path: str):
+    """Check whether the variants of an image could not be created."""
+    return os.path.isfile(get_failed_path(image_path))
+
+def mark_image_failed(image_path: str):
+    with open(get_failed_path(image_path), 'w'):
+        pass
+
+async def wait_for_image(image_path: str, timeout: float = 10):
+    """Wait until the variants of an image are created, or the timeout (in seconds) expires."""
+    deadline = time.monotonic() + timeout
+    while is_image_pending(image_path) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+def resize_image(img, ratio: float):
+    return img.resize(
+        (max(1, int(img.width * ratio)), max(1, int(img.height * ratio))),
+        Image.Resampling.LANCZOS
+    )
+
+def save_image(img, image_path: str):
+    """Save an image as JPEG under a temporary name and move it in place,
+    so that a variant is never served while it is being written."""
+    tmp_path = f'{image_path}.tmp'
+    img.save(tmp_path, 'JPEG', quality='web_high')
+    os.replace(tmp_path, image_path)
+
+def process_image(image_path: str, mode: str):
+    """Create the variants of an uploaded image. This runs in a worker process.
+    Each variant is resized from the next larger one, and JPEG uploads
+    are decoded directly at a reduced scale when an SD variant is requested."""
+    upload_path = get_upload_path(image_path)
+    variants = get_image_variants(image_path)
+    try:
+        img = Image.open(upload_path)
+        if (mode == 'sd'):
+            # The draft keeps both sides above SD_WIDTH, whatever the EXIF orientation is
+            img.draft('RGB', (SD_WIDTH, SD_WIDTH))
+        img = ImageOps.exif_transpose(img)
+
+        if (mode == 'sd'):
+            img_full = resize_image(img, SD_WIDTH / img.width)
+        else:
+            img_full = img
+        save_image(img_full, variants['full'])
+
+        img_normal = resize_image(img_full, NORMAL_WIDTH / img_full.width)
+        save_image(img_normal, variants['normal'])
+
+        img_thumb = resize_image(img_normal, max(THUMB_SIZE / img_normal.width, THUMB_SIZE / img_normal.height))
+        save_image(img_thumb, variants['thumb'])
+    except Exception:
+        # Marked before the upload is removed, so that the image is never seen as neither pending nor failed
+        mark_image_failed(image_path)
+        raise
+    finally:
+        os.remove(upload_path)
+
+#------------------------------------------ Image processing pool
+
+executor = None
+pending_images = 0
+pending_lock = threading.Lock()
+
+def start_image_pool():
+    """Create the processing pool, unless it exists.
+    Its workers are started by a server process (or spawned), instead of being forked from the application,
+    whose threads (e.g., of the DB connections) would be copied in an unknown state."""
+    global executor
+    with pending_lock:
+        if executor is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context(method))
+    return executor
+
+def on_image_processed(future, image_path: str, submitted: float):
+    global pending_images
+    with pending_lock:
+        pending_images -= 1
+    metrics.record_image_processing(time.perf_counter() - submitted)
+    exception = None if future.cancelled() else future.exception()
+    if exception is not None:
+        logger.error('Image not processed: %s', image_path, exc_info=exception)
+        if is_image_pending(image_path):
+            # The worker stopped before cleaning up (e.g., it was killed)
+            mark_image_failed(image_path)
+            remove_file(get_upload_path(image_path))
+
+def submit_image(image_path: str, mode: str):
+    """Queue the creation of the variants of an uploaded image on the processing pool.
+    If the image is not queued (e.g., too many images are already queued), its upload is removed
+    and an exception is raised."""
+    global executor, pending_images
+    with pending_lock:
+        queued = pending_images < IMAGE_QUEUE_SIZE
+        if queued:
+            pending_images += 1
+    if not queued:
+        remove_file(get_upload_path(image_path))
+        raise PhotoExceptionBusy('Too many images are being processed.')
+
+    try:
+        future = start_image_pool().submit(process_image, image_path, mode)
+    except BaseException as exception:
+        with pending_lock:
+            pending_images -= 1
+            broken = isinstance(exception, BrokenProcessPool)
+            if broken and executor is not None:
+                # A worker died: the next images get a new pool
+                executor.shutdown(wait=False)
+                executor = None
+        remove_file(get_upload_path(image_path))
+        if broken:
+            raise PhotoExceptionBusy('The image processing pool is restarting.')
+        raise
+    future.add_done_callback(functools.partial(on_image_processed, image_path=image_path, submitted=time.perf_counter()))
+    return future
+
+def shutdown_image_pool():
+    """Stop the processing pool, after the queued images are processed."""
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=True)
+        executor = None
+
+#------------------------------------------ Deletion worker
+
+deletion_executor = None
+deletion_lock = threading.Lock()
+
+def delete_unpinned_image(user_id: int, image_id: str):
+    """Remove the files of an image, unless it is being uploaded again (see `save_upload`).
+    The files of a pinned image are left to the collection of the orphan files."""
+    if not is_image_pinned(get_image_path(user_id, image_id)):
+        delete_image(user_id, image_id)
+
+def delete_files(user_id: int, image_ids: list = (), thumbnail_ids: list = ()):
+    """Remove the files of images and thumbnails, logging the failures instead of raising them.
+    The images that are uploaded again are kept."""
+    with lock_user_files(user_id):
+        for delete, file_ids in ((delete_unpinned_image, image_ids), (delete_thumbnail, thumbnail_ids)):
+            for file_id in file_ids:
+                try:
+                    delete(user_id, file_id)
+                except PhotoException:
+                    # Not an uploaded image (e.g., test data)
+                    pass
+                except OSError:
+                    logger.exception('Photo file of user %d not removed: %s', user_id, file_id)
+
+def queue_deletion(user_id: int, image_ids: list = (), thumbnail_ids: list = ()):
+    """Remove the files of images and thumbnails on a background thread, so that the caller
+    (e.g., the writer, after a commit) does not wait for the file system. The files are removed in order."""
+    global deletion_executor
+    if not image_ids and not thumbnail_ids:
+        return
+    with deletion_lock:
+        if deletion_executor is None:
+            deletion_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='photo-deletion')
+    deletion_executor.submit(delete_files, user_id, list(image_ids), list(thumbnail_ids))
+
+def shutdown_deletion_worker():
+    """Stop the deletion thread, after the queued files are removed."""
+    global deletion_executor
+    if deletion_executor is not None:
+        deletion_executor.shutdown(wait=True)
+        deletion_executor = None
+
+#------------------------------------------ Garbage collection
+
+def list_user_ids():
+    """Get the users that have a photo directory."""
+    if not os.path.isdir(PHOTOS_DIR):
+        return []
+    return sorted(int(name) for name in os.listdir(PHOTOS_DIR) if name.isdigit())
+
+def get_files_mtime(file_paths):
+    """Get when the last of some files (e.g., the variants of an image) was changed, or None if none exists."""
+    mtimes = []
+    for file_path in file_paths:
+        try:
+            mtimes.append(os.stat(file_path).st_mtime)
+        except FileNotFoundError:
+            pass
+    return max(mtimes, default=None)
+
+def find_orphan_files(user_id: int, image_ids: set, thumbnail_ids: set, grace: float):
+    """Find the image and thumbnail files of a user that are not referenced (by the given IDs).
+    Files changed less than `grace` seconds ago, and pinned images, are skipped:
+    they may be uploads whose item is not saved yet.
+    Returns the IDs of the orphan images and of the orphan thumbnails."""
+    user_dir = f'{PHOTOS_DIR}/{user_id}'
+    deadline = time.time() - grace
+    seen_images, orphan_images, orphan_thumbnails = set(), [], []
+    for dir_path, _, file_names in os.walk(user_dir):
+        relative_dir = os.path.relpath(dir_path, user_dir)
+        for file_name in file_names:
+            if relative_dir == 'thumbnails':
+                thumbnail_id = file_name[:-len('.jpeg')]
+                if not file_name.endswith('.jpeg') or not THUMBNAIL_ID_PATTERN.match(thumbnail_id) \
+                        or thumbnail_id in thumbnail_ids:
+                    continue
+                mtime = get_files_mtime([os.path.join(dir_path, file_name)])
+                if mtime is not None and mtime < deadline:
+                    orphan_thumbnails.append(thumbnail_id)
+                continue
+
+            # The image ID is the path of the file (see `get_image_path`), without the variant suffix
+            file_id = file_name if relative_dir == '.' else \
+                os.path.join(relative_dir, file_name).replace(os.sep, '-')
+            for suffix in MARKER_SUFFIXES:
+                if file_id.endswith(suffix):
+                    file_id = file_id[:-len(suffix)]
+            if not IMAGE_ID_PATTERN.match(file_id):
+                # Uploads being processed and temporary files
+                continue
+            image_id = get_image_variants(file_id)['normal']
+            if image_id in image_ids or image_id in seen_images:
+                continue
+            seen_images.add(image_id)
+            image_path = get_image_path(user_id, image_id)
+            mtime = get_files_mtime(get_image_files(image_path))
+            if not is_image_pending(image_path) and not is_image_pinned(image_path) \
+                    and mtime is not None and mtime < deadline:
+                orphan_images.append(image_id)
+    return orphan_images, orphan_thumbnails
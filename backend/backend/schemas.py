@@ -1,7 +1,7 @@
-from typing import List, Union
+from typing import Dict, List, Literal, Union
 import datetime
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 #---------------------------------- Location
@@ -63,10 +63,20 @@ class User(UserBase):
     class Config:
         orm_mode = True
 
+class CurrentUser(BaseModel):
+    """The authenticated user, as cached between requests."""
+    id: int
+    email: str
+    is_active: bool
+
+    class Config:
+        orm_mode = True
+
 #---------------------------------- Item
 
 class ItemPhotos(BaseModel):
     thumbnail: Union[str, None] = None
+    thumbnail_id: Union[str, None] = None
     selected: Union[int, None] = None
     sources: Union[List[str], None] = None
 
@@ -101,6 +111,74 @@ class Item(ItemUpdate):
     class Config:
         orm_mode = True
 
+class ItemPage(BaseModel):
+    items: List[Item] = []
+    next_cursor: Union[str, None] = None
+
+class ItemFilter(BaseModel):
+    """Conditions on the items of a list, all of which must hold.
+    An item must have all the `tag_ids` and all the `location_ids`; the date and cost ranges are inclusive."""
+    is_active: Union[bool, None] = None
+    is_bookmarked: Union[bool, None] = None
+    is_silenced: Union[bool, None] = None
+    tag_ids: List[int] = []
+    location_ids: List[int] = []
+    expiration_date_from: Union[datetime.date, None] = None
+    expiration_date_to: Union[datetime.date, None] = None
+    cost_min: Union[int, None] = None
+    cost_max: Union[int, None] = None
+
+class ItemsBulk(BaseModel):
+    """An operation applied at once to several items.
+    The `add_tag` and `remove_tag` operations need a tag, the `move_location` operation needs a location."""
+    ids: List[int] = Field(..., max_items=1000)
+    operation: Literal['archive', 'restore', 'bookmark', 'unbookmark', 'delete', 'add_tag', 'remove_tag', 'move_location']
+    tag: Union[TagBase, None] = None
+    location: Union[LocationBase, None] = None
+
+class ItemsBulkResult(BaseModel):
+    revision: int
+    ids: List[int] = []
+
+#---------------------------------- Image
+
+class ImageStatus(BaseModel):
+    filename: str
+    variants: Dict[str, bool]
+    # The variants could not be created (e.g., the image data is corrupt)
+    failed: bool = False
+
+#---------------------------------- Stats
+
+class StatsEntry(BaseModel):
+    """The number and the total cost of the items with a tag or location."""
+    id: int
+    name: str
+    count: int
+    cost: int
+
+class Stats(BaseModel):
+    active_count: int = 0
+    active_cost: int = 0
+    archived_count: int = 0
+    archived_cost: int = 0
+    tags: List[StatsEntry] = []
+    locations: List[StatsEntry] = []
+
+#---------------------------------- Changes
+
+class Deletions(BaseModel):
+    items: List[int] = []
+    tags: List[int] = []
+    locations: List[int] = []
+
+class Changes(BaseModel):
+    revision: int
+    items: List[Item] = []
+    tags: List[Tag] = []
+    locations: List[Location] = []
+    deleted: Deletions = Deletions()
+
 #---------------------------------- Item
 class Token(BaseModel):
     access_token: str
@@ -0,0 +1,248 @@
+"""Measure the throughput and the latencies (p50, p95, p99) of the main API endpoints.
+
+The application runs in-process, with its storage profile and writer, on a temporary DB
+(filled by `generate_data`) and photo directory. Each scenario sends a number of
+requests, with some of them in flight at once:
+login, item list (full and summary), item page, item, item creation and update, image upload, tags and locations.
+
+The results can be saved as a baseline, and compared with a baseline saved before (e.g., on the main branch):
+the command then exits with 1 if a scenario got slower (p95) or handled fewer requests per second
+than the baseline, by more than the tolerance.
+
+    python -m backend.scripts.benchmark_api [--items 10000] [--requests 100] [--concurrency 10]
+        [--scenarios list,item] [--save-baseline FILE] [--baseline FILE] [--tolerance 0.25]
+"""
+import argparse
+import asyncio
+from contextlib import contextmanager
+import io
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import httpx
+from PIL import Image
+
+from backend import database, metrics, models, photos, storage
+from backend.main import app
+from backend.scripts.benchmark_login import percentile
+from backend.scripts.generate_data import generate_data
+
+PASSWORD = 'benchmark'
+
+
+def make_jpeg(rng):
+    """Create a photo-sized JPEG, different each time (so that each upload is processed)."""
+    img = Image.new('RGB', (1600, 1200), tuple(rng.randrange(256) for _ in range(3)))
+    img.putpixel((rng.randrange(1600), rng.randrange(1200)), (255, 255, 255))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+@contextmanager
+def temporary_app(items: int, seed: int = 0):
+    """Run the application on a temporary DB, filled by `generate_data` with a user and its items,
+    and a temporary photo directory.
+    Yields the email of the user, whose password is PASSWORD.
+    The async engines must be closed, in the event loop of the requests, with `close_temporary_app`."""
+    photos_dir = photos.PHOTOS_DIR
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Not by changing the working directory: the image workers read the settings from it
+        photos.PHOTOS_DIR = os.path.join(tmp_dir, 'photos')
+        db_path = os.path.join(tmp_dir, 'benchmark.db')
+        engine = metrics.instrument_engine(storage.create_sync_engine(f'sqlite:///{db_path}'))
+        # The sessions of the requests and the writer use the temporary DB
+        database.AsyncSessionLocal.configure(
+            bind=metrics.instrument_engine(storage.create_read_engine(f'sqlite+aiosqlite:///{db_path}')))
+        database.writer.engine = metrics.instrument_engine(storage.create_write_engine(f'sqlite+aiosqlite:///{db_path}'))
+        try:
+            models.Base.metadata.create_all(bind=engine)
+            emails, _ = generate_data(engine, items=items, seed=seed, password=PASSWORD)
+            yield emails[0]
+            photos.shutdown_image_pool()
+            photos.shutdown_deletion_worker()
+        finally:
+            engine.dispose()
+            photos.PHOTOS_DIR = photos_dir
+
+async def close_temporary_app():
+    await database.writer.close()
+    await database.AsyncSessionLocal.kw['bind'].dispose()
+    await database.writer.engine.dispose()
+
+class Scenarios:
+    """The requests of the scenarios; each method sends one request and returns the response."""
+
+    def __init__(self, client, headers, email: str, items: int, rng):
+        self.client = client
+        self.headers = headers
+        self.email = email
+        self.items = items
+        self.rng = rng
+        self.images = []
+
+    def random_item_id(self):
+        return self.rng.randint(1, self.items)
+
+    async def login(self):
+        return await self.client.post('/api/token', data={'username': self.email, 'password': PASSWORD})
+
+    async def list(self):
+        return await self.client.get('/api/users/me/items/', headers=self.headers)
+
+    async def list_summary(self):
+        return await self.client.get('/api/users/me/items/', headers=self.headers, params={'summary': True})
+
+    async def page(self):
+        return await self.client.get('/api/users/me/items/page', headers=self.headers, params={'limit': 50})
+
+    async def item(self):
+        return await self.client.get(f'/api/users/me/items/{self.random_item_id()}', headers=self.headers)
+
+    async def create(self):
+        return await self.client.post('/api/users/me/items/', headers=self.headers, json={
+            'name': f'Benchmark item {self.rng.randrange(1000000)}', 'photos': {'sources': []},
+            'tags': [{'name': f'tag {self.rng.randint(1, 20)}'}], 'locations': [{'name': 'location 1'}]})
+
+    async def update(self):
+        return await self.client.post(f'/api/users/me/items/{self.random_item_id()}', headers=self.headers,
+                                      json={'name': f'Updated item {self.rng.randrange(1000000)}'})
+
+    async def upload(self):
+        # As the API asks (Retry-After), send the image again when the processing queue is full
+        image = self.images.pop()
+        while True:
+            response = await self.client.post(f'/api/users/me/items/{self.random_item_id()}/image',
+                headers=self.headers, params={'mode': 'sd'}, files={'file': ('photo.jpeg', image, 'image/jpeg')})
+            if response.status_code != 503:
+                return response
+            await asyncio.sleep(float(response.headers.get('Retry-After', 1)))
+
+    async def tags(self):
+        return await self.client.get('/api/users/me/tags/', headers=self.headers)
+
+    async def locations(self):
+        return await self.client.get('/api/users/me/locations/', headers=self.headers)
+
+SCENARIOS = ['login', 'list', 'list_summary', 'page', 'item', 'create', 'update', 'upload', 'tags', 'locations']
+
+async def measure(request, count: int, concurrency: int):
+    """Send `count` requests, with `concurrency` of them in flight.
+    Returns the latencies, the number of failed requests and the elapsed time."""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed_request():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await request()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[timed_request() for _ in range(count)])
+    return latencies, errors, time.perf_counter() - start
+
+async def run(args, email: str):
+    results = {}
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        response = await client.post('/api/token', data={'username': email, 'password': PASSWORD})
+        response.raise_for_status()
+        headers = {'Authorization': f'Bearer {response.json()["access_token"]}'}
+        scenarios = Scenarios(client, headers, email, args.items, random.Random(args.seed))
+
+        for name in args.scenarios:
+            # The logins are slow by design (password hashing): fewer of them are enough
+            count = max(args.concurrency, args.requests // 10) if name == 'login' else args.requests
+            if name == 'upload':
+                scenarios.images = [make_jpeg(scenarios.rng) for _ in range(count + args.concurrency)]
+            request = getattr(scenarios, name)
+            # Warm up (caches, connections)
+            await measure(request, args.concurrency, args.concurrency)
+
+            latencies, errors, elapsed = await measure(request, count, args.concurrency)
+            results[name] = {
+                'requests': count,
+                'errors': errors,
+                'throughput': count / elapsed,
+                'p50': 1000 * statistics.median(latencies),
+                'p95': 1000 * percentile(latencies, 0.95),
+                'p99': 1000 * percentile(latencies, 0.99),
+            }
+            report(name, results[name])
+    return results
+
+def report(name: str, result: dict, baseline: dict = None):
+    line = (f'{name:<14} n={result["requests"]:<5} err={result["errors"]:<3} '
+            f'{result["throughput"]:8.1f} req/s  p50={result["p50"]:7.1f} ms  '
+            f'p95={result["p95"]:7.1f} ms  p99={result["p99"]:7.1f} ms')
+    if baseline:
+        line += (f'  | p95 {100 * (result["p95"] / baseline["p95"] - 1):+5.0f}%  '
+                 f'req/s {100 * (result["throughput"] / baseline["throughput"] - 1):+5.0f}%')
+    print(line)
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Print the results next to the ones of a baseline, and return the scenarios that regressed."""
+    regressions = []
+    print(f'\nCompared with the baseline (tolerance {100 * tolerance:.0f}%):')
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            report(name, result)
+            continue
+        report(name, result, base)
+        if result['p95'] > base['p95'] * (1 + tolerance) or \
+                result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=10000, help='items of the benchmark user')
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario (a tenth for login)')
+    parser.add_argument('--concurrency', type=int, default=10, help='requests in flight')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f'among {",".join(SCENARIOS)}')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the data and of the requests')
+    parser.add_argument('--save-baseline', metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare the results with a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, as a fraction')
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(',')
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    parameters = {'items': args.items, 'requests': args.requests, 'concurrency': args.concurrency, 'seed': args.seed}
+    if baseline and baseline['parameters'] != parameters:
+        print(f'Warning: the baseline was measured with other parameters: {baseline["parameters"]}')
+
+    with temporary_app(args.items, args.seed) as email:
+        async def run_and_close():
+            try:
+                return await run(args, email)
+            finally:
+                await close_temporary_app()
+        results = asyncio.run(run_and_close())
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({'parameters': parameters, 'results': results}, baseline_file, indent=2)
+        print(f'Baseline saved to {args.save_baseline}')
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            raise SystemExit(f'Regressions: {", ".join(regressions)}')
+        print('No regression')
+
+if __name__ == '__main__':
+    main()
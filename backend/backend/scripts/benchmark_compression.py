@@ -0,0 +1,104 @@
+"""Measure the CPU time of compressing the API responses against the bytes it saves, by encoding and level.
+
+The bodies are the real responses of the application, on a temporary DB of generated data
+(see `benchmark_api.temporary_app`): the item list (full and summary), a page of items and an item.
+Each one is compressed as the middleware of the API does it, chunk by chunk, with the encodings available
+at a few levels; the level used by the API is marked.
+The latency of the full item list is also measured through the API, with and without compression.
+
+    python -m backend.scripts.benchmark_compression [--items 2000] [--repeat 5]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+from backend import compression
+from backend.main import app
+from backend.scripts.benchmark_api import PASSWORD, close_temporary_app, temporary_app
+
+LEVELS = {'zstd': (1, 3, 9), 'br': (1, 4, 9), 'gzip': (1, 6, 9)}
+# Chunks given to the compressor, like a streamed body
+CHUNK_SIZE = 64 * 1024
+
+BODIES = {
+    'list': ('/api/users/me/items/', {}),
+    'list_summary': ('/api/users/me/items/', {'summary': True}),
+    'page': ('/api/users/me/items/page', {'limit': 50}),
+    'item': ('/api/users/me/items/1', {}),
+}
+
+
+def compress(body: bytes, encoding: str, level: int):
+    compressor = compression.create_compressor(encoding, level)
+    chunks = [compressor.compress(body[start:start + CHUNK_SIZE]) for start in range(0, len(body), CHUNK_SIZE)]
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+def measure(func, repeat: int):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), result
+
+async def get_bodies(email: str, repeat: int):
+    """Get the uncompressed bodies, and the median latencies of the full item list by encoding."""
+    bodies, latencies = {}, {}
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        response = await client.post('/api/token', data={'username': email, 'password': PASSWORD})
+        response.raise_for_status()
+        client.headers['Authorization'] = f'Bearer {response.json()["access_token"]}'
+
+        for name, (url, params) in BODIES.items():
+            response = await client.get(url, params=params, headers={'Accept-Encoding': 'identity'})
+            response.raise_for_status()
+            bodies[name] = response.content
+
+        for encoding in ['identity'] + compression.AVAILABLE_ENCODINGS:
+            durations = []
+            for _ in range(repeat + 1):
+                start = time.perf_counter()
+                # The raw stream: the bytes as sent, not decoded by the client
+                async with client.stream('GET', BODIES['list'][0], headers={'Accept-Encoding': encoding}) as response:
+                    size = sum([len(chunk) async for chunk in response.aiter_raw()])
+                durations.append(time.perf_counter() - start)
+            # Without the first request (cold caches)
+            latencies[encoding] = (statistics.median(durations[1:]), size)
+    return bodies, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=2000, help='items of the user')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements (the median is shown)')
+    args = parser.parse_args()
+
+    with temporary_app(args.items) as email:
+        async def run_and_close():
+            try:
+                return await get_bodies(email, args.repeat)
+            finally:
+                await close_temporary_app()
+        bodies, latencies = asyncio.run(run_and_close())
+
+    print(f'Encodings: {", ".join(compression.AVAILABLE_ENCODINGS)} (threshold {compression.COMPRESSION_MIN_SIZE} bytes)')
+    for name, body in bodies.items():
+        print(f'\n{name}: {len(body) / 1024:.1f} KiB')
+        for encoding in compression.AVAILABLE_ENCODINGS:
+            for level in LEVELS[encoding]:
+                duration, compressed = measure(lambda: compress(body, encoding, level), args.repeat)
+                saved = len(body) - len(compressed)
+                marker = '*' if level == compression.LEVELS[encoding] else ' '
+                print(f'  {encoding:<5} {level:>2}{marker} {len(compressed) / 1024:9.1f} KiB  '
+                      f'ratio {len(body) / len(compressed):5.1f}  {1000 * duration:8.2f} ms  '
+                      f'{len(body) / duration / 1e6:7.1f} MB/s  {1e6 * duration / max(saved, 1) * 1024:7.1f} µs per KiB saved')
+
+    print(f'\nLatency of the item list through the API ({args.items} items):')
+    for encoding, (duration, size) in latencies.items():
+        print(f'  {encoding:<9} {1000 * duration:8.1f} ms  {size / 1024:9.1f} KiB sent')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Measure the latency of listing items while a burst of logins is being processed.
+
+The application runs in-process, against a temporary database, so the numbers
+show how much the (slow by design) password checks of the logins delay the
+other requests handled by the same worker.
+
+    python -m backend.scripts.benchmark_login [--requests 200] [--logins 20] [--concurrency 10]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend import crud, models, schemas
+from backend.main import api, app, get_db
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def list_items(client, headers, count, concurrency):
+    """Get the item list `count` times, with `concurrency` requests in flight, and return the latencies."""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed_request():
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.get('/api/users/me/items/', headers=headers)
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+    await asyncio.gather(*[timed_request() for _ in range(count)])
+    return latencies
+
+async def login(client):
+    response = await client.post('/api/token', data={'username': 'benchmark', 'password': 'benchmark'})
+    response.raise_for_status()
+    return response.json()['access_token']
+
+def report(title, latencies):
+    print(f'{title:<24} n={len(latencies):<5} '
+          f'p50={1000 * statistics.median(latencies):7.1f} ms  '
+          f'p95={1000 * percentile(latencies, 0.95):7.1f} ms  '
+          f'p99={1000 * percentile(latencies, 0.99):7.1f} ms  '
+          f'max={1000 * max(latencies):7.1f} ms')
+
+async def run(requests, logins, concurrency):
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        headers = {'Authorization': f'Bearer {await login(client)}'}
+
+        # Warm up (caches, connections)
+        await list_items(client, headers, concurrency, concurrency)
+
+        report('items', await list_items(client, headers, requests, concurrency))
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            list_items(client, headers, requests, concurrency),
+            *[login(client) for _ in range(logins)]
+        )
+        elapsed = time.perf_counter() - start
+        report(f'items + {logins} logins', results[0])
+        print(f'{logins} logins and {requests} item lists done in {elapsed:.2f} s')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='item list requests per measurement')
+    parser.add_argument('--logins', type=int, default=20, help='logins in the burst')
+    parser.add_argument('--concurrency', type=int, default=10, help='item list requests in flight')
+    parser.add_argument('--items', type=int, default=100, help='items of the benchmark user')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "benchmark.db")
+        engine = create_engine(f'sqlite:///{db_path}', connect_args={"check_same_thread": False})
+        models.Base.metadata.create_all(bind=engine)
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        async_engine = create_async_engine(f'sqlite+aiosqlite:///{db_path}')
+        async_session_factory = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                             bind=async_engine, class_=AsyncSession)
+
+        async def get_benchmark_db():
+            async with async_session_factory() as db:
+                yield db
+        api.dependency_overrides[get_db] = get_benchmark_db
+
+        db = session_factory()
+        user = crud.create_user(db, schemas.UserCreate(email='benchmark', password='benchmark', settings='{}'))
+        for i in range(args.items):
+            crud.create_user_item(db, schemas.ItemCreate(
+                name=f'Item {i}',
+                description='Lorem ipsum dolor sit amet, consectetur adipiscing elit.',
+                photos=schemas.ItemPhotos(sources=[]),
+                tags=[schemas.TagBase(name=f'tag {i % 5}')],
+                locations=[schemas.LocationBase(name=f'location {i % 3}')],
+            ), user.id)
+        db.close()
+
+        async def run_and_dispose():
+            await run(args.requests, args.logins, args.concurrency)
+            await async_engine.dispose()
+        asyncio.run(run_and_dispose())
+        engine.dispose()
+
+if __name__ == '__main__':
+    main()
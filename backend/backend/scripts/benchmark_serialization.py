@@ -0,0 +1,93 @@
+"""Measure the cost of turning the item list into a JSON response body, before and after the fast path.
+
+- before: `jsonable_encoder` over the ORM items, `json.loads` of the photos text, validation of the result
+  against the response model and encoding of it again, by FastAPI, with the standard `json` module;
+- after: parsing of the photos text with orjson (done by the JSON column when the items are read),
+  `create_serializable_item` and `ORJSONResponse`.
+
+The items are built in memory, so the numbers do not include any DB access.
+
+    python -m backend.scripts.benchmark_serialization [--items 10000] [--repeat 5]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import statistics
+import time
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+import orjson
+from sqlalchemy.orm.attributes import set_committed_value
+
+from backend import models, schemas
+from backend.main import create_serializable_item
+
+
+def make_items(count: int):
+    """Create items like the ones of a real inventory, with their photos as stored in the DB (JSON text)."""
+    tags = [models.Tag(id=index, name=f'tag {index}') for index in range(20)]
+    locations = [models.Location(id=index, name=f'location {index}') for index in range(10)]
+    items, photos_texts = [], []
+    for index in range(count):
+        item_db = models.Item(
+            id=index, name=f'Item {index}', description='A thing kept somewhere in the house',
+            quantity=1, cost=index % 100, expiration_date=datetime.date(2024, 1, 1) if index % 3 else None,
+            code=f'C{index}', is_active=index % 4 != 0, is_bookmarked=index % 7 == 0, is_silenced=False,
+            addition_date=datetime.date(2023, 1, 1), removal_date=None, revision=1, owner_id=1,
+        )
+        # As loaded from the DB (without the backrefs of the tags and locations)
+        set_committed_value(item_db, 'tags', [tags[index % 20], tags[(index * 7 + 1) % 20]] if index % 5 else [])
+        set_committed_value(item_db, 'locations', [locations[index % 10]])
+        items.append(item_db)
+        photos_texts.append(json.dumps({'thumbnail_id': f'{index:032x}', 'selected': 0, 'sources': [f'{index:064x}']}))
+    return items, photos_texts
+
+def serialize_before(items: list, photos_texts: list, field):
+    for item_db, photos_text in zip(items, photos_texts):
+        item_db.photos = photos_text
+    content = []
+    for item_db in items:
+        serializable_item = jsonable_encoder(item_db)
+        serializable_item['photos'] = json.loads(serializable_item['photos'])
+        content.append(serializable_item)
+    content = asyncio.run(serialize_response(field=field, response_content=content))
+    return JSONResponse(content).body
+
+def serialize_after(items: list, photos_texts: list):
+    for item_db, photos_text in zip(items, photos_texts):
+        item_db.photos = orjson.loads(photos_text)
+    return ORJSONResponse([create_serializable_item(item_db) for item_db in items]).body
+
+def measure(func, repeat: int):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = func()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), body
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=10000, help='items in the list')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements (the median is shown)')
+    args = parser.parse_args()
+
+    items, photos_texts = make_items(args.items)
+    field = create_response_field(name='Response_get_user_items', type_=List[schemas.Item])
+
+    before, body_before = measure(lambda: serialize_before(items, photos_texts, field), args.repeat)
+    after, body_after = measure(lambda: serialize_after(items, photos_texts), args.repeat)
+    if json.loads(body_before) != json.loads(body_after):
+        raise SystemExit('The responses differ')
+
+    print(f'{args.items} items, {len(body_after) / 1024:.0f} KiB')
+    print(f'before: {1000 * before:8.1f} ms')
+    print(f'after:  {1000 * after:8.1f} ms ({before / after:.1f}x faster)')
+
+if __name__ == '__main__':
+    main()
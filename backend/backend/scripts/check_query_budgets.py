@@ -0,0 +1,175 @@
+"""Check the SQL statements run by each endpoint of the application against its query budget.
+
+Each endpoint declares the most statements a request may run (see `metrics.query_budget`).
+The application runs in-process, on a temporary DB of generated data (see `benchmark_api.temporary_app`),
+and requests are sent to every endpoint, one at a time. A request fails the check if it runs more
+statements than the budget of its endpoint, if it runs a statement more than `metrics.REPEAT_LIMIT` times
+(an N+1 pattern, e.g., a query per item) or if it lazily loads a relationship (e.g., while serializing).
+An endpoint without a budget, or not requested, fails the check as well.
+
+Exits with 1 if a check fails.
+
+    python -m backend.scripts.check_query_budgets [--items 200] [--verbose]
+"""
+import argparse
+import asyncio
+import base64
+import io
+import secrets
+
+from fastapi.routing import APIRoute
+import httpx
+from PIL import Image
+from starlette.routing import Match
+
+from backend import metrics
+from backend.main import api, app
+from backend.scripts.benchmark_api import PASSWORD, close_temporary_app, temporary_app
+
+
+def make_jpeg(size: int):
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), (200, 120, 40)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def get_requests(context: dict):
+    """Get the requests of the check, as (method, URL, keyword arguments of the client),
+    given the IDs found or created by the preparation (see `prepare`)."""
+    item_id, image_id, thumbnail_id = context['item_id'], context['image_id'], context['thumbnail_id']
+    item_ids, tag_ids, location_ids = context['item_ids'], context['tag_ids'], context['location_ids']
+    return [
+        ('POST', '/api/token', {'data': {'username': context['email'], 'password': PASSWORD}}),
+        ('POST', '/api/users/', {'json': {'email': 'budget@example.com', 'password': 'budget', 'settings': '{}'}}),
+        ('GET', '/api/users/me', {}),
+        ('POST', '/api/users/me/items/', {'json': {
+            'name': 'Budget item', 'photos': {'sources': []},
+            'tags': [{'name': 'tag 1'}, {'name': 'new tag'}], 'locations': [{'name': 'new location'}]}}),
+        ('GET', '/api/users/me/items/', {}),
+        ('GET', '/api/users/me/items/', {'params': {'summary': True}}),
+        ('GET', '/api/users/me/items/', {'params': {'tag_ids': tag_ids[:2], 'is_active': True}}),
+        ('GET', '/api/users/me/items/page', {'params': {'limit': 20}}),
+        ('GET', '/api/users/me/items/page', {'params': {'limit': 20, 'summary': True, 'location_ids': location_ids[:1]}}),
+        ('GET', '/api/users/me/items/search', {'params': {'q': 'chair'}}),
+        ('POST', '/api/users/me/items/bulk', {'json': {'ids': item_ids[1:4], 'operation': 'add_tag', 'tag': {'name': 'tag 2'}}}),
+        ('POST', '/api/users/me/items/bulk', {'json': {'ids': item_ids[4:6], 'operation': 'delete'}}),
+        ('GET', f'/api/users/me/items/{item_id}', {}),
+        ('POST', f'/api/users/me/items/{item_id}', {'json': {
+            'name': 'Renamed', 'tags': [{'name': 'tag 3'}], 'locations': [{'name': 'location 2'}],
+            'photos': {'sources': [image_id], 'selected': 0}}}),
+        ('DELETE', f'/api/users/me/items/{item_ids[6]}', {}),
+        ('POST', '/api/items/', {'params': {'name': 'thing'}}),
+        ('GET', f'/api/users/me/items/{item_id}/image/{image_id}', {}),
+        ('GET', f'/api/users/me/items/{item_id}/image/{image_id}/status', {}),
+        ('GET', f'/api/users/me/items/{item_id}/thumbnail/{thumbnail_id}', {}),
+        ('POST', f'/api/users/me/items/{item_id}/image', {
+            'params': {'mode': 'sd'}, 'files': {'file': ('photo.jpeg', make_jpeg(900), 'image/jpeg')}}),
+        ('GET', '/api/users/me/tags/', {}),
+        ('POST', f'/api/users/me/tags/{tag_ids[0]}', {'json': {'name': 'renamed tag'}}),
+        ('GET', '/api/users/me/locations/', {}),
+        ('POST', f'/api/users/me/locations/{location_ids[0]}', {'json': {'name': 'renamed location'}}),
+        ('GET', '/api/users/me/stats', {}),
+        ('GET', '/api/users/me/changes', {'params': {'since': 0}}),
+        ('GET', '/metrics', {'headers': {'Authorization': f'Bearer {metrics.METRICS_TOKEN}'}}),
+    ]
+
+async def prepare(client, email: str):
+    """Log in, find the items, tags and locations of the user, upload an image and give an item a thumbnail,
+    for the requests of the check."""
+    response = await client.post('/api/token', data={'username': email, 'password': PASSWORD})
+    response.raise_for_status()
+    client.headers['Authorization'] = f'Bearer {response.json()["access_token"]}'
+
+    response = await client.get('/api/users/me')
+    response.raise_for_status()
+    tag_ids = sorted(tag['id'] for tag in response.json()['tags'])
+    location_ids = sorted(location['id'] for location in response.json()['locations'])
+    response = await client.get('/api/users/me/items/', params={'summary': True})
+    response.raise_for_status()
+    item_ids = sorted(item['id'] for item in response.json())
+
+    item_id = item_ids[0]
+    response = await client.post(f'/api/users/me/items/{item_id}/image', params={'mode': 'sd'},
+                                 files={'file': ('photo.jpeg', make_jpeg(800), 'image/jpeg')})
+    response.raise_for_status()
+    image_id = response.json()['filename']
+    response = await client.post(f'/api/users/me/items/{item_id}', json={'photos': {
+        'sources': [image_id], 'selected': 0, 'thumbnail': base64.b64encode(make_jpeg(80)).decode()}})
+    response.raise_for_status()
+    thumbnail_id = response.json()['photos']['thumbnail_id']
+    # Wait for the image variants
+    response = await client.get(f'/api/users/me/items/{item_id}/image/{image_id}')
+    response.raise_for_status()
+    return {'email': email, 'item_id': item_id, 'image_id': image_id, 'thumbnail_id': thumbnail_id,
+            'item_ids': item_ids, 'tag_ids': tag_ids, 'location_ids': location_ids}
+
+def find_route(method: str, url: str):
+    """Get the endpoint route of a request."""
+    scope = {'type': 'http', 'method': method, 'path': url.split('?')[0]}
+    routes = app.router.routes
+    if scope['path'].startswith('/api/'):
+        scope['path'] = scope['path'][len('/api'):]
+        routes = api.router.routes
+    for route in routes:
+        if isinstance(route, APIRoute) and route.matches(scope)[0] == Match.FULL:
+            return route
+    raise SystemExit(f'No route for {method} {url}')
+
+async def run(email: str, verbose: bool):
+    failures = []
+    checked_routes = set()
+    async with httpx.AsyncClient(app=app, base_url='http://budget') as client:
+        context = await prepare(client, email)
+        for method, url, kwargs in get_requests(context):
+            route = find_route(method, url)
+            checked_routes.add(id(route))
+            budget = getattr(route.endpoint, 'query_budget', None)
+
+            with metrics.track_queries() as query_log:
+                response = await client.request(method, url, **kwargs)
+            statements = len(query_log.statements)
+            print(f'{method:<6} {route.path:<50} {statements:>3} / {budget if budget is not None else "-"}'
+                  f'  ({response.status_code})')
+            if verbose:
+                for statement in query_log.statements:
+                    print('       ', ' '.join(statement.split())[:160])
+
+            if response.status_code >= 400:
+                failures.append(f'{method} {url}: status {response.status_code}')
+            if budget is None:
+                failures.append(f'{method} {route.path}: no query budget ({statements} statements)')
+            try:
+                query_log.check(budget if budget is not None else statements)
+            except metrics.QueryBudgetException as exception:
+                failures.append(f'{method} {url}: {exception}')
+
+    for routes in (api.router.routes, app.router.routes):
+        for route in routes:
+            if isinstance(route, APIRoute) and id(route) not in checked_routes:
+                failures.append(f'{",".join(sorted(route.methods))} {route.path}: not checked')
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=200, help='items of the user')
+    parser.add_argument('--verbose', action='store_true', help='show the statements of each request')
+    args = parser.parse_args()
+
+    # /metrics is only served with a token
+    metrics.METRICS_TOKEN = metrics.METRICS_TOKEN or secrets.token_hex(16)
+    with temporary_app(args.items) as email:
+        async def run_and_close():
+            try:
+                return await run(email, args.verbose)
+            finally:
+                await close_temporary_app()
+        failures = asyncio.run(run_and_close())
+
+    if failures:
+        print('\nFailed checks:')
+        for failure in failures:
+            print(f'- {failure}')
+        raise SystemExit(1)
+    print('\nAll the endpoints are within their query budget')
+
+if __name__ == '__main__':
+    main()
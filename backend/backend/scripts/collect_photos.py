@@ -0,0 +1,60 @@
+"""Remove the photo files (images and thumbnails) that no item refers to anymore.
+
+The files of the photos removed from the items are deleted after each commit; orphans are left by
+the failures in between (e.g., a crash before the deletion, a rolled back change after a thumbnail was saved).
+The files changed recently, and the images uploaded again (see `photos.UPLOAD_PIN_TIME`), are kept,
+since their items may not be saved yet.
+
+    python -m backend.scripts.collect_photos [--email EMAIL] [--grace 3600] [--batch-size 500] [--pause 0.1] [--dry-run]
+"""
+import argparse
+import time
+
+from backend import crud, photos
+from backend.database import SessionLocal
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--email', help='collect the files of this user only')
+    parser.add_argument('--grace', type=float, default=3600, help='age (in seconds) under which files are kept')
+    parser.add_argument('--batch-size', type=int, default=500, help='files removed at once')
+    parser.add_argument('--pause', type=float, default=0.1,
+                        help='wait (in seconds) between batches, to leave the disk to the application')
+    parser.add_argument('--dry-run', action='store_true', help='only show the orphan files')
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.email:
+            db_user = crud.get_user_by_email(db, args.email)
+            if db_user is None:
+                raise SystemExit(f'User {args.email} not found')
+            user_ids = [db_user.id]
+        else:
+            user_ids = photos.list_user_ids()
+
+        total_images, total_thumbnails = 0, 0
+        for user_id in user_ids:
+            # The references are read before the files are listed: a file saved in between is recent
+            image_ids, thumbnail_ids = crud.get_photo_files(db, user_id)
+            db.rollback()
+            orphan_images, orphan_thumbnails = photos.find_orphan_files(user_id, image_ids, thumbnail_ids, args.grace)
+            for file_id in orphan_images + orphan_thumbnails:
+                print(f'{user_id}: {file_id}')
+            if not args.dry_run:
+                for start in range(0, len(orphan_images), args.batch_size):
+                    photos.delete_files(user_id, image_ids=orphan_images[start:start + args.batch_size])
+                    time.sleep(args.pause)
+                for start in range(0, len(orphan_thumbnails), args.batch_size):
+                    photos.delete_files(user_id, thumbnail_ids=orphan_thumbnails[start:start + args.batch_size])
+                    time.sleep(args.pause)
+            total_images += len(orphan_images)
+            total_thumbnails += len(orphan_thumbnails)
+    finally:
+        db.close()
+    action = 'found' if args.dry_run else 'removed'
+    print(f'{total_images} orphan images and {total_thumbnails} orphan thumbnails {action}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Fill the DB with generated users, each with items, tags, locations and photo references.
+
+The data only depends on the parameters and on the seed, so a benchmark can be repeated on the same data.
+The rows are inserted with Core `executemany`, in chunks, instead of with the `crud` functions;
+the stats are then computed from the items. The photos are only references: no image file is written.
+The users are `user<N>@example.com` (N from 1), with the password given.
+
+    python -m backend.scripts.generate_data [--users 1] [--items 1000] [--tags 20] [--locations 10]
+        [--photos 2] [--seed 0] [--password test]
+"""
+import argparse
+from collections import Counter
+import datetime
+import hashlib
+import random
+import time
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from backend import crud, models, photos, security
+from backend.database import engine
+
+CHUNK_SIZE = 10000
+
+THINGS = ['Car', 'Bicycle', 'Wallet', 'Blouse', 'Bag', 'Shirt', 'Helmet', 'Toothbrush', 'Key', 'Table', 'Coin',
+          'Trousers', 'Sweater', 'Shoe', 'Cupboard', 'Pillow', 'Coffee maker', 'Bed', 'Spoon', 'Blanket', 'Knife',
+          'Stove', 'Pot', 'Dish', 'Sofa', 'Stool', 'Cup', 'Fork', 'Glass', 'Pen', 'Computer', 'Notebook', 'Desk',
+          'Pencil', 'Bookcase', 'Book', 'Chair', 'Backpack', 'Paper', 'Glue', 'Ruler', 'Clock', 'Lamp', 'Drill']
+QUALITIES = ['old', 'new', 'red', 'blue', 'small', 'large', 'spare', 'broken', 'wooden', 'steel', 'vintage', 'cheap']
+DESCRIPTION = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore.'
+
+
+def get_next_id(connection, table):
+    return (connection.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+def insert_rows(connection, table, rows: list):
+    """Insert rows with `executemany`, CHUNK_SIZE rows at a time."""
+    for start in range(0, len(rows), CHUNK_SIZE):
+        connection.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+def generate_user_data(rng, user_id: int, next_ids: dict, items: int, tags: int, locations: int, max_photos: int):
+    """Generate the rows of the tags, locations, items (and their links) and photos of a user.
+    The IDs are assigned from `next_ids`, which is updated."""
+    today = datetime.date.today()
+    rows = {'tags': [], 'locations': [], 'items': [], 'item_tags': [], 'item_locations': [], 'photos': []}
+
+    tag_ids, location_ids = [], []
+    for kind, count, object_ids in (('tags', tags, tag_ids), ('locations', locations, location_ids)):
+        for index in range(count):
+            object_ids.append(next_ids[kind])
+            rows[kind].append({'id': next_ids[kind], 'name': f'{kind[:-1]} {index + 1}', 'revision': 0,
+                               'owner_id': user_id})
+            next_ids[kind] += 1
+
+    # Photos are shared by a few items, like the same picture of a set of things
+    image_ids = [photos.make_image_id(hashlib.sha256(f'{user_id}-{index}'.encode()).hexdigest())
+                 for index in range(max(1, items * max_photos // 4))]
+    photo_refs = Counter()
+
+    for revision in range(1, items + 1):
+        item_id = next_ids['items']
+        next_ids['items'] += 1
+        sources = rng.sample(image_ids, rng.randint(0, min(max_photos, len(image_ids))))
+        photo_refs.update(sources)
+        is_active = rng.random() < 0.85
+        addition_date = today - datetime.timedelta(days=rng.randrange(3 * 365))
+        rows['items'].append({
+            'id': item_id,
+            'name': f'{rng.choice(QUALITIES).capitalize()} {rng.choice(THINGS).lower()} {revision}',
+            'description': DESCRIPTION,
+            'quantity': rng.randint(1, 5),
+            'cost': rng.randint(0, 200),
+            'expiration_date': today + datetime.timedelta(days=rng.randrange(-30, 365)) if rng.random() < 0.3 else None,
+            'code': f'{user_id:04d}{revision:08d}' if rng.random() < 0.5 else None,
+            'photos': {'selected': 0 if sources else None, 'sources': sources, 'thumbnail_id': None},
+            'is_active': is_active,
+            'is_bookmarked': rng.random() < 0.1,
+            'is_silenced': rng.random() < 0.05,
+            'addition_date': addition_date,
+            'removal_date': None if is_active else addition_date + datetime.timedelta(days=rng.randrange(365)),
+            'revision': revision,
+            'owner_id': user_id,
+        })
+        for tag_id in rng.sample(tag_ids, rng.randint(0, min(3, len(tag_ids)))):
+            rows['item_tags'].append({'item_id': item_id, 'tag_id': tag_id})
+        for location_id in rng.sample(location_ids, rng.randint(min(1, len(location_ids)), min(2, len(location_ids)))):
+            rows['item_locations'].append({'item_id': item_id, 'location_id': location_id})
+
+    rows['photos'] = [{'image_id': image_id, 'ref_count': count, 'owner_id': user_id}
+                      for image_id, count in photo_refs.items()]
+    return rows
+
+def generate_data(db_engine, users: int = 1, items: int = 1000, tags: int = 20, locations: int = 10,
+                  max_photos: int = 2, seed: int = 0, password: str = 'test'):
+    """Add generated users and their data to a DB (see the module documentation).
+    Returns the emails of the users and the number of rows inserted."""
+    rng = random.Random(seed)
+    hashed_password = security.get_password_hash(password)
+    emails, row_count = [], 0
+
+    with db_engine.begin() as connection:
+        next_ids = {kind: get_next_id(connection, models.Base.metadata.tables[kind])
+                    for kind in ('users', 'items', 'tags', 'locations')}
+        for index in range(users):
+            user_id = next_ids['users']
+            next_ids['users'] += 1
+            email = f'user{user_id}@example.com'
+            connection.execute(models.User.__table__.insert(), {
+                'id': user_id, 'email': email, 'hashed_password': hashed_password, 'settings': '{}',
+                'is_active': True, 'creation_date': datetime.date.today(), 'revision': items,
+            })
+            emails.append(email)
+
+            rows = generate_user_data(rng, user_id, next_ids, items, tags, locations, max_photos)
+            # The links go in first: the full-text triggers then index each item once, with its tags and locations
+            # (the foreign keys are not enforced)
+            for table_name in ('tags', 'locations', 'item_tags', 'item_locations', 'items', 'photos'):
+                insert_rows(connection, models.Base.metadata.tables[table_name], rows[table_name])
+                row_count += len(rows[table_name])
+
+    db = Session(bind=db_engine)
+    try:
+        for email in emails:
+            crud.rebuild_item_stats(db, crud.get_user_by_email(db, email).id)
+    finally:
+        db.close()
+    return emails, row_count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1, help='users to add')
+    parser.add_argument('--items', type=int, default=1000, help='items per user')
+    parser.add_argument('--tags', type=int, default=20, help='tags per user (up to 3 per item)')
+    parser.add_argument('--locations', type=int, default=10, help='locations per user (1 or 2 per item)')
+    parser.add_argument('--photos', type=int, default=2, help='photos per item, at most')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random choices')
+    parser.add_argument('--password', default='test', help='password of the users')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    emails, row_count = generate_data(engine, args.users, args.items, args.tags, args.locations, args.photos,
+                                      args.seed, args.password)
+    elapsed = time.perf_counter() - start
+    print(f'{len(emails)} users ({emails[0]}...) and {row_count} rows inserted in {elapsed:.1f} s '
+          f'({60 * row_count / elapsed:.0f} rows/min)' if emails else 'No user added')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Write the compressed variants (gzip and brotli) of the frontend build, served by the application.
+
+To run at build time, after the build is copied (e.g., in the Docker image), with STATIC_PRECOMPRESS=false:
+the workers then do not compress the files at startup. The variants of unchanged files are kept.
+Prints the bytes of the files, uncompressed and with their smallest variant.
+
+    python -m backend.scripts.precompress_static [--directory app]
+"""
+import argparse
+import time
+
+from backend import static
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--directory', default='app', help='directory of the frontend build')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    sizes = static.precompress(args.directory)
+    elapsed = time.perf_counter() - start
+    total = sum(size for size, _ in sizes.values())
+    compressed = sum(min(variant_sizes.values(), default=size) for size, variant_sizes in sizes.values())
+    print(f'{len(sizes)} files compressed ({", ".join(static.ENCODINGS)}) in {elapsed:.1f} s: '
+          f'{total} bytes, {compressed} bytes with their smallest variant')
+
+if __name__ == '__main__':
+    main()
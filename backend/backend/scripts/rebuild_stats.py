@@ -0,0 +1,33 @@
+"""Compute again the item stats (counts and costs by status, tag and location) from the items.
+
+The stats are kept up to date by the item writes of the application; rebuilding them is only needed
+after the DB was changed by other means (e.g., by hand or by a restored backup).
+
+    python -m backend.scripts.rebuild_stats [--email EMAIL]
+"""
+import argparse
+
+from backend import crud
+from backend.database import SessionLocal
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--email', help='rebuild the stats of this user only')
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        user_id = None
+        if args.email:
+            db_user = crud.get_user_by_email(db, args.email)
+            if db_user is None:
+                raise SystemExit(f'User {args.email} not found')
+            user_id = db_user.id
+        crud.rebuild_item_stats(db, user_id)
+    finally:
+        db.close()
+    print(f'Stats rebuilt for {args.email or "all the users"}')
+
+if __name__ == '__main__':
+    main()
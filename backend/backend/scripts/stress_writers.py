@@ -0,0 +1,151 @@
+"""Write to one SQLite file from several processes, each with many concurrent writers,
+and check that no write fails (e.g., with `database is locked`).
+
+Each process plays the role of a uvicorn worker: it has its own read-only pool and
+writer (see `backend.storage`), and runs `--writers` coroutines that create and update
+items while reading the item list. Each process writes the items of its own user, or with `--shared-user`
+all of them write the items of the same user (so they create the same tags and locations).
+With `--baseline`, the processes use plain engines and threads instead, as the application did before
+the storage profile.
+
+    python -m backend.scripts.stress_writers [--processes 4] [--writers 50] [--writes 20] [--shared-user] [--baseline]
+
+The exit status is 1 if any write failed.
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from backend import crud, models, schemas, storage
+
+
+def make_item(process: int, writer: int, write: int):
+    return schemas.ItemCreate(
+        name=f'Item {process}-{writer}-{write}',
+        tags=[schemas.TagBase(name=f'tag {write % 5}')],
+        locations=[schemas.LocationBase(name=f'location {writer % 3}')],
+    )
+
+def write_item(db, process: int, writer: int, write: int, user_id: int):
+    """Create an item, and update it right away (i.e., two small commits)."""
+    db_item = crud.create_user_item(db, make_item(process, writer, write), user_id)
+    crud.update_user_item(db, db_item.id, schemas.ItemUpdate(is_bookmarked=True), user_id)
+
+async def run_process_async(db_path: str, process: int, writers: int, writes: int, user_id: int):
+    url = f'sqlite+aiosqlite:///{db_path}'
+    read_engine = storage.create_read_engine(url)
+    read_session_factory = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                        bind=read_engine, class_=AsyncSession)
+    write_engine = storage.create_write_engine(url)
+    writer = storage.Writer(write_engine)
+    errors = []
+
+    async def run_writer(writer_index):
+        for write in range(writes):
+            try:
+                await writer.run(write_item, process, writer_index, write, user_id)
+                async with read_session_factory() as db:
+                    await db.run_sync(crud.get_user_items_page, user_id, limit=20)
+            except DBAPIError as exception:
+                errors.append(str(exception.orig))
+
+    await asyncio.gather(*[run_writer(writer_index) for writer_index in range(writers)])
+    await writer.close()
+    await read_engine.dispose()
+    await write_engine.dispose()
+    return errors, writer.batches
+
+def run_process_baseline(db_path: str, process: int, writers: int, writes: int, user_id: int):
+    engine = create_engine(f'sqlite:///{db_path}', connect_args={"check_same_thread": False})
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    errors = []
+
+    def run_writer(writer_index):
+        for write in range(writes):
+            db = session_factory()
+            try:
+                write_item(db, process, writer_index, write, user_id)
+                crud.get_user_items_page(db, user_id, limit=20)
+            except DBAPIError as exception:
+                errors.append(str(exception.orig))
+            finally:
+                db.close()
+
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        list(executor.map(run_writer, range(writers)))
+    engine.dispose()
+    return errors, None
+
+def run_process(db_path: str, process: int, writers: int, writes: int, user_id: int, baseline: bool):
+    if baseline:
+        return run_process_baseline(db_path, process, writers, writes, user_id)
+    return asyncio.run(run_process_async(db_path, process, writers, writes, user_id))
+
+def stress(db_path: str, processes: int, writers: int, writes: int, shared_user: bool = False,
+           baseline: bool = False):
+    """Create a DB file with the users, and run the writers of the processes on it.
+    Returns the errors of the writes, the number of batches of the writers (None with `baseline`)
+    and the elapsed time."""
+    engine = storage.create_sync_engine(f'sqlite:///{db_path}')
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    user_ids = [
+        crud.create_user(db, schemas.UserCreate(email=f'stress{process}', password='', settings='{}'),
+                         hashed_password='').id
+        for process in range(1 if shared_user else processes)
+    ]
+    db.close()
+    engine.dispose()
+
+    start = time.perf_counter()
+    # The processes are started without a copy of the threads and connections of the current one
+    with multiprocessing.get_context('spawn').Pool(processes) as pool:
+        results = pool.starmap(run_process, [
+            (db_path, process, writers, writes, user_ids[0 if shared_user else process], baseline)
+            for process in range(processes)
+        ])
+    elapsed = time.perf_counter() - start
+
+    errors = [error for process_errors, _ in results for error in process_errors]
+    batches = None if baseline else sum(process_batches for _, process_batches in results)
+    return errors, batches, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4, help='processes (i.e., workers) writing to the DB')
+    parser.add_argument('--writers', type=int, default=50, help='concurrent writers per process')
+    parser.add_argument('--writes', type=int, default=20, help='items written by each writer')
+    parser.add_argument('--shared-user', action='store_true', help='write the items of the same user in all processes')
+    parser.add_argument('--baseline', action='store_true', help='use plain engines and threads')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'stress.db')
+        errors, batches, elapsed = stress(db_path, args.processes, args.writers, args.writes,
+                                          shared_user=args.shared_user, baseline=args.baseline)
+        engine = create_engine(f'sqlite:///{db_path}')
+        with engine.connect() as connection:
+            item_count = connection.exec_driver_sql('SELECT COUNT(*) FROM items').scalar()
+        engine.dispose()
+
+    writes = args.processes * args.writers * args.writes
+    print(f'{args.processes} processes x {args.writers} writers x {args.writes} writes: '
+          f'{item_count}/{writes} items in {elapsed:.2f} s ({2 * item_count / elapsed:.0f} commits/s)')
+    if not args.baseline:
+        print(f'{batches} batches ({2 * writes / max(1, batches):.1f} commits per batch)')
+    print(f'{len(errors)} failed writes')
+    for error in sorted(set(errors)):
+        print(f'  {errors.count(error)} x {error}')
+    raise SystemExit(1 if errors else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,12 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from decouple import Config, RepositoryEnv
+import functools
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
-DOTENV_FILE = './local/.env'
-config = Config(RepositoryEnv(DOTENV_FILE))
+from .cache import TTLCache
+from .config import config
 
 SECRET_KEY = config('SECRET_KEY')
 ALGORITHM = config('ALGORITHM', default='HS256')
@@ -12,6 +14,15 @@ ACCESS_TOKEN_EXPIRE_MINUTES = config('ACCESS_TOKEN_EXPIRE_MINUTES', default=60,
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Password hashing is slow (by design), so it runs on a few dedicated threads
+PASSWORD_WORKERS = config('PASSWORD_WORKERS', default=2, cast=int)
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix='password')
+
+# Authenticated users, by token
+AUTH_CACHE_SIZE = config('AUTH_CACHE_SIZE', default=1024, cast=int)
+AUTH_CACHE_TTL = config('AUTH_CACHE_TTL', default=60, cast=int)
+user_cache = TTLCache(max_size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
 class SecurityException(Exception):
     pass
 
@@ -34,6 +45,12 @@ def authenticate_user(user_db, password: str):
         return False
     return user_db
 
+async def run_password_task(func, *args):
+    """Run a task that hashes or verifies passwords on the password threads,
+    so that it does not block the event loop nor take all the request threads."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, functools.partial(func, *args))
+
 def create_access_token(data: dict, expires_delta = ACCESS_TOKEN_EXPIRE_MINUTES):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=expires_delta)
@@ -0,0 +1,214 @@
+"""Serving of the frontend build (the `app` directory).
+
+The compressible files are precompressed (gzip and brotli),
+next to the originals (e.g., `main.1a2b3c4d.js.gz`), either at startup or at build time
+(`scripts/precompress_static`); each request gets the smallest variant its `Accept-Encoding` allows.
+The fingerprinted files (e.g., `static/js/main.1a2b3c4d.js`) never change, so they are cached by the browsers
+for a year; the other ones (e.g., `index.html`) are revalidated with their ETag on each use.
+The small files are kept in memory, by each worker, instead of being read from the disk for each request.
+The paths without a file extension that match no file (the routes of the frontend, e.g., `/items/12`)
+get `index.html`, so that the frontend router handles them.
+"""
+import gzip
+import logging
+import mimetypes
+import os
+import os.path
+import re
+import stat
+import tempfile
+
+import anyio
+import brotli
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+from .cache import TTLCache
+from .compression import get_accepted_encodings
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+# Compress the files of the build when the application starts (not needed if done at build time)
+STATIC_PRECOMPRESS = config('STATIC_PRECOMPRESS', default=True, cast=bool)
+# Files kept in memory (entries, seconds, largest file in bytes)
+STATIC_CACHE_SIZE = config('STATIC_CACHE_SIZE', default=128, cast=int)
+STATIC_CACHE_TTL = config('STATIC_CACHE_TTL', default=60, cast=int)
+STATIC_CACHE_MAX_FILE_SIZE = config('STATIC_CACHE_MAX_FILE_SIZE', default=256 * 1024, cast=int)
+
+COMPRESSIBLE_EXTENSIONS = ('.html', '.js', '.css', '.json', '.map', '.svg', '.txt', '.ico', '.xml', '.webmanifest')
+# Smaller files are not worth a variant
+MIN_COMPRESS_SIZE = 1024
+# By order of preference, with the file extension of their variants
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+# File names with a content hash (e.g., `main.1a2b3c4d.js`, `roboto-latin-400-normal.f5ac4e2d3b0d3c2a1b9e.woff2`)
+FINGERPRINT_PATTERN = re.compile(r'\.[0-9a-f]{8,}\.')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+#------------------------------------------ Precompression
+
+def compress(data: bytes, encoding: str):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def write_variant(path: str, data: bytes, mode: int):
+    """Write a file atomically, so that other workers never serve it partially written."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as variant_file:
+            variant_file.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def precompress(directory: str):
+    """Write the compressed variants of the compressible files of a directory, unless up to date.
+    Only the variants smaller than their original are kept.
+    Returns the original and compressed sizes of the files, as {path: (size, {encoding: size})}."""
+    sizes = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            stat_result = os.stat(path)
+            if stat_result.st_size < MIN_COMPRESS_SIZE:
+                continue
+            data = None
+            variant_sizes = {}
+            for encoding in ENCODINGS:
+                variant_path = path + ENCODINGS[encoding]
+                try:
+                    variant_stat = os.stat(variant_path)
+                    if variant_stat.st_mtime >= stat_result.st_mtime:
+                        variant_sizes[encoding] = variant_stat.st_size
+                        continue
+                except FileNotFoundError:
+                    pass
+                if data is None:
+                    with open(path, 'rb') as original_file:
+                        data = original_file.read()
+                compressed = compress(data, encoding)
+                if len(compressed) >= len(data):
+                    continue
+                try:
+                    write_variant(variant_path, compressed, stat.S_IMODE(stat_result.st_mode))
+                except OSError:
+                    logger.warning('Compressed variant not written: %s', variant_path)
+                    continue
+                variant_sizes[encoding] = len(compressed)
+            sizes[path] = (stat_result.st_size, variant_sizes)
+    return sizes
+
+def find_variants(directory: str):
+    """Get the compressed variants of the files of a directory, as {path: (mtime, {encoding: (path, stat)})}.
+    A variant is only served while its original has the same modification time as when it was found."""
+    variants = {}
+    # The paths are looked up by StaticFiles with the symbolic links resolved
+    for root, _, filenames in os.walk(os.path.realpath(directory)):
+        for filename in filenames:
+            if not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, filename)
+            stat_result = os.stat(path)
+            encodings = {}
+            for encoding in ENCODINGS:
+                variant_path = path + ENCODINGS[encoding]
+                try:
+                    variant_stat = os.stat(variant_path)
+                except FileNotFoundError:
+                    continue
+                if variant_stat.st_mtime >= stat_result.st_mtime:
+                    encodings[encoding] = (variant_path, variant_stat)
+            if encodings:
+                variants[path] = (stat_result.st_mtime, encodings)
+    return variants
+
+#------------------------------------------ Serving
+
+def read_file(path: str):
+    with open(path, 'rb') as file:
+        return file.read()
+
+class PrecompressedStaticFiles(StaticFiles):
+    """Static files served with their compressed variants and caching headers (see the module documentation).
+    Responses of small files are kept in `cache`, by path and accepted encodings."""
+
+    def __init__(self, *, directory: str, html: bool = False, precompress_files: bool = STATIC_PRECOMPRESS,
+                 cache_size: int = STATIC_CACHE_SIZE, cache_ttl: int = STATIC_CACHE_TTL,
+                 max_cached_file_size: int = STATIC_CACHE_MAX_FILE_SIZE, **kwargs):
+        super().__init__(directory=directory, html=html, **kwargs)
+        self.variants = {}
+        if os.path.isdir(directory):
+            if precompress_files:
+                precompress(directory)
+            self.variants = find_variants(directory)
+        self.cache = TTLCache(cache_size, cache_ttl) if cache_size > 0 else None
+        self.max_cached_file_size = max_cached_file_size
+
+    async def get_file_response(self, path: str, scope) -> Response:
+        """Get the response of a path, or of `index.html` for a route of the frontend."""
+        try:
+            return await super().get_response(path, scope)
+        except HTTPException as exception:
+            if exception.status_code != 404 or not self.html or os.path.splitext(path)[1]:
+                raise
+        return await super().get_response('index.html', scope)
+
+    async def get_response(self, path: str, scope) -> Response:
+        if self.cache is None or scope['method'] != 'GET':
+            return await self.get_file_response(path, scope)
+
+        request_headers = Headers(scope=scope)
+        key = (path, get_accepted_encodings(request_headers, ENCODINGS))
+        cached = self.cache.get(key)
+        if cached is None:
+            response = await self.get_file_response(path, scope)
+            if not isinstance(response, FileResponse) or response.status_code != 200 or \
+                    response.stat_result.st_size > self.max_cached_file_size:
+                return response
+            content = await anyio.to_thread.run_sync(read_file, response.path)
+            if len(content) != response.stat_result.st_size:
+                # Changed since its lookup
+                return response
+            cached = (content, dict(response.headers))
+            self.cache.set(key, cached)
+
+        content, headers = cached
+        if self.is_not_modified(Headers(headers), request_headers):
+            return NotModifiedResponse(Headers(headers))
+        return Response(content, headers=headers)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        """Get the response of a file, with its smallest variant accepted and its caching headers."""
+        request_headers = Headers(scope=scope)
+        media_type = mimetypes.guess_type(str(full_path))[0] or 'text/plain'
+        encoding = None
+        file_variants = self.variants.get(str(full_path))
+        if file_variants is not None and file_variants[0] == stat_result.st_mtime:
+            for accepted_encoding in get_accepted_encodings(request_headers, ENCODINGS):
+                if accepted_encoding in file_variants[1]:
+                    encoding = accepted_encoding
+                    full_path, stat_result = file_variants[1][encoding]
+                    break
+
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, method=scope['method'],
+                                media_type=media_type)
+        if FINGERPRINT_PATTERN.search(os.path.basename(str(full_path))):
+            response.headers['cache-control'] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers['cache-control'] = REVALIDATE_CACHE_CONTROL
+        if file_variants is not None:
+            response.headers['vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            response.headers['content-encoding'] = encoding
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
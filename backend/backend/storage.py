@@ -0,0 +1,225 @@
+"""SQLite storage profile.
+
+The DB file is shared by all the workers of the application, so:
+- every connection enables WAL (readers do not block on the writer and vice-versa),
+  waits for locks instead of failing at once, and uses a larger page cache and memory mapped I/O;
+- reads go through a pool of read-only connections;
+- writes of a process go through a single connection, one batch at a time (see `Writer`).
+  Write transactions start with BEGIN IMMEDIATE, so a transaction takes the write lock
+  (waiting up to SQLITE_BUSY_TIMEOUT for other processes) before it reads what it will change.
+"""
+import asyncio
+import contextvars
+import logging
+
+import orjson
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from .config import config
+
+SQLITE_BUSY_TIMEOUT = config('SQLITE_BUSY_TIMEOUT', default=10000, cast=int)  # ms
+SQLITE_MMAP_SIZE = config('SQLITE_MMAP_SIZE', default=256 * 1024 * 1024, cast=int)  # bytes
+SQLITE_CACHE_SIZE = config('SQLITE_CACHE_SIZE', default=16 * 1024, cast=int)  # KiB per connection
+SQLITE_READ_POOL_SIZE = config('SQLITE_READ_POOL_SIZE', default=8, cast=int)
+WRITE_BATCH_SIZE = config('WRITE_BATCH_SIZE', default=32, cast=int)
+# Waits of SQLITE_BUSY_TIMEOUT for the write lock before the jobs of a batch fail
+WRITE_LOCK_ATTEMPTS = config('WRITE_LOCK_ATTEMPTS', default=3, cast=int)
+
+logger = logging.getLogger(__name__)
+
+#------------------------------------------ Engines
+
+def set_pragmas(dbapi_connection, read_only: bool = False):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # In WAL mode, NORMAL only syncs at checkpoints: a commit stays atomic and durable across crashes
+    # of the application, only a power loss can roll back the last commits.
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+    cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE}')
+    if read_only:
+        cursor.execute('PRAGMA query_only=ON')
+    cursor.close()
+
+def configure_engine(engine, read_only: bool = False):
+    """Apply the storage profile to the connections of an (async) engine.
+    Unless the engine is read-only, its transactions start with BEGIN IMMEDIATE."""
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        set_pragmas(dbapi_connection, read_only=read_only)
+        if not read_only:
+            # Let SQLAlchemy emit BEGIN, instead of the driver
+            dbapi_connection.isolation_level = None
+
+    if not read_only:
+        @event.listens_for(sync_engine, 'begin')
+        def on_begin(connection):
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return engine
+
+def serialize_json(value):
+    return orjson.dumps(value).decode()
+
+# The JSON columns (e.g., the photos of the items) are encoded and parsed with orjson
+JSON_OPTIONS = {'json_serializer': serialize_json, 'json_deserializer': orjson.loads}
+
+def create_sync_engine(url: str):
+    """Create the engine of the scripts (e.g., `sqlite:///./local/backend.db`)."""
+    return configure_engine(create_engine(url, connect_args={"check_same_thread": False}, **JSON_OPTIONS))
+
+def create_read_engine(url: str):
+    """Create the engine of the read-only connection pool (e.g., `sqlite+aiosqlite:///./local/backend.db`)."""
+    return configure_engine(create_async_engine(
+        url, poolclass=AsyncAdaptedQueuePool, pool_size=SQLITE_READ_POOL_SIZE, max_overflow=0, **JSON_OPTIONS
+    ), read_only=True)
+
+def create_write_engine(url: str):
+    """Create the engine of the writer, which uses a single connection."""
+    return configure_engine(create_async_engine(
+        url, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0, **JSON_OPTIONS
+    ))
+
+#------------------------------------------ Writer
+
+class WriterClosedException(Exception):
+    pass
+
+class Writer:
+    """The write path of a process: write jobs run one after another, on a single connection.
+
+    A job is a function that gets a (synchronous) Session as its first argument, e.g., a `crud` function.
+    The jobs queued while a batch is being written form the next batch: each job runs in a savepoint,
+    and the batch is committed once, so that a burst of small writes costs a single commit.
+    A `commit()` of a job only releases its savepoint, and a failing job only rolls back its own changes.
+    Work that must wait for the changes to be in the DB is registered with `crud.after_commit`.
+    If another process keeps the write lock for WRITE_LOCK_ATTEMPTS waits, the jobs of the batch fail
+    with the `OperationalError`; the jobs still running or queued when the writer is closed fail as well.
+    """
+
+    def __init__(self, engine, batch_size: int = WRITE_BATCH_SIZE):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.loop = None
+        self.queue = None
+        self.task = None
+        self.jobs = []
+        self.batches = 0
+
+    async def run(self, func, *args, **kwargs):
+        """Run `func(session, *args, **kwargs)` on the writer and return its result, once it is committed."""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.task = loop.create_task(self.process())
+
+        future = loop.create_future()
+        # The job runs in the context of the caller (e.g., to count its statements in the request metrics)
+        context = contextvars.copy_context()
+        self.queue.put_nowait((lambda db: context.run(func, db, *args, **kwargs), future))
+        return await future
+
+    async def close(self):
+        """Stop the writer, failing the jobs of the batch being written and the queued ones."""
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        futures = [future for _, future in self.jobs]
+        while not self.queue.empty():
+            futures.append(self.queue.get_nowait()[1])
+        for future in futures:
+            if not future.done():
+                future.set_exception(WriterClosedException('The writer was closed.'))
+        self.task = None
+        self.loop = None
+        self.jobs = []
+
+    async def process(self):
+        while True:
+            self.jobs = jobs = [await self.queue.get()]
+            while len(jobs) < self.batch_size and not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+
+            callbacks = []
+            self.batches += 1
+            try:
+                for attempt in range(1, WRITE_LOCK_ATTEMPTS + 1):
+                    try:
+                        async with self.engine.connect() as connection:
+                            async with connection.begin():
+                                results = await connection.run_sync(run_batch, [job for job, _ in jobs], callbacks)
+                        break
+                    except OperationalError as exception:
+                        # Only BEGIN IMMEDIATE waits for the lock: nothing was written yet, so the batch is retried
+                        if 'database is locked' not in str(exception.orig) or attempt == WRITE_LOCK_ATTEMPTS:
+                            raise
+                        logger.warning('Write lock not acquired in %d ms, retrying', SQLITE_BUSY_TIMEOUT)
+            except Exception as exception:
+                for _, future in jobs:
+                    if not future.done():
+                        future.set_exception(exception)
+                continue
+
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('After commit callback failed')
+            for (_, future), (result, exception) in zip(jobs, results):
+                if future.done():
+                    # Cancelled by the caller
+                    continue
+                if exception is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exception)
+
+def run_batch(connection, jobs: list, callbacks: list):
+    """Run write jobs, each in its own session and savepoint, inside the transaction of a connection.
+    The after commit callbacks of a job (see `crud.after_commit`) are added to `callbacks` with the changes
+    they follow, i.e., when the job commits or succeeds; the ones of the changes rolled back by a failing job
+    are dropped.
+    Returns a (result, exception) pair for each job."""
+    results = []
+    for job in jobs:
+        savepoint = connection.begin_nested()
+        job_callbacks = []
+        db = Session(bind=connection, autoflush=False, expire_on_commit=False, info={'after_commit': job_callbacks})
+
+        @event.listens_for(db, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            # A commit of the job releases the savepoint: continue the job in a new one
+            nonlocal savepoint
+            if not savepoint.is_active:
+                savepoint = connection.begin_nested()
+
+        @event.listens_for(db, 'after_commit')
+        def keep_callbacks(session):
+            # The changes of the job so far stay in the batch, whatever the rest of the job does
+            callbacks.extend(job_callbacks)
+            job_callbacks.clear()
+
+        try:
+            result = job(db)
+            db.close()
+            savepoint.commit()
+            callbacks.extend(job_callbacks)
+            results.append((result, None))
+        except Exception as exception:
+            db.close()
+            savepoint.rollback()
+            results.append((None, exception))
+    return results
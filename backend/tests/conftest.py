@@ -0,0 +1,86 @@
+"""Fixtures of the tests.
+
+The application runs in-process, on a temporary DB and photo directory: the tests run in a temporary
+working directory, with the settings in `local/.env` (read when the backend is imported) and an empty
+frontend build in `app`. Each test gets a user of its own, with generated data (see `generate_data`).
+"""
+import os
+import tempfile
+
+WORK_DIR = tempfile.mkdtemp(prefix='backend-tests-')
+os.makedirs(os.path.join(WORK_DIR, 'local'))
+os.makedirs(os.path.join(WORK_DIR, 'app'))
+with open(os.path.join(WORK_DIR, 'local', '.env'), 'w') as env_file:
+    env_file.write('SECRET_KEY=tests\nALGORITHM=HS256\nACCESS_TOKEN_EXPIRE_MINUTES=60\nMETRICS_TOKEN=tests\n')
+os.chdir(WORK_DIR)
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import httpx
+import pytest
+
+from backend import crud, database, metrics, models, photos, security
+from backend.main import app, shutdown_database
+from backend.scripts.benchmark_api import PASSWORD
+from backend.scripts.generate_data import generate_data
+
+# Items of the user of a test
+ITEMS = 20
+
+
+@dataclass
+class LoggedUser:
+    id: int
+    email: str
+    headers: dict
+
+@pytest.fixture(scope='session')
+def anyio_backend():
+    return 'asyncio'
+
+@pytest.fixture(scope='session', autouse=True)
+def tables():
+    models.Base.metadata.create_all(bind=database.engine)
+    yield
+    photos.shutdown_image_pool()
+    photos.shutdown_deletion_worker()
+    database.engine.dispose()
+
+def create_user():
+    """Create a user with ITEMS generated items, 20 tags and 10 locations, and the headers of its requests."""
+    email = generate_data(database.engine, items=ITEMS, password=PASSWORD)[0][0]
+    token = security.create_access_token(data={'sub': email})
+    # The transactions of the scripts' engine take the write lock: the session is closed at once
+    with database.SessionLocal() as db:
+        user_id = crud.get_user_by_email(db, email).id
+    return LoggedUser(user_id, email, {'Authorization': f'Bearer {token}'})
+
+@pytest.fixture
+def user():
+    """A user with generated data (see `create_user`)."""
+    return create_user()
+
+@pytest.fixture
+def other_user():
+    """A second user, with the same generated data as `user` (the same names of tags, locations...)."""
+    return create_user()
+
+@pytest.fixture
+def query_budget():
+    """Check the SQL statements of a block (and of the requests it sends) against a budget:
+    `with query_budget(4) as query_log: ...` fails if the block runs more statements than the budget,
+    repeats a statement (N+1) or lazily loads a relationship (see `QueryLog.check`)."""
+    @contextmanager
+    def check_budget(budget: int):
+        with metrics.track_queries() as query_log:
+            yield query_log
+        query_log.check(budget)
+    return check_budget
+
+@pytest.fixture
+async def client():
+    """A client of the application, whose engines and writer are closed in the event loop of the test."""
+    async with httpx.AsyncClient(app=app, base_url='http://test') as test_client:
+        yield test_client
+    await shutdown_database()
@@ -0,0 +1,75 @@
+import pytest
+
+from .test_changes import get_revision
+
+pytestmark = pytest.mark.anyio
+
+
+async def get_items(client, user):
+    return (await client.get('/api/users/me/items/', headers=user.headers)).json()
+
+def get_names(item, kind: str):
+    return {linked['name'] for linked in item[kind]}
+
+async def run_bulk(client, user, item_ids: list, operation: str, **fields):
+    response = await client.post('/api/users/me/items/bulk', headers=user.headers,
+                                 json={'ids': item_ids, 'operation': operation, **fields})
+    assert response.status_code == 200
+    return response.json()
+
+async def get_changed_ids(client, user, since: int):
+    changes = (await client.get('/api/users/me/changes', headers=user.headers, params={'since': since})).json()
+    return sorted(item['id'] for item in changes['items'])
+
+@pytest.mark.parametrize('operation, fields, is_changed', [
+    ('remove_tag', {'tag': {'name': 'tag 1'}}, lambda item: 'tag 1' in get_names(item, 'tags')),
+    ('add_tag', {'tag': {'name': 'tag 1'}}, lambda item: 'tag 1' not in get_names(item, 'tags')),
+    ('move_location', {'location': {'name': 'location 1'}},
+        lambda item: get_names(item, 'locations') != {'location 1'}),
+    ('archive', {}, lambda item: item['is_active']),
+    ('restore', {}, lambda item: not item['is_active']),
+    ('bookmark', {}, lambda item: not item['is_bookmarked']),
+    ('delete', {}, lambda item: True),
+])
+async def test_changed_items(client, user, operation, fields, is_changed):
+    """Only the items that an operation changes get a new revision, and are returned, sorted."""
+    items = await get_items(client, user)
+    expected = sorted(item['id'] for item in items if is_changed(item))
+    if operation != 'delete':
+        # Some of the generated items are already as the operation leaves them
+        assert 0 < len(expected) < len(items)
+    since = await get_revision(client, user)
+
+    result = await run_bulk(client, user, [item['id'] for item in reversed(items)] + [10 ** 9], operation, **fields)
+    assert result['ids'] == expected
+    assert result['revision'] == since + 1
+    if operation != 'delete':
+        assert await get_changed_ids(client, user, since) == expected
+
+    # Once done, the operation changes nothing
+    if operation != 'delete':
+        result = await run_bulk(client, user, [item['id'] for item in items], operation, **fields)
+        assert result == {'revision': since + 1, 'ids': []}
+
+@pytest.mark.parametrize('operation', ['remove_tag', 'add_tag'])
+async def test_unknown_tag(client, user, operation):
+    items = await get_items(client, user)
+    since = await get_revision(client, user)
+
+    result = await run_bulk(client, user, [item['id'] for item in items], operation, tag={'name': 'unknown'})
+    if operation == 'remove_tag':
+        assert result == {'revision': since, 'ids': []}
+        assert await get_revision(client, user) == since
+    else:
+        # Created
+        assert result['ids'] == sorted(item['id'] for item in items)
+        tags = (await client.get('/api/users/me/tags/', headers=user.headers)).json()
+        assert 'unknown' in {tag['name'] for tag in tags}
+
+async def test_move_location(client, user):
+    item = next(item for item in await get_items(client, user) if len(item['locations']) == 2)
+    location = sorted(get_names(item, 'locations'))[0]
+
+    assert (await run_bulk(client, user, [item['id']], 'move_location', location={'name': location}))['ids'] == [item['id']]
+    item = (await client.get(f'/api/users/me/items/{item["id"]}', headers=user.headers)).json()
+    assert get_names(item, 'locations') == {location}
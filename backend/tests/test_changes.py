@@ -0,0 +1,43 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def get_revision(client, user):
+    response = await client.get('/api/users/me/changes', headers=user.headers, params={'since': 0})
+    return response.json()['revision']
+
+@pytest.mark.parametrize('kind', ['tags', 'locations'])
+async def test_rename_changes_items(client, user, kind):
+    items = (await client.get('/api/users/me/items/', headers=user.headers)).json()
+    objects = (await client.get(f'/api/users/me/{kind}/', headers=user.headers)).json()
+    # The items show the names of their tags and locations
+    name = next(item[kind][0]['name'] for item in items if item[kind])
+    object_id = next(linked['id'] for linked in objects if linked['name'] == name)
+    linked_ids = {item['id'] for item in items if name in [linked['name'] for linked in item[kind]]}
+    since = await get_revision(client, user)
+
+    response = await client.post(f'/api/users/me/{kind}/{object_id}', headers=user.headers, json={'name': 'renamed'})
+    assert response.status_code == 200
+
+    changes = (await client.get('/api/users/me/changes', headers=user.headers, params={'since': since})).json()
+    assert [changed['id'] for changed in changes[kind]] == [object_id]
+    assert {item['id'] for item in changes['items']} == linked_ids
+    for item in changes['items']:
+        assert 'renamed' in [linked['name'] for linked in item[kind]]
+    # The next sync only gets the changes made since
+    changes = (await client.get('/api/users/me/changes', headers=user.headers,
+                                params={'since': changes['revision']})).json()
+    assert changes['items'] == [] and changes[kind] == []
+
+@pytest.mark.parametrize('kind', ['tags', 'locations'])
+async def test_same_name_keeps_items(client, user, kind):
+    objects = (await client.get(f'/api/users/me/{kind}/', headers=user.headers)).json()
+    since = await get_revision(client, user)
+
+    response = await client.post(f'/api/users/me/{kind}/{objects[0]["id"]}', headers=user.headers,
+                                 json={'name': objects[0]['name']})
+    assert response.status_code == 200
+
+    changes = (await client.get('/api/users/me/changes', headers=user.headers, params={'since': since})).json()
+    assert changes['items'] == []
@@ -0,0 +1,91 @@
+import gzip
+
+import brotli
+import orjson
+import pytest
+import zstandard
+
+from backend import compression
+
+from .test_photos import make_jpeg, upload
+
+pytestmark = pytest.mark.anyio
+
+DECOMPRESS = {
+    None: lambda body: body,
+    'gzip': gzip.decompress,
+    'br': brotli.decompress,
+    'zstd': lambda body: zstandard.ZstdDecompressor().decompressobj().decompress(body),
+}
+
+
+async def get_raw(client, url: str, headers: dict):
+    """Get a response and its body as sent (httpx would decode some of the encodings)."""
+    async with client.stream('GET', url, headers=headers) as response:
+        body = b''.join([chunk async for chunk in response.aiter_raw()])
+    return response, body
+
+@pytest.mark.parametrize('accept_encoding, encoding', [
+    ('zstd, br, gzip', 'zstd'),
+    ('gzip, deflate, br', 'br'),
+    ('gzip', 'gzip'),
+    ('GZIP', 'gzip'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('zstd;q=0.2, br;q=0.8, gzip;q=0.5', 'br'),
+    ('br;q=0, *', 'zstd'),
+    ('zstd;q=0, br;q=0, *', 'gzip'),
+    ('*;q=0, gzip', 'gzip'),
+    ('gzip;q=0', None),
+    ('identity', None),
+    ('', None),
+])
+async def test_negotiation(client, user, accept_encoding, encoding):
+    expected = (await client.get('/api/users/me/items/', headers={**user.headers, 'Accept-Encoding': 'identity'})).json()
+
+    response, body = await get_raw(client, '/api/users/me/items/', {**user.headers, 'Accept-Encoding': accept_encoding})
+    assert response.status_code == 200
+    assert response.headers.get('content-encoding') == encoding
+    assert 'Accept-Encoding' in response.headers['vary']
+    if encoding is not None:
+        # Streamed
+        assert 'content-length' not in response.headers
+    assert orjson.loads(DECOMPRESS[encoding](body)) == expected
+
+async def test_size_threshold(client, user, monkeypatch):
+    response, body = await get_raw(client, '/api/users/me', {**user.headers, 'Accept-Encoding': 'gzip'})
+    assert len(body) < compression.COMPRESSION_MIN_SIZE
+    assert 'content-encoding' not in response.headers
+
+    monkeypatch.setattr(compression, 'COMPRESSION_MIN_SIZE', 10)
+    response, body = await get_raw(client, '/api/users/me', {**user.headers, 'Accept-Encoding': 'gzip'})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert orjson.loads(gzip.decompress(body))['email'] == user.email
+
+async def test_images_not_compressed(client, user):
+    image_id = (await upload(client, user, make_jpeg(1200))).json()['filename']
+
+    response, body = await get_raw(client, f'/api/users/me/items/1/image/{image_id}',
+                                   {**user.headers, 'Accept-Encoding': 'zstd, br, gzip'})
+    assert response.status_code == 200
+    assert len(body) > compression.COMPRESSION_MIN_SIZE
+    assert 'content-encoding' not in response.headers
+    assert body[:2] == b'\xff\xd8'
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+async def test_etag(client, user, encoding):
+    """The compressed and uncompressed bodies, and the 304 responses, have the same validator."""
+    response, _ = await get_raw(client, '/api/users/me/items/', {**user.headers, 'Accept-Encoding': encoding})
+    assert response.headers['content-encoding'] == encoding
+    etag = response.headers['etag']
+    assert etag.startswith('W/')
+
+    response, _ = await get_raw(client, '/api/users/me/items/', {**user.headers, 'Accept-Encoding': 'identity'})
+    assert response.headers['etag'] == etag
+
+    for accept_encoding in (encoding, 'identity'):
+        response, body = await get_raw(client, '/api/users/me/items/',
+                                       {**user.headers, 'Accept-Encoding': accept_encoding, 'If-None-Match': etag})
+        assert response.status_code == 304
+        assert body == b''
+        assert response.headers['etag'] == etag
+        assert 'content-encoding' not in response.headers
@@ -0,0 +1,24 @@
+import random
+
+import pytest
+
+from backend.scripts.generate_data import generate_user_data
+
+from .test_stats import get_stats, rebuild_stats
+
+pytestmark = pytest.mark.anyio
+
+
+def generate(seed: int):
+    next_ids = {'items': 1, 'tags': 1, 'locations': 1}
+    return generate_user_data(random.Random(seed), 1, next_ids, items=50, tags=20, locations=10, max_photos=2)
+
+def test_same_seed_same_data():
+    assert generate(1) == generate(1)
+    assert generate(1)['items'] != generate(2)['items']
+
+async def test_generated_stats(client, user):
+    stats = await get_stats(client, user)
+    items = (await client.get('/api/users/me/items/', headers=user.headers)).json()
+    assert stats['active_count'] + stats['archived_count'] == len(items)
+    assert stats == await rebuild_stats(client, user)
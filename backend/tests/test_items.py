@@ -0,0 +1,117 @@
+import pytest
+
+from backend import crud, metrics
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize('kind', ['tags', 'locations'])
+async def test_item_etag_after_rename(client, user, kind):
+    items = (await client.get('/api/users/me/items/', headers=user.headers)).json()
+    item = next(item for item in items if item[kind])
+    objects = (await client.get(f'/api/users/me/{kind}/', headers=user.headers)).json()
+    object_id = next(linked['id'] for linked in objects if linked['name'] == item[kind][0]['name'])
+
+    response = await client.get(f'/api/users/me/items/{item["id"]}', headers=user.headers)
+    etag = response.headers['etag']
+    response = await client.get(f'/api/users/me/items/{item["id"]}', headers={**user.headers, 'If-None-Match': etag})
+    assert response.status_code == 304
+
+    response = await client.post(f'/api/users/me/{kind}/{object_id}', headers=user.headers, json={'name': 'renamed'})
+    assert response.status_code == 200
+
+    response = await client.get(f'/api/users/me/items/{item["id"]}', headers={**user.headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+    assert 'renamed' in [linked['name'] for linked in response.json()[kind]]
+
+def matches(item, item_filter: dict, names: dict):
+    """Check an item against the parameters of a filter, in Python."""
+    for field in ('is_active', 'is_bookmarked', 'is_silenced'):
+        if field in item_filter and item[field] != item_filter[field]:
+            return False
+    for kind in ('tags', 'locations'):
+        linked_names = {linked['name'] for linked in item[kind]}
+        if any(names[kind].get(object_id) not in linked_names for object_id in item_filter.get(f'{kind[:-1]}_ids', [])):
+            return False
+    expiration_date = item['expiration_date']
+    if 'expiration_date_from' in item_filter and not (expiration_date and expiration_date >= item_filter['expiration_date_from']):
+        return False
+    if 'expiration_date_to' in item_filter and not (expiration_date and expiration_date <= item_filter['expiration_date_to']):
+        return False
+    if 'cost_min' in item_filter and not (item['cost'] is not None and item['cost'] >= item_filter['cost_min']):
+        return False
+    if 'cost_max' in item_filter and not (item['cost'] is not None and item['cost'] <= item_filter['cost_max']):
+        return False
+    return True
+
+async def get_names(client, user):
+    """Get the names of the tags and locations of the user, by ID."""
+    return {kind: {linked['id']: linked['name']
+                   for linked in (await client.get(f'/api/users/me/{kind}/', headers=user.headers)).json()}
+            for kind in ('tags', 'locations')}
+
+def make_filters(items: list, names: dict):
+    item = next(item for item in items if len(item['tags']) >= 2)
+    tag_ids = [tag_id for tag_id, name in names['tags'].items() if name in [tag['name'] for tag in item['tags']]]
+    location_id = next(location_id for location_id, name in names['locations'].items()
+                       if name == item['locations'][0]['name'])
+    dates = sorted(item['expiration_date'] for item in items if item['expiration_date'])
+    return [
+        {},
+        {'is_active': True},
+        {'is_active': False, 'is_bookmarked': False},
+        {'tag_ids': tag_ids[:1]},
+        {'tag_ids': tag_ids},
+        {'tag_ids': tag_ids[:1], 'location_ids': [location_id]},
+        {'location_ids': [location_id], 'is_active': True},
+        {'tag_ids': [max(names['tags']) + 1]},
+        {'cost_min': 50, 'cost_max': 150},
+        {'expiration_date_from': dates[0], 'expiration_date_to': dates[len(dates) // 2]},
+    ]
+
+@pytest.mark.parametrize('driving', [True, False], ids=['driving link', 'exists only'])
+async def test_filters(client, user, monkeypatch, driving):
+    """The filtered lists have the items that match the filter, in the same order as the full list,
+    whether the items are read from the link table of a rare tag or location or not (see `query_user_items`)."""
+    items = (await client.get('/api/users/me/items/', headers=user.headers)).json()
+    names = await get_names(client, user)
+    # The tags and locations of the user all have less than the default number of items
+    if not driving:
+        monkeypatch.setattr(crud, 'FILTER_DRIVING_LINKS', 0)
+
+    for item_filter in make_filters(items, names):
+        with metrics.track_queries() as query_log:
+            response = await client.get('/api/users/me/items/', headers=user.headers, params=item_filter)
+        assert response.status_code == 200
+        expected = [item['id'] for item in items if matches(item, item_filter, names)]
+        assert [item['id'] for item in response.json()] == expected, item_filter
+        has_links = bool(item_filter.get('tag_ids') or item_filter.get('location_ids'))
+        assert any('IN (SELECT' in statement for statement in query_log.statements) == (driving and has_links)
+
+async def get_all_pages(client, user, params: dict):
+    item_ids, cursor = [], None
+    while True:
+        response = await client.get('/api/users/me/items/page', headers=user.headers,
+                                    params={**params, 'limit': 3, **({'cursor': cursor} if cursor else {})})
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page['items']) <= 3
+        item_ids += [item['id'] for item in page['items']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            return item_ids
+
+@pytest.mark.parametrize('summary', [False, True])
+async def test_pages(client, user, summary):
+    """Following the cursors gives the items of the list once each, in order, with or without a filter."""
+    items = (await client.get('/api/users/me/items/', headers=user.headers)).json()
+    names = await get_names(client, user)
+
+    for item_filter in make_filters(items, names)[:6]:
+        expected = [item['id'] for item in items if matches(item, item_filter, names)]
+        assert await get_all_pages(client, user, {**item_filter, 'summary': summary}) == expected, item_filter
+
+async def test_invalid_cursor(client, user):
+    response = await client.get('/api/users/me/items/page', headers=user.headers, params={'cursor': 'invalid'})
+    assert response.status_code == 422
@@ -0,0 +1,26 @@
+import re
+
+import pytest
+
+from backend import metrics
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_metrics_token(client, monkeypatch):
+    assert (await client.get('/metrics')).status_code == 401
+    assert (await client.get('/metrics', headers={'Authorization': 'Bearer wrong'})).status_code == 401
+    response = await client.get('/metrics', headers={'Authorization': f'Bearer {metrics.METRICS_TOKEN}'})
+    assert response.status_code == 200
+    assert 'write_batches_total' in response.text
+
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', '')
+    assert (await client.get('/metrics', headers={'Authorization': 'Bearer '})).status_code == 404
+
+async def test_fetched_rows(client, user, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_SERVER_TIMING', True)
+    response = await client.get('/api/users/me/items/', headers=user.headers, params={'summary': True})
+
+    rows = int(re.search(r'(\d+) rows', response.headers['Server-Timing']).group(1))
+    # The items, and their tags and locations
+    assert rows >= len(response.json())
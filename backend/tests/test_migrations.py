@@ -0,0 +1,73 @@
+import base64
+import json
+import os
+import shutil
+
+from alembic import command
+from alembic.config import Config
+import pytest
+import sqlalchemy as sa
+
+from backend import photos
+
+from .test_photos import make_thumbnail
+
+ALEMBIC_DIR = os.path.join(os.path.dirname(__file__), '..', 'alembic')
+# Not a user of the other tests, whose photos are in the same directory
+OWNER_ID = 10 ** 6
+
+
+@pytest.fixture
+def alembic_config(tmp_path):
+    """The migrations, on an empty DB of their own."""
+    config = Config()
+    config.set_main_option('script_location', ALEMBIC_DIR)
+    config.set_main_option('sqlalchemy.url', f'sqlite:///{tmp_path}/backend.db')
+    yield config
+    shutil.rmtree(f'{photos.PHOTOS_DIR}/{OWNER_ID}', ignore_errors=True)
+
+def get_item_photos(engine):
+    with engine.connect() as connection:
+        rows = connection.execute(sa.text("SELECT id, photos FROM items ORDER BY id")).fetchall()
+    return {item_id: json.loads(item_photos) if item_photos else None for item_id, item_photos in rows}
+
+def test_move_thumbnails_to_files(alembic_config):
+    command.upgrade(alembic_config, 'a51d2e8c94f3')
+    engine = sa.create_engine(alembic_config.get_main_option('sqlalchemy.url'))
+    data = make_thumbnail((10, 200, 30))
+    thumbnail = base64.b64encode(data).decode()
+    inline_photos = {
+        1: {'thumbnail': thumbnail, 'selected': 0, 'sources': ['2023-5-1683380000.jpeg']},
+        2: {'thumbnail': 'not base64!', 'selected': 0, 'sources': []},
+        3: {'thumbnail': None, 'selected': None, 'sources': []},
+        4: None,
+    }
+    with engine.begin() as connection:
+        connection.execute(sa.text("INSERT INTO users (id, email, hashed_password, settings, is_active, creation_date) "
+                                   "VALUES (:id, 'migrated@example.com', '', '{}', 1, '2023-05-06')"), {'id': OWNER_ID})
+        for item_id, item_photos in inline_photos.items():
+            connection.execute(sa.text(
+                "INSERT INTO items (id, name, quantity, photos, is_active, is_bookmarked, is_silenced, addition_date, owner_id) "
+                "VALUES (:id, 'Item', 1, :photos, 1, 0, 0, '2023-05-06', :owner_id)"),
+                {'id': item_id, 'photos': json.dumps(item_photos) if item_photos else None, 'owner_id': OWNER_ID})
+
+    command.upgrade(alembic_config, '6f0b8d3a2c17')
+    item_photos = get_item_photos(engine)
+    thumbnail_id = item_photos[1]['thumbnail_id']
+    assert item_photos[1] == {'thumbnail_id': thumbnail_id, 'selected': 0, 'sources': ['2023-5-1683380000.jpeg']}
+    assert photos.THUMBNAIL_ID_PATTERN.match(thumbnail_id) and thumbnail_id.startswith('1-')
+    with open(photos.get_thumbnail_path(OWNER_ID, thumbnail_id), 'rb') as thumbnail_file:
+        assert thumbnail_file.read() == data
+    # The invalid thumbnails are dropped
+    assert item_photos[2] == {'thumbnail_id': None, 'selected': 0, 'sources': []}
+    assert item_photos[3] == {'thumbnail_id': None, 'selected': None, 'sources': []}
+    assert item_photos[4] is None
+    assert os.listdir(f'{photos.PHOTOS_DIR}/{OWNER_ID}/thumbnails') == [f'{thumbnail_id}.jpeg']
+
+    # Inline again
+    command.downgrade(alembic_config, 'a51d2e8c94f3')
+    item_photos = get_item_photos(engine)
+    assert item_photos[1] == inline_photos[1]
+    assert item_photos[2] == {'selected': 0, 'sources': []}
+    assert item_photos[4] is None
+    engine.dispose()
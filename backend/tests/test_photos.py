@@ -0,0 +1,241 @@
+import asyncio
+import base64
+from concurrent.futures.process import BrokenProcessPool
+import io
+import os
+
+from PIL import Image
+import pytest
+
+from backend import photos
+
+pytestmark = pytest.mark.anyio
+
+
+def make_jpeg(size: int = 400):
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), (200, 120, 40)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+async def upload(client, user, data: bytes):
+    return await client.post('/api/users/me/items/1/image', headers=user.headers, params={'mode': 'sd'},
+                              files={'file': ('photo.jpeg', data, 'image/jpeg')})
+
+def list_files(user):
+    """Get the names of the photo files of a user, without the lock of the directory."""
+    return [name for _, _, names in os.walk(f'{photos.PHOTOS_DIR}/{user.id}') for name in names if name != '.lock']
+
+async def create_item(client, user, image_id: str):
+    response = await client.post('/api/users/me/items/', headers=user.headers,
+                                 json={'name': 'Photo item', 'photos': {'sources': [image_id], 'selected': 0}})
+    assert response.status_code == 200
+    return response.json()['id']
+
+async def delete_item(client, user, item_id: int):
+    response = await client.delete(f'/api/users/me/items/{item_id}', headers=user.headers)
+    assert response.status_code == 204
+    # Wait for the files to be removed
+    photos.shutdown_deletion_worker()
+
+async def test_upload(client, user):
+    response = await upload(client, user, make_jpeg())
+    assert response.status_code == 200
+    image_id = response.json()['filename']
+
+    response = await client.get(f'/api/users/me/items/1/image/{image_id}', headers=user.headers)
+    assert response.status_code == 200
+    response = await client.get(f'/api/users/me/items/1/image/{image_id}/status', headers=user.headers)
+    assert response.json() == {'filename': image_id, 'variants': {'full': True, 'normal': True, 'thumb': True},
+                               'failed': False}
+
+async def test_upload_not_image(client, user):
+    response = await upload(client, user, b'not an image')
+    assert response.status_code == 422
+    assert list_files(user) == []
+
+async def test_upload_processing_failure(client, user, caplog):
+    # Readable, but cut: only decoding the pixels fails
+    data = make_jpeg()
+    response = await upload(client, user, data[:len(data) // 2])
+    assert response.status_code == 200
+    image_id = response.json()['filename']
+
+    response = await client.get(f'/api/users/me/items/1/image/{image_id}', headers=user.headers)
+    assert response.status_code == 404
+    response = await client.get(f'/api/users/me/items/1/image/{image_id}/status', headers=user.headers)
+    assert response.status_code == 200
+    assert response.json()['failed'] and not any(response.json()['variants'].values())
+
+    # Logged by the callback of the pool, once the worker is done
+    for _ in range(100):
+        if 'Image not processed' in caplog.text:
+            break
+        await asyncio.sleep(0.05)
+    assert 'Image not processed' in caplog.text
+
+async def test_delete_unreferenced_image(client, user):
+    image_id = (await upload(client, user, make_jpeg())).json()['filename']
+    item_id = await create_item(client, user, image_id)
+    assert (await client.get(f'/api/users/me/items/{item_id}/image/{image_id}', headers=user.headers)).status_code == 200
+
+    await delete_item(client, user, item_id)
+    assert list_files(user) == []
+
+async def test_delete_image_uploaded_again(client, user):
+    image_id = (await upload(client, user, make_jpeg())).json()['filename']
+    item_id = await create_item(client, user, image_id)
+    await client.get(f'/api/users/me/items/{item_id}/image/{image_id}', headers=user.headers)
+
+    # The same image, for a new item, while the item showing it is deleted
+    assert (await upload(client, user, make_jpeg())).json()['filename'] == image_id
+    await delete_item(client, user, item_id)
+
+    item_id = await create_item(client, user, image_id)
+    response = await client.get(f'/api/users/me/items/{item_id}/image/{image_id}', headers=user.headers)
+    assert response.status_code == 200
+
+    # Until the pin expires, the files are left to the orphan collection
+    image_path = photos.get_image_path(user.id, image_id)
+    assert photos.find_orphan_files(user.id, set(), set(), grace=0) == ([], [])
+    for file_path in photos.get_image_files(image_path):
+        if os.path.isfile(file_path):
+            os.utime(file_path, (0, 0))
+    assert photos.find_orphan_files(user.id, set(), set(), grace=60) == ([image_id], [])
+
+@pytest.mark.parametrize('photos_value', [None, {}, {'sources': []}])
+async def test_clear_photos(client, user, photos_value):
+    image_id = (await upload(client, user, make_jpeg())).json()['filename']
+    item_id = await create_item(client, user, image_id)
+
+    # Other updates keep the photos
+    response = await client.post(f'/api/users/me/items/{item_id}', headers=user.headers, json={'name': 'Renamed'})
+    assert response.json()['photos']['sources'] == [image_id]
+    photos.shutdown_deletion_worker()
+    assert list_files(user) != []
+
+    response = await client.post(f'/api/users/me/items/{item_id}', headers=user.headers, json={'photos': photos_value})
+    assert response.status_code == 200
+    assert not (response.json()['photos'] or {}).get('sources')
+    photos.shutdown_deletion_worker()
+    assert list_files(user) == []
+
+def make_thumbnail(color: tuple):
+    buffer = io.BytesIO()
+    Image.new('RGB', (32, 32), color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+async def update_photos(client, user, item_id: int, item_photos: dict):
+    response = await client.post(f'/api/users/me/items/{item_id}', headers=user.headers, json={'photos': item_photos})
+    assert response.status_code == 200
+    return response.json()['photos']
+
+async def test_thumbnail_update(client, user):
+    image_id = (await upload(client, user, make_jpeg())).json()['filename']
+    item_id = await create_item(client, user, image_id)
+    thumbnail_dir = f'{photos.PHOTOS_DIR}/{user.id}/thumbnails'
+
+    # The inline thumbnail is moved to a file, named after its content
+    data = make_thumbnail((10, 200, 30))
+    item_photos = await update_photos(client, user, item_id,
+        {'sources': [image_id], 'selected': 0, 'thumbnail': base64.b64encode(data).decode()})
+    thumbnail_id = item_photos['thumbnail_id']
+    assert thumbnail_id.startswith(f'{item_id}-')
+    assert item_photos['thumbnail'] is None
+    with open(photos.get_thumbnail_path(user.id, thumbnail_id), 'rb') as thumbnail_file:
+        assert thumbnail_file.read() == data
+    assert os.listdir(thumbnail_dir) == [f'{thumbnail_id}.jpeg']
+
+    # Kept by the other updates, replaced by a new thumbnail
+    response = await client.post(f'/api/users/me/items/{item_id}', headers=user.headers, json={'name': 'Renamed'})
+    assert response.json()['photos']['thumbnail_id'] == thumbnail_id
+    item_photos = await update_photos(client, user, item_id,
+        {'sources': [image_id], 'selected': 0, 'thumbnail': base64.b64encode(make_thumbnail((0, 0, 255))).decode()})
+    assert item_photos['thumbnail_id'] not in (None, thumbnail_id)
+    photos.shutdown_deletion_worker()
+    assert os.listdir(thumbnail_dir) == [f'{item_photos["thumbnail_id"]}.jpeg']
+
+    # Invalid, or removed with the selected photo
+    response = await client.post(f'/api/users/me/items/{item_id}', headers=user.headers,
+                                 json={'photos': {'sources': [image_id], 'selected': 0, 'thumbnail': 'not base64!'}})
+    assert response.status_code == 422
+    item_photos = await update_photos(client, user, item_id, {'sources': [image_id], 'selected': None})
+    assert item_photos['thumbnail_id'] is None
+    photos.shutdown_deletion_worker()
+    assert os.listdir(thumbnail_dir) == []
+
+async def test_thumbnail_requests(client, user, other_user):
+    image_id = (await upload(client, user, make_jpeg())).json()['filename']
+    item_id = await create_item(client, user, image_id)
+    data = make_thumbnail((10, 200, 30))
+    thumbnail_id = (await update_photos(client, user, item_id,
+        {'sources': [image_id], 'selected': 0, 'thumbnail': base64.b64encode(data).decode()}))['thumbnail_id']
+    url = f'/api/users/me/items/{item_id}/thumbnail/{thumbnail_id}'
+
+    response = await client.get(url, headers=user.headers)
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers['content-type'] == 'image/jpeg'
+    assert response.headers['cache-control'] == 'private, max-age=31536000, immutable'
+    assert response.headers['etag'] == f'"{thumbnail_id}"'
+
+    response = await client.get(url, headers={**user.headers, 'If-None-Match': response.headers['etag']})
+    assert response.status_code == 304
+    assert response.content == b''
+
+    # Only the owner gets the thumbnail, of its item
+    assert (await client.get(url, headers=other_user.headers)).status_code == 404
+    assert (await client.get(f'/api/users/me/items/{item_id + 1}/thumbnail/{thumbnail_id}',
+                             headers=user.headers)).status_code == 404
+    assert (await client.get(f'/api/users/me/items/{item_id}/thumbnail/..%2F{thumbnail_id}',
+                             headers=user.headers)).status_code == 404
+
+class FailingPool:
+    def __init__(self, exception):
+        self.exception = exception
+
+    def submit(self, *args):
+        raise self.exception
+
+    def shutdown(self, wait: bool = True):
+        pass
+
+@pytest.mark.parametrize('exception, raised', [
+    (RuntimeError('cannot schedule new futures after shutdown'), RuntimeError),
+    (BrokenProcessPool('A worker died'), photos.PhotoExceptionBusy),
+])
+def test_submit_failure(monkeypatch, exception, raised):
+    image_path = photos.get_image_path(0, photos.make_image_id('0' * 64))
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    with open(photos.get_upload_path(image_path), 'wb') as upload_file:
+        upload_file.write(make_jpeg())
+    monkeypatch.setattr(photos, 'executor', FailingPool(exception))
+    pending_images = photos.pending_images
+
+    with pytest.raises(raised):
+        photos.submit_image(image_path, 'sd')
+    # Neither a queue slot nor a pending upload is left behind
+    assert photos.pending_images == pending_images
+    assert not photos.is_image_pending(image_path)
+    if raised is photos.PhotoExceptionBusy:
+        assert photos.executor is None
+
+async def test_image_requests(client, user):
+    response = await upload(client, user, make_jpeg())
+    image_id = response.json()['filename']
+    url = f'/api/users/me/items/1/image/{image_id}'
+    response = await client.get(url, headers=user.headers)
+    assert response.status_code == 200
+    size = len(response.content)
+
+    response = await client.get(url, headers={**user.headers, 'If-None-Match': response.headers['etag']})
+    assert response.status_code == 304
+    assert response.content == b''
+    response = await client.get(url, headers={**user.headers, 'If-None-Match': '"other"'})
+    assert response.status_code == 200
+
+    response = await client.get(url, headers={**user.headers, 'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.headers['content-range'] == f'bytes 0-9/{size}' and len(response.content) == 10
+    response = await client.get(url, headers={**user.headers, 'Range': f'bytes={size}-'})
+    assert response.status_code == 416
+    assert response.headers['content-range'] == f'bytes */{size}'
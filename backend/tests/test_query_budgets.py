@@ -0,0 +1,42 @@
+from fastapi.routing import APIRoute
+import pytest
+from sqlalchemy.orm import lazyload, selectinload
+
+from backend import database, metrics, models
+from backend.main import api, app
+from backend.scripts import check_query_budgets
+
+pytestmark = pytest.mark.anyio
+
+ROUTES = [route for routes in (api.router.routes, app.router.routes) for route in routes if isinstance(route, APIRoute)]
+
+
+@pytest.mark.parametrize('route', ROUTES, ids=[f'{",".join(sorted(route.methods))} {route.path}' for route in ROUTES])
+async def test_route_budget(client, user, query_budget, route):
+    assert hasattr(route.endpoint, 'query_budget'), 'no query budget'
+    context = await check_query_budgets.prepare(client, user.email)
+    requests = [(method, url, kwargs) for method, url, kwargs in check_query_budgets.get_requests(context)
+                if check_query_budgets.find_route(method, url) is route]
+    assert requests, 'not requested by check_query_budgets'
+
+    for method, url, kwargs in requests:
+        with query_budget(route.endpoint.query_budget):
+            response = await client.request(method, url, **kwargs)
+        assert response.status_code < 400
+
+def load_item_tags(user_id: int, loader):
+    with database.SessionLocal() as db:
+        items = db.query(models.Item).filter(models.Item.owner_id == user_id).options(loader(models.Item.tags)).all()
+        return [[tag.name for tag in item.tags] for item in items]
+
+def test_lazy_loads_fail_budget(user, query_budget):
+    # The items, their tags and their locations
+    with query_budget(3):
+        expected = load_item_tags(user.id, selectinload)
+
+    # The tags of each item loaded when they are used: a query per item
+    with pytest.raises(metrics.QueryBudgetException) as exception_info:
+        with query_budget(100) as query_log:
+            assert load_item_tags(user.id, lazyload) == expected
+    assert 'statement run' in str(exception_info.value) and 'lazy load of Item' in str(exception_info.value)
+    assert len(query_log.lazy_loads) == len(expected)
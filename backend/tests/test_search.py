@@ -0,0 +1,120 @@
+import pytest
+
+from backend import crud
+
+pytestmark = pytest.mark.anyio
+
+
+async def search(client, user, q: str):
+    response = await client.get('/api/users/me/items/search', headers=user.headers, params={'q': q})
+    assert response.status_code == 200
+    return [item['id'] for item in response.json()]
+
+async def create_screwdriver(client, user):
+    response = await client.post('/api/users/me/items/', headers=user.headers, json={
+        'name': 'Cordless screwdriver', 'description': 'Bought at the hardware store', 'code': 'XJ42',
+        'tags': [{'name': 'tools'}], 'locations': [{'name': 'garage'}]})
+    assert response.status_code == 200
+    return response.json()['id']
+
+async def get_object_id(client, user, kind: str, name: str):
+    objects = (await client.get(f'/api/users/me/{kind}/', headers=user.headers)).json()
+    return next(linked['id'] for linked in objects if linked['name'] == name)
+
+@pytest.mark.parametrize('q, found', [
+    ('cordless screwdriver', True),
+    # The last word of a term is a prefix
+    ('cordl', True),
+    ('cordless scr', True),
+    ('cord screwdriver', False),
+    ('hardware', True),
+    ('xj42', True),
+    ('tools', True),
+    ('garage', True),
+    ('screwdriver, garage, hardware', True),
+    ('screwdriver, kitchen', False),
+])
+async def test_words(client, user, q, found):
+    item_id = await create_screwdriver(client, user)
+    assert (item_id in await search(client, user, q)) == found
+
+@pytest.mark.parametrize('q, found', [
+    ('n.screwdriver', True),
+    ('n:screwdriver', True),
+    ('N.cordless', True),
+    ('n.tools', False),
+    ('n.hardware', False),
+    ('t.tools', True),
+    ('t:too', True),
+    ('t.garage', False),
+    ('t.screwdriver', False),
+    ('l.garage', True),
+    ('l:gar', True),
+    ('l.tools', False),
+    ('t.tools, l.garage, screwdriver', True),
+    ('t.tools, l.kitchen', False),
+])
+async def test_qualifiers(client, user, q, found):
+    item_id = await create_screwdriver(client, user)
+    assert (item_id in await search(client, user, q)) == found
+
+@pytest.mark.parametrize('q', [
+    '"', '*', '-', '(', ':', 'NOT', 'screwdriver OR', 'screwdriver AND', 'screwdriver" OR "lorem',
+    'NEAR(screwdriver lorem)', '{name}: screwdriver', '^screwdriver', 'owner : u1', 't.tools OR lorem',
+])
+async def test_syntax_characters(client, user, q):
+    """The FTS5 syntax in a search text is ignored, only the words are searched."""
+    item_id = await create_screwdriver(client, user)
+    item_ids = await search(client, user, q)
+    # No term matches the other items in the same way as the screwdriver
+    assert set(item_ids) <= {item_id}
+
+async def test_users_isolated(client, user, other_user):
+    # The users have the same generated names
+    item_ids = {item['id'] for item in (await client.get('/api/users/me/items/', headers=user.headers)).json()}
+    for q in ('lorem', 't.tag 1', 'l.location', 'n.1'):
+        found_ids = await search(client, user, q)
+        assert found_ids and set(found_ids) <= item_ids, q
+        other_found_ids = await search(client, other_user, q)
+        assert other_found_ids and not set(other_found_ids) & item_ids, q
+
+async def test_index_sync(client, user):
+    item_id = await create_screwdriver(client, user)
+
+    # Renames of the tags and locations
+    tag_id = await get_object_id(client, user, 'tags', 'tools')
+    await client.post(f'/api/users/me/tags/{tag_id}', headers=user.headers, json={'name': 'equipment'})
+    assert item_id in await search(client, user, 't.equipment')
+    assert item_id not in await search(client, user, 't.tools')
+    location_id = await get_object_id(client, user, 'locations', 'garage')
+    await client.post(f'/api/users/me/locations/{location_id}', headers=user.headers, json={'name': 'shed'})
+    assert item_id in await search(client, user, 'l.shed')
+    assert item_id not in await search(client, user, 'l.garage')
+
+    # Bulk operations
+    async def bulk(operation: str, **fields):
+        response = await client.post('/api/users/me/items/bulk', headers=user.headers,
+                                     json={'ids': [item_id], 'operation': operation, **fields})
+        assert response.status_code == 200
+    await bulk('add_tag', tag={'name': 'boxed'})
+    assert item_id in await search(client, user, 't.boxed, t.equipment')
+    await bulk('remove_tag', tag={'name': 'boxed'})
+    assert item_id not in await search(client, user, 't.boxed')
+    await bulk('move_location', location={'name': 'attic'})
+    assert item_id in await search(client, user, 'l.attic')
+    assert item_id not in await search(client, user, 'l.shed')
+
+    # Updates and deletion of the item
+    await client.post(f'/api/users/me/items/{item_id}', headers=user.headers, json={'name': 'Ratchet screwdriver'})
+    assert item_id in await search(client, user, 'n.ratchet')
+    assert item_id not in await search(client, user, 'cordless')
+    await bulk('delete')
+    assert item_id not in await search(client, user, 'ratchet')
+
+async def test_many_matches(client, user, monkeypatch):
+    """The searches with too many matches to rank give the newest matches first."""
+    ranked_ids = await search(client, user, 'lorem')
+    monkeypatch.setattr(crud, 'SEARCH_RANKED_MATCHES', 5)
+    item_ids = await search(client, user, 'lorem')
+    assert set(item_ids) == set(ranked_ids)
+    assert item_ids == sorted(item_ids, reverse=True)
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from sqlalchemy import event
+
+from backend import cache, crud, database, metrics, models, security
+from backend.scripts.benchmark_api import PASSWORD
+
+pytestmark = pytest.mark.anyio
+
+
+async def get_me(client, headers: dict):
+    """Get the authenticated user, and whether it was read from the DB."""
+    with metrics.track_queries() as query_log:
+        response = await client.get('/api/users/me', headers=headers)
+    from_db = any('WHERE users.email = ' in statement for statement in query_log.statements)
+    return response, from_db
+
+def update_user(user_id: int, **fields):
+    """Change a user outside of the API, as the scripts do."""
+    with database.SessionLocal() as db:
+        db_user = db.query(models.User).filter(models.User.id == user_id).first()
+        for key, value in fields.items():
+            setattr(db_user, key, value)
+        db.commit()
+
+async def test_cached_user(client, user):
+    _, from_db = await get_me(client, user.headers)
+    for _ in range(2):
+        response, from_db = await get_me(client, user.headers)
+        assert response.json()['email'] == user.email
+        assert not from_db
+
+@pytest.mark.parametrize('fields, status_code', [
+    ({'hashed_password': security.get_password_hash('changed')}, 200),
+    ({'settings': '{"theme": "dark"}'}, 200),
+    ({'is_active': False}, 400),
+])
+async def test_user_update_invalidates(client, user, other_user, fields, status_code):
+    await get_me(client, user.headers)
+    await get_me(client, other_user.headers)
+
+    # Registered by the DB functions, for the scripts that do not import the API
+    assert event.contains(models.User, 'after_update', crud.invalidate_cached_user)
+    update_user(user.id, **fields)
+    response, from_db = await get_me(client, user.headers)
+    assert response.status_code == status_code
+    assert from_db
+    # The other users stay cached
+    _, from_db = await get_me(client, other_user.headers)
+    assert not from_db
+
+async def test_expires_with_token(client, user, monkeypatch):
+    """A user is cached until its token expires, even if the TTL of the cache is longer."""
+    monkeypatch.setattr(security.user_cache, 'ttl', 3600)
+    token = security.create_access_token(data={'sub': user.email}, expires_delta=1)
+    headers = {'Authorization': f'Bearer {token}'}
+    await get_me(client, headers)
+
+    class Clock:
+        now = time.time()
+        @classmethod
+        def time(cls):
+            return cls.now
+    monkeypatch.setattr(cache, 'time', Clock)
+    exp = security.decode_token(token)['exp']
+    Clock.now = exp - 1
+    assert security.user_cache.get(token).id == user.id
+    Clock.now = exp
+    assert security.user_cache.get(token) is None
+
+    # Read again, with the token still valid by the actual time
+    response, from_db = await get_me(client, headers)
+    assert response.status_code == 200
+    assert from_db
+
+async def test_login_not_blocking(client, user, monkeypatch):
+    """The password checks of the logins run on the password threads, while the other requests are served."""
+    released = threading.Event()
+    threads = []
+    verify_password = security.verify_password
+    def blocked_verify_password(*args):
+        threads.append(threading.current_thread().name)
+        released.wait(10)
+        return verify_password(*args)
+    monkeypatch.setattr(security, 'verify_password', blocked_verify_password)
+
+    # More logins than password threads
+    logins = [asyncio.create_task(client.post('/api/token', data={'username': user.email, 'password': PASSWORD}))
+              for _ in range(security.PASSWORD_WORKERS + 2)]
+    try:
+        while len(threads) < security.PASSWORD_WORKERS:
+            await asyncio.sleep(0.01)
+        response = await asyncio.wait_for(client.get('/api/users/me/items/', headers=user.headers), 5)
+        assert response.status_code == 200
+        assert not any(login.done() for login in logins)
+    finally:
+        released.set()
+    for response in await asyncio.gather(*logins):
+        assert response.status_code == 200
+        assert response.json()['token_type'] == 'bearer'
+    assert len(threads) == len(logins)
+    assert all(thread.startswith('password') for thread in threads)
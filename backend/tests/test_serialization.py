@@ -0,0 +1,40 @@
+import datetime
+
+from fastapi.responses import ORJSONResponse
+import orjson
+import pytest
+from sqlalchemy.orm.attributes import set_committed_value
+
+from backend import models, schemas
+from backend.main import create_serializable_item
+
+
+def make_item(photos, tags, locations, **fields):
+    """An item as loaded from the DB, with its photos parsed by the JSON column."""
+    item_db = models.Item(**{
+        'id': 1, 'name': 'Item', 'description': 'A thing kept somewhere in the house', 'quantity': 2, 'cost': 15,
+        'expiration_date': datetime.date(2024, 1, 31), 'code': 'C1', 'is_active': True, 'is_bookmarked': False,
+        'is_silenced': False, 'addition_date': datetime.date(2023, 1, 1), 'removal_date': None, 'revision': 1,
+        'owner_id': 1, 'photos': photos, **fields,
+    })
+    set_committed_value(item_db, 'tags', [models.Tag(id=index, name=f'tag {index}') for index in range(tags)])
+    set_committed_value(item_db, 'locations',
+                        [models.Location(id=index, name=f'location {index}') for index in range(locations)])
+    return item_db
+
+@pytest.mark.parametrize('photos', [
+    None,
+    {},
+    {'thumbnail_id': 'a' * 32, 'selected': 0, 'sources': ['b' * 64, 'c' * 64]},
+], ids=['no photos', 'empty photos', 'photos'])
+@pytest.mark.parametrize('tags, locations', [(0, 0), (2, 0), (0, 1), (3, 2)])
+@pytest.mark.parametrize('fields', [
+    {},
+    {'expiration_date': None, 'cost': None, 'code': None, 'removal_date': datetime.date(2023, 6, 1)},
+], ids=['all fields', 'missing fields'])
+def test_same_as_response_model(photos, tags, locations, fields):
+    item_db = make_item(photos, tags, locations, **fields)
+
+    fast = orjson.loads(ORJSONResponse(create_serializable_item(item_db)).body)
+    validated = orjson.loads(schemas.Item.from_orm(item_db).json())
+    assert fast == validated
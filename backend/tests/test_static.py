@@ -0,0 +1,107 @@
+import os
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Mount
+
+from backend import static
+
+pytestmark = pytest.mark.anyio
+
+INDEX = b'<!doctype html><html><head><title>Stuffkeeper</title></head><body>' + b'<div></div>' * 200 + b'</body></html>'
+SCRIPT = b'function f() { return "stuff"; }\n' * 300
+SCRIPT_PATH = 'static/js/main.1a2b3c4d.js'
+
+
+@pytest.fixture
+def build_dir(tmp_path):
+    """A frontend build, with an index, a fingerprinted script and a small file."""
+    os.makedirs(tmp_path / 'static' / 'js')
+    (tmp_path / 'index.html').write_bytes(INDEX)
+    (tmp_path / SCRIPT_PATH).write_bytes(SCRIPT)
+    (tmp_path / 'robots.txt').write_bytes(b'User-agent: *\n')
+    return tmp_path
+
+def create_client(build_dir, **kwargs):
+    files = static.PrecompressedStaticFiles(directory=str(build_dir), html=True, **kwargs)
+    return httpx.AsyncClient(app=Starlette(routes=[Mount('/', app=files)]), base_url='http://test'), files
+
+@pytest.mark.parametrize('cache_size', [0, 16], ids=['not cached', 'cached'])
+@pytest.mark.parametrize('accept_encoding, encoding', [
+    ('br, gzip', 'br'),
+    ('gzip, deflate, br', 'br'),
+    ('gzip', 'gzip'),
+    ('br;q=0, gzip', 'gzip'),
+    ('*', 'br'),
+    ('identity', None),
+    ('', None),
+])
+async def test_variants(build_dir, cache_size, accept_encoding, encoding):
+    client, _ = create_client(build_dir, cache_size=cache_size)
+    async with client:
+        for _ in range(2):
+            response = await client.get(f'/{SCRIPT_PATH}', headers={'Accept-Encoding': accept_encoding})
+            assert response.status_code == 200
+            assert response.headers.get('content-encoding') == encoding
+            variant_path = build_dir / (SCRIPT_PATH + (static.ENCODINGS[encoding] if encoding else ''))
+            assert int(response.headers['content-length']) == os.path.getsize(variant_path)
+            assert response.headers['vary'] == 'Accept-Encoding'
+            assert response.content == SCRIPT
+
+async def test_small_file_not_compressed(build_dir):
+    client, _ = create_client(build_dir)
+    async with client:
+        response = await client.get('/robots.txt', headers={'Accept-Encoding': 'br, gzip'})
+    assert 'content-encoding' not in response.headers
+    assert not os.path.exists(build_dir / 'robots.txt.gz')
+
+@pytest.mark.parametrize('cache_size', [0, 16], ids=['not cached', 'cached'])
+async def test_caching_headers(build_dir, cache_size):
+    client, _ = create_client(build_dir, cache_size=cache_size)
+    async with client:
+        response = await client.get(f'/{SCRIPT_PATH}')
+        assert response.headers['cache-control'] == 'public, max-age=31536000, immutable'
+
+        response = await client.get('/')
+        assert response.headers['cache-control'] == 'no-cache'
+        assert response.content == INDEX
+        response = await client.get('/', headers={'If-None-Match': response.headers['etag']})
+        assert response.status_code == 304
+        assert response.headers['cache-control'] == 'no-cache'
+
+async def test_frontend_routes(build_dir):
+    client, _ = create_client(build_dir)
+    async with client:
+        for path in ('/items/12', '/tags', '/items/12/edit'):
+            response = await client.get(path)
+            assert response.status_code == 200
+            assert response.content == INDEX
+            assert response.headers['cache-control'] == 'no-cache'
+        # A missing file is not a route
+        assert (await client.get('/static/js/main.00000000.js')).status_code == 404
+        assert (await client.get('/favicon.ico')).status_code == 404
+
+async def test_memory_cache(build_dir):
+    client, files = create_client(build_dir, cache_size=2, max_cached_file_size=len(INDEX))
+    async with client:
+        for _ in range(3):
+            assert (await client.get('/', headers={'Accept-Encoding': 'gzip'})).content == INDEX
+        assert files.cache.stats() == {'size': 1, 'hits': 2, 'misses': 1}
+
+        # Too large to be kept in memory
+        response = await client.get(f'/{SCRIPT_PATH}', headers={'Accept-Encoding': 'identity'})
+        assert response.content == SCRIPT
+        assert files.cache.stats()['size'] == 1
+
+        # The least recently used entry is evicted (the accepted encodings are part of the key)
+        await client.get('/robots.txt')
+        await client.get('/', headers={'Accept-Encoding': 'br'})
+        assert files.cache.stats()['size'] == 2
+        await client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert files.cache.stats()['misses'] == 5
+
+        # A changed file is served again once its entry is dropped
+        files.cache.clear()
+        (build_dir / 'robots.txt').write_bytes(b'User-agent: *\nDisallow: /api/\n')
+        assert (await client.get('/robots.txt')).content == b'User-agent: *\nDisallow: /api/\n'
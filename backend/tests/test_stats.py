@@ -0,0 +1,72 @@
+import random
+
+import pytest
+
+from backend import crud, database, models
+
+pytestmark = pytest.mark.anyio
+
+
+async def get_stats(client, user):
+    response = await client.get('/api/users/me/stats', headers=user.headers)
+    assert response.status_code == 200
+    return response.json()
+
+async def rebuild_stats(client, user):
+    """Get the stats of the user once computed again from the items."""
+    with database.SessionLocal() as db:
+        crud.rebuild_item_stats(db, user.id)
+    return await get_stats(client, user)
+
+def random_links(rng, kind: str, names: list):
+    count = rng.randint(1, 2) if kind == 'locations' else rng.randint(0, 3)
+    return [{'name': name} for name in rng.sample(names, count)]
+
+async def change_randomly(client, user, rng, item_ids: list, names: dict):
+    """Create, update, archive, tag or delete random items, with the single item and the bulk endpoints."""
+    operation = rng.choice(['create', 'update', 'update', 'delete', 'bulk'])
+    if operation == 'create' or not item_ids:
+        item = {'name': 'Random item', 'cost': rng.randint(0, 100), 'tags': random_links(rng, 'tags', names['tags']),
+                'locations': random_links(rng, 'locations', names['locations'])}
+        response = await client.post('/api/users/me/items/', headers=user.headers, json=item)
+        item_ids.append(response.json()['id'])
+    elif operation == 'update':
+        changes = rng.choice([
+            {'cost': rng.randint(0, 100)},
+            {'is_active': rng.random() < 0.5},
+            {'tags': random_links(rng, 'tags', names['tags'] + ['new tag'])},
+            {'locations': random_links(rng, 'locations', names['locations'])},
+            {'cost': rng.randint(0, 100), 'is_active': True, 'tags': random_links(rng, 'tags', names['tags'])},
+        ])
+        response = await client.post(f'/api/users/me/items/{rng.choice(item_ids)}', headers=user.headers, json=changes)
+    elif operation == 'delete':
+        item_id = item_ids.pop(rng.randrange(len(item_ids)))
+        response = await client.delete(f'/api/users/me/items/{item_id}', headers=user.headers)
+    else:
+        bulk = {'ids': rng.sample(item_ids, min(len(item_ids), rng.randint(1, 5))),
+                'operation': rng.choice(['archive', 'restore', 'add_tag', 'remove_tag', 'move_location'])}
+        bulk['tag'] = {'name': rng.choice(names['tags'])}
+        bulk['location'] = {'name': rng.choice(names['locations'])}
+        response = await client.post('/api/users/me/items/bulk', headers=user.headers, json=bulk)
+    assert response.status_code in (200, 204)
+
+async def test_stats_match_rebuild(client, user):
+    """The stats kept up to date by the changes are the ones computed from the items."""
+    rng = random.Random(0)
+    items = (await client.get('/api/users/me/items/', headers=user.headers)).json()
+    item_ids = [item['id'] for item in items]
+    names = {kind: [linked['name'] for linked in (await client.get(f'/api/users/me/{kind}/', headers=user.headers)).json()]
+             for kind in ('tags', 'locations')}
+
+    for _ in range(60):
+        await change_randomly(client, user, rng, item_ids, names)
+
+    stats = await get_stats(client, user)
+    assert stats['active_count'] + stats['archived_count'] == len(item_ids)
+    assert stats == await rebuild_stats(client, user)
+
+def test_item_stats(user):
+    """The stats of a single item computed in Python are the ones of the aggregate queries."""
+    with database.SessionLocal() as db:
+        for db_item in db.query(models.Item).filter(models.Item.owner_id == user.id):
+            assert crud.get_item_stats(db_item) == crud.aggregate_item_stats(db, models.Item.id == db_item.id)
@@ -0,0 +1,120 @@
+import asyncio
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from backend import crud, models, storage
+from backend.scripts import stress_writers
+
+
+def add_tag(db, name: str):
+    db.add(models.Tag(name=name, revision=0, owner_id=1))
+    db.flush()
+
+def failing_job(db, called: list):
+    crud.after_commit(db, called.append, 'failing')
+    add_tag(db, 'failing')
+    raise ValueError('Job failed.')
+
+def committing_job(db, called: list):
+    """Commit a first change, and fail after a second one."""
+    crud.after_commit(db, called.append, 'committed')
+    add_tag(db, 'committed')
+    db.commit()
+    crud.after_commit(db, called.append, 'rolled back')
+    add_tag(db, 'rolled back')
+    raise ValueError('Job failed.')
+
+def succeeding_job(db, called: list):
+    crud.after_commit(db, called.append, 'succeeding')
+    add_tag(db, 'succeeding')
+    db.commit()
+
+@pytest.mark.anyio
+async def test_writer_callbacks(tmp_path):
+    url = f'sqlite:///{tmp_path}/writer.db'
+    engine = storage.create_sync_engine(url)
+    models.Base.metadata.create_all(bind=engine)
+    writer = storage.Writer(storage.create_write_engine(url.replace('sqlite:', 'sqlite+aiosqlite:')))
+    called = []
+
+    # Queued at once: a single batch
+    results = await asyncio.gather(*[writer.run(job, called) for job in (failing_job, committing_job, succeeding_job)],
+                                   return_exceptions=True)
+    await writer.close()
+    await writer.engine.dispose()
+
+    assert writer.batches == 1
+    assert [type(result) for result in results] == [ValueError, ValueError, type(None)]
+    # Only the callbacks of the changes that were kept
+    assert called == ['committed', 'succeeding']
+    with engine.connect() as connection:
+        assert {name for name, in connection.exec_driver_sql('SELECT name FROM tags')} == {'committed', 'succeeding'}
+    engine.dispose()
+
+@contextmanager
+def locked_writer(tmp_path, monkeypatch, busy_timeout: int):
+    """A writer on a DB whose write lock is held by another connection (e.g., of another process)."""
+    monkeypatch.setattr(storage, 'SQLITE_BUSY_TIMEOUT', busy_timeout)
+    url = f'sqlite:///{tmp_path}/writer.db'
+    engine = storage.create_sync_engine(url)
+    models.Base.metadata.create_all(bind=engine)
+    writer = storage.Writer(storage.create_write_engine(url.replace('sqlite:', 'sqlite+aiosqlite:')))
+    # Started with BEGIN IMMEDIATE: takes the write lock
+    with engine.begin():
+        yield writer
+    engine.dispose()
+
+@pytest.mark.anyio
+async def test_writer_lock_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'WRITE_LOCK_ATTEMPTS', 2)
+    with locked_writer(tmp_path, monkeypatch, busy_timeout=100) as writer:
+        called = []
+        results = await asyncio.gather(*[writer.run(succeeding_job, called) for _ in range(3)],
+                                       return_exceptions=True)
+        assert [type(result) for result in results] == [OperationalError] * 3
+        assert called == []
+        await writer.close()
+        await writer.engine.dispose()
+
+@pytest.mark.anyio
+async def test_writer_close(tmp_path, monkeypatch):
+    with locked_writer(tmp_path, monkeypatch, busy_timeout=500) as writer:
+        writer.batch_size = 1
+        # The first job waits for the lock, the other ones are queued
+        tasks = [asyncio.ensure_future(writer.run(succeeding_job, [])) for _ in range(3)]
+        await asyncio.sleep(0.1)
+        await writer.close()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert [type(result) for result in results] == [storage.WriterClosedException] * 3
+        await writer.engine.dispose()
+
+
+@pytest.mark.parametrize('shared_user', [False, True], ids=['user_per_process', 'shared_user'])
+def test_concurrent_writers(tmp_path, shared_user):
+    processes, writers, writes = 2, 5, 5
+    db_path = str(tmp_path / 'stress.db')
+    errors, _, _ = stress_writers.stress(db_path, processes, writers, writes, shared_user=shared_user)
+    assert errors == []
+
+    items = processes * writers * writes
+    users = 1 if shared_user else processes
+    engine = create_engine(f'sqlite:///{db_path}')
+    with engine.connect() as connection:
+        def count(sql: str):
+            return connection.exec_driver_sql(sql).scalar()
+
+        assert count('SELECT COUNT(*) FROM items') == items
+        assert count('SELECT COUNT(*) FROM items WHERE is_bookmarked') == items
+        # Each process creates the tags and locations it does not find: each name is created once per user
+        assert count('SELECT COUNT(*) FROM tags') == users * 5
+        assert count('SELECT COUNT(*) FROM locations') == users * 3
+        assert count('SELECT COUNT(*) FROM item_tags') == items
+        assert count('SELECT COUNT(*) FROM item_locations') == items
+        assert count("SELECT SUM(count) FROM item_stats WHERE kind = 'active'") == items
+        assert count("SELECT SUM(count) FROM item_stats WHERE kind = 'tag'") == items
+        # A revision per commit: the creation and the update of each item
+        assert count('SELECT SUM(revision) FROM users') == 2 * items
+    engine.dispose()
@@ -252,6 +252,29 @@ export function loadItemImage({id, image}) {
   });
 }
 
+export function loadItemThumbnail({id, thumbnail}) {
+
+  const state = store.getState();
+  const token = state.global.token;
+
+  return fetch(`${backendAddress}/users/me/items/${id}/thumbnail/${thumbnail}`, {
+        method: 'GET',
+        mode: 'cors',
+        headers: {
+         'Authorization': `Bearer ${token}`
+        }
+  })
+  .then(response => {
+        if(response.ok) {
+            return response.blob()
+        }
+        return response.text().then(text => {throw new ApplicationException({code: response.status, message:text})})
+  })
+  .then(blob => {
+      return URL.createObjectURL(blob);
+  });
+}
+
 export async function saveItemImage({id, imageUrl, mode}) {
 
   const state = store.getState();
@@ -1,4 +1,4 @@
-import React, {useEffect, useState, useCallback} from 'react';
+import React, {useEffect, useState, useCallback, useRef} from 'react';
 import { useDispatch, useSelector } from 'react-redux';
 import { useNavigate } from "react-router-dom";
 
@@ -36,7 +36,7 @@ import UnarchiveIcon from '@mui/icons-material/Unarchive';
 
 import GlobalLoading from '../components/GlobalLoading';
 
-import {addItem, saveItem, archiveItem, deleteItem, checkTag, checkLocation } from '../services/backend';
+import {addItem, saveItem, archiveItem, deleteItem, checkTag, checkLocation, loadItemThumbnail } from '../services/backend';
 import {setSelectedItem, setYItems, setVisibleStats, setIsMultiEdit,
  setTags as setGlobalTags, setLocations as setGlobalLocations} from '../services/store';
 
@@ -53,6 +53,8 @@ export default function Items() {
   const [locations, setLocations] = useState([]);
   const [inputTag, setInputTag] = useState('');
   const [inputLocation, setInputLocation] = useState('');
+  const [thumbnails, setThumbnails] = useState({});
+  const requestedThumbnails = useRef(new Set());
 
   const items = useSelector((state) => state.global.items);
   const globalTags = useSelector((state) => state.global.tags);
@@ -67,8 +69,8 @@ export default function Items() {
   const dispatch = useDispatch();
 
   const getThumbnail = (item) => {
-    if (item.photos?.thumbnail) {
-        return 'data:image/jpeg;base64,' + item.photos.thumbnail;
+    if (item.photos?.thumbnail_id && thumbnails[item.photos.thumbnail_id]) {
+        return thumbnails[item.photos.thumbnail_id];
     } else {
         // If the thumbnail is not available replace it with a standard image
         return 'no-image-icon.gif';
@@ -496,6 +498,19 @@ export default function Items() {
     computeVisibleStats(items);
   }, [items, scrollPosition, resetSelection, computeVisibleStats]);
 
+  useEffect(() => {
+    // Thumbnails are served separately from the items (and cached by the browser)
+    items.forEach(item => {
+        const thumbnail = item.photos?.thumbnail_id;
+        if (thumbnail && !requestedThumbnails.current.has(thumbnail)) {
+            requestedThumbnails.current.add(thumbnail);
+            loadItemThumbnail({id: item.id, thumbnail})
+            .then(url => setThumbnails(previous => ({...previous, [thumbnail]: url})))
+            .catch(() => {});
+        }
+    });
+  }, [items]);
+
   return(
     <React.Fragment>
 